@@ -0,0 +1,258 @@
+"""Versioned JSON API, under /api/v1.
+
+Reads:
+
+- GET /timeline?cursor=&limit=       the current user's home timeline
+- GET /users/<id>/messages?cursor=   one user's messages
+- GET /users/<id>                    one user
+- GET /users?ids=1,2,3               several users at once
+- GET /relationships?ids=1,2,3       does the current user follow them /
+                                     do they follow the current user?
+
+Writes, answered with just the new state:
+
+- POST / DELETE /messages/<id>/like  -> {"liked": ..., "count": ...}
+- POST / DELETE /users/<id>/follow   -> {"following": ..., "follower_count": ...}
+
+Clients authenticate with the site's session cookie. Writes must also send a
+JSON body or an X-Requested-With header, which a cross-site form can't, so a
+logged-in browser can't be tricked into making them. Batch endpoints take up
+to API_MAX_BATCH ids.
+
+User endpoints read only the columns they return, as plain rows rather than
+model instances; message pages load each author's few columns in the same
+query. Either way an endpoint runs a fixed number of queries however many
+items it returns (see test_api.py).
+"""
+
+from flask import Blueprint, abort, current_app, g, jsonify, request
+
+from models import db, Follows, Likes, Message, User
+from pagination import paginate, per_page
+import graph
+from tasks import run_in_background
+import timeline
+from user_context import invalidate_user_context
+
+DEFAULT_MAX_BATCH = 100
+
+USER_FIELDS = ('id', 'username', 'image_url', 'header_image_url', 'bio',
+               'location', 'message_count', 'following_count',
+               'follower_count', 'like_count')
+
+AUTHOR_FIELDS = ('id', 'username', 'image_url')
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+_user_columns = [User.__table__.c[field] for field in USER_FIELDS]
+
+
+##############################################################################
+# Helpers
+
+
+def _error(e):
+    return jsonify(error=e.name, description=e.description), e.code
+
+
+# by status code, so these win over the app's HTML 404 page
+for code in (400, 401, 403, 404, 405):
+    api.register_error_handler(code, _error)
+
+
+@api.before_request
+def _check_write():
+    if request.method in ('GET', 'HEAD'):
+        return
+    if not (request.is_json or request.headers.get('X-Requested-With')):
+        abort(400, "Send a JSON body or an X-Requested-With header.")
+
+
+def _current_user_id():
+    if not g.user:
+        abort(401)
+    return g.user.id
+
+
+def _id_list(name='ids'):
+    """The comma-separated ids in query parameter `name`, in order, deduped."""
+
+    try:
+        ids = [int(part) for part in request.args.get(name, '').split(',')
+               if part.strip()]
+    except ValueError:
+        abort(400, f"{name} must be comma-separated integers.")
+
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > current_app.config.get('API_MAX_BATCH', DEFAULT_MAX_BATCH):
+        abort(400, f"Too many {name}.")
+    return ids
+
+
+def _limit():
+    limit = request.args.get('limit', type=int)
+    if limit is None:
+        return None
+    return max(1, min(limit, per_page()))
+
+
+def _user_rows(ids):
+    return (db.session.query(*_user_columns)
+            .filter(User.id.in_(ids), User.deleted_at.is_(None)))
+
+
+def _user_exists(user_id):
+    return db.session.query(User.id).filter(
+        User.id == user_id, User.deleted_at.is_(None)).scalar() is not None
+
+
+def _messages_page(query):
+    """Serialize a page of messages, with each author listed once."""
+
+    page = paginate(query, request.args.get('cursor'), _limit())
+    liked = g.user_context.liked_message_ids if g.user_context else ()
+
+    messages, authors = [], {}
+    for message in page.items:
+        author = message.user
+        if author.id not in authors:
+            authors[author.id] = {field: getattr(author, field)
+                                  for field in AUTHOR_FIELDS}
+        messages.append({
+            'id': message.id,
+            'text': message.text,
+            'timestamp': message.timestamp.isoformat(),
+            'user_id': author.id,
+            'liked': message.id in liked,
+        })
+
+    return jsonify(messages=messages, users=authors,
+                   next_cursor=page.next_cursor)
+
+
+##############################################################################
+# Reads
+
+
+@api.route('/timeline')
+def home_timeline():
+    """The current user's home timeline, a page at a time."""
+
+    return _messages_page(timeline.timeline_query(_current_user_id()))
+
+
+@api.route('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """`user_id`'s messages, a page at a time."""
+
+    if not _user_exists(user_id):
+        abort(404)
+    return _messages_page(Message.with_authors()
+                          .filter(Message.user_id == user_id))
+
+
+@api.route('/users/<int:user_id>')
+def user_detail(user_id):
+    """One user's public profile."""
+
+    row = _user_rows([user_id]).first()
+    if row is None:
+        abort(404)
+    return jsonify(dict(zip(USER_FIELDS, row)))
+
+
+@api.route('/users')
+def users_batch():
+    """The users in ?ids=, in that order; unknown ids are left out."""
+
+    ids = _id_list()
+    found = {row[0]: row for row in _user_rows(ids)} if ids else {}
+    return jsonify(users=[dict(zip(USER_FIELDS, found[user_id]))
+                          for user_id in ids if user_id in found])
+
+
+@api.route('/relationships')
+def relationships():
+    """How the current user and each user in ?ids= are connected."""
+
+    user_id = _current_user_id()
+    ids = _id_list()
+    following, followers = Follows.relationships(user_id, ids)
+    return jsonify(relationships=[
+        {'id': other_id,
+         'following': other_id in following,
+         'followed_by': other_id in followers}
+        for other_id in ids])
+
+
+##############################################################################
+# Writes
+
+
+@api.route('/messages/<int:message_id>/like', methods=['POST', 'DELETE'])
+def like(message_id):
+    """Like (POST) or un-like (DELETE) a message; both are idempotent."""
+
+    user_id = _current_user_id()
+    author_id = (db.session.query(Message.user_id)
+                 .filter(Message.id == message_id).scalar())
+    if author_id is None:
+        abort(404)
+    if author_id == user_id:
+        abort(403, "You cannot like your own post.")
+
+    if request.method == 'POST':
+        Likes.like(user_id, message_id)
+    else:
+        Likes.unlike(user_id, message_id)
+    count = Likes.count_for(message_id)
+    db.session.commit()
+    invalidate_user_context(user_id)
+
+    return jsonify(liked=request.method == 'POST', count=count)
+
+
+@api.route('/users/<int:followed_id>/follow', methods=['POST', 'DELETE'])
+def follow(followed_id):
+    """Follow (POST) or unfollow (DELETE) a user; both are idempotent.
+
+    A POST that starts a follow is a 201; repeating it is a 200.
+    """
+
+    user_id = _current_user_id()
+    if followed_id == user_id:
+        abort(403, "You cannot follow yourself.")
+
+    # conflict-ignoring writes, so racing requests can't fail or
+    # double-count; see models.py
+    if request.method == 'POST':
+        if not _user_exists(followed_id):
+            abort(404)
+        changed = Follows.follow(user_id, followed_id)
+    else:
+        changed = Follows.unfollow(user_id, followed_id)
+
+    follower_count = (db.session.query(User.follower_count)
+                      .filter(User.id == followed_id).scalar())
+    if follower_count is None:
+        abort(404)
+    db.session.commit()
+    invalidate_user_context(user_id)
+    if request.method == 'POST':
+        graph.index.add(user_id, followed_id)
+    else:
+        graph.index.remove(user_id, followed_id)
+
+    if timeline.fanout_enabled():
+        run_in_background(timeline.add_followed if request.method == 'POST'
+                          else timeline.remove_followed, user_id, followed_id)
+
+    status = 201 if request.method == 'POST' and changed else 200
+    return jsonify(following=request.method == 'POST',
+                   follower_count=follower_count), status
+
+
+def init_app(app):
+    """Mount the API on `app`."""
+
+    app.register_blueprint(api)
@@ -1,13 +1,33 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g, url_for
+import click
+from flask import (Flask, render_template, request, flash, redirect, session, g,
+                   url_for, abort, jsonify)
 from functools import wraps
 from flask_debugtoolbar import DebugToolbarExtension
-from sqlalchemy import or_
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import load_only
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Likes
+from models import db, connect_db, User, Message, Likes, Follows
+from tasks import run_in_background
+from hashing import HashingOverloaded
+import timeline
+from pagination import paginate
+from user_context import load_user_context, invalidate_user_context
+import search
+import instrumentation
+import fragments
+import caching
+import assets
+import replicas
+import pooling
+import api
+import live
+import recommendations
+import graph
+import purge
+import partitions
 
 CURR_USER_KEY = "curr_user"
 
@@ -18,13 +38,137 @@ app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgres:///warbler'))
 
+# Read replicas for GET requests (comma-separated URIs); see replicas.py.
+# A client that just wrote reads from the primary for DB_STICKY_SECONDS.
+app.config['SQLALCHEMY_REPLICA_URIS'] = [
+    uri for uri in os.environ.get('REPLICA_DATABASE_URLS', '').split(',')
+    if uri]
+app.config['DB_STICKY_SECONDS'] = 10
+
+# Connection pools, for the primary and each replica; see pooling.py.
+# Each request's statements are cut off after DB_STATEMENT_TIMEOUT_MS
+# (0 for no limit), and DB_POOL_WARMUP connections are opened at startup.
+app.config['DB_POOL_SIZE'] = int(
+    os.environ.get('DB_POOL_SIZE', pooling.DEFAULT_POOL_SIZE))
+app.config['DB_MAX_OVERFLOW'] = int(
+    os.environ.get('DB_MAX_OVERFLOW', pooling.DEFAULT_MAX_OVERFLOW))
+app.config['DB_POOL_TIMEOUT'] = int(
+    os.environ.get('DB_POOL_TIMEOUT', pooling.DEFAULT_POOL_TIMEOUT))
+app.config['DB_POOL_RECYCLE'] = int(
+    os.environ.get('DB_POOL_RECYCLE', pooling.DEFAULT_POOL_RECYCLE))
+app.config['DB_POOL_PRE_PING'] = (
+    os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true')
+app.config['DB_STATEMENT_TIMEOUT_MS'] = int(
+    os.environ.get('DB_STATEMENT_TIMEOUT_MS', 5000))
+app.config['DB_POOL_WARMUP'] = int(os.environ.get('DB_POOL_WARMUP', 0))
+
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Password hashing runs on a process pool; see hashing.py. Changing
+# BCRYPT_LOG_ROUNDS rehashes passwords as users log in.
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_HASH_WORKERS'] = int(
+    os.environ.get('PASSWORD_HASH_WORKERS', 2))
+app.config['PASSWORD_HASH_MAX_PENDING'] = int(
+    os.environ.get('PASSWORD_HASH_MAX_PENDING', 8))
+
+# Precomputed (fan-out-on-write) home timelines; see timeline.py. Run
+# `flask rebuild-timelines` when turning this on for an existing database
+app.config['TIMELINE_FANOUT_ENABLED'] = (
+    os.environ.get('TIMELINE_FANOUT_ENABLED', 'false').lower() == 'true')
+app.config['TIMELINE_MAX_LENGTH'] = 800
+app.config['TIMELINE_FANOUT_FOLLOWER_LIMIT'] = 5000
+app.config['TASKS_ALWAYS_EAGER'] = False
+
+# Page size for timelines, profiles and likes; see pagination.py
+app.config['MESSAGES_PER_PAGE'] = int(
+    os.environ.get('MESSAGES_PER_PAGE', 100))
+
+# Pages look this many days back before reaching for older messages; worth
+# turning on once messages is partitioned by month (partitions.py). 0 = off.
+app.config['MESSAGES_HOT_WINDOW_DAYS'] = int(
+    os.environ.get('MESSAGES_HOT_WINDOW_DAYS', 0))
+# Months of partitions kept ahead, and (0 = all) kept attached
+app.config['MESSAGE_PARTITIONS_AHEAD'] = 3
+app.config['MESSAGE_PARTITIONS_KEEP_MONTHS'] = int(
+    os.environ.get('MESSAGE_PARTITIONS_KEEP_MONTHS', 0))
+
+# How long (seconds) the current user's likes/follows id-sets are cached
+# between requests; see user_context.py. 0 turns the cache off.
+app.config['USER_CONTEXT_TTL'] = int(os.environ.get('USER_CONTEXT_TTL', 30))
+
+# User directory / search paging; see search.py
+app.config['USERS_PER_PAGE'] = 24
+app.config['SEARCH_MAX_RESULTS'] = 100
+# Without pg_trgm, searches use an in-process index of usernames, reloaded
+# after this many seconds to pick up other processes' changes
+app.config['SEARCH_INDEX_TTL'] = int(os.environ.get('SEARCH_INDEX_TTL', 60))
+
+# A SELECT repeated this many times in one request is flagged as a likely
+# N+1; see instrumentation.py
+app.config['N_PLUS_ONE_THRESHOLD'] = 10
+# Bearer token for /metrics; unset, /metrics answers no one unless
+# METRICS_ALLOW_LOCAL lets in requests from this machine (not behind a
+# reverse proxy on the same host: every request would look local)
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN') or None
+app.config['METRICS_ALLOW_LOCAL'] = (
+    os.environ.get('METRICS_ALLOW_LOCAL', 'false').lower() == 'true')
+
+# Rendered message/user cards; see fragments.py. Set FRAGMENT_CACHE_BACKEND
+# to a shared cache client to share cards between processes.
+app.config['FRAGMENT_CACHE_ENABLED'] = True
+app.config['FRAGMENT_CACHE_MAX_ENTRIES'] = 20000
+app.config['FRAGMENT_CACHE_BACKEND'] = None
+
+# Cache lifetime (seconds) for static files that aren't fingerprinted;
+# see caching.py
+app.config['STATIC_MAX_AGE'] = 60 * 60
+
+# JSON API; see api.py. Batch endpoints take at most API_MAX_BATCH ids, and
+# payloads go out in field order rather than spending time sorting keys.
+app.config['API_MAX_BATCH'] = 100
+app.config['JSON_SORT_KEYS'] = False
+
+# Live timeline updates over server-sent events; see live.py. LIVE_BROKER is
+# None (this process only) or 'postgres' (NOTIFY, for several processes).
+app.config['LIVE_BROKER'] = os.environ.get('LIVE_BROKER') or None
+app.config['LIVE_KEEPALIVE_SECONDS'] = 15
+app.config['LIVE_MAX_SECONDS'] = 5 * 60
+app.config['LIVE_QUEUE_SIZE'] = 100
+
+# Who-to-follow suggestions, refreshed by `flask refresh-recommendations`;
+# see recommendations.py. The home sidebar shows RECOMMENDATIONS_SHOWN of
+# them and gives the lookup RECOMMENDATIONS_BUDGET_MS (0 for no limit).
+app.config['RECOMMENDATIONS_PER_USER'] = 10
+app.config['RECOMMENDATIONS_SHOWN'] = 3
+app.config['RECOMMENDATIONS_BATCH_SIZE'] = 500
+app.config['RECOMMENDATIONS_BUDGET_MS'] = 50
+app.config['RECOMMENDATIONS_CACHE_TTL'] = 5 * 60
+
+# In-process following/followers lists; see graph.py. Entries are reloaded
+# after GRAPH_INDEX_TTL seconds (0 turns the index's cache off), and all of
+# them together are kept under GRAPH_INDEX_MAX_BYTES.
+app.config['GRAPH_INDEX_TTL'] = 60
+app.config['GRAPH_INDEX_MAX_BYTES'] = 64 * 1024 * 1024
+
+# Deleted accounts' data is purged by `flask purge-deleted-users` (run it
+# from cron) this many rows at a time, pausing between batches; see purge.py
+app.config['PURGE_BATCH_SIZE'] = 500
+app.config['PURGE_BATCH_PAUSE_SECONDS'] = 0.05
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+replicas.init_app(app)
+instrumentation.init_app(app)
+fragments.init_app(app)
+assets.init_app(app)
+pooling.start_warm_up(app)
+api.init_app(app)
+live.init_app(app)
+recommendations.init_app(app)
 
 
 ##############################################################################
@@ -33,12 +177,18 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user (and their context) to Flask global.
+
+    g.user_context also carries the ids the user likes and follows; see
+    user_context.py.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user_context = load_user_context(session[CURR_USER_KEY])
+        g.user = g.user_context.user if g.user_context else None
 
     else:
+        g.user_context = None
         g.user = None
 
 def login_required(f):
@@ -51,6 +201,35 @@ def login_required(f):
             return redirect("/") 
     return func
 
+def follow_state(user_ids):
+    """Which of `user_ids` does the current user follow / get followed by?
+
+    Returns (following_ids, follower_ids) sets for templates to check rows
+    against, from one query; both are empty when logged out.
+    """
+
+    if not g.user:
+        return set(), set()
+
+    return Follows.relationships(g.user.id, set(user_ids))
+
+
+def wants_json():
+    """Did the client ask for JSON rather than a page?"""
+
+    best = request.accept_mimetypes.best_match(['text/html',
+                                                'application/json'])
+    return best == 'application/json'
+
+
+def user_profile_version(user):
+    """Everything about `user` a profile header shows, for ETags."""
+
+    return (user.id, user.username, user.image_url, user.header_image_url,
+            user.bio, user.location, user.message_count,
+            user.following_count, user.follower_count, user.like_count)
+
+
 def do_login(user):
     """Log in user."""
 
@@ -92,6 +271,11 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        except HashingOverloaded:
+            flash("We're very busy right now. Please try again in a moment.",
+                  'danger')
+            return render_template('users/signup.html', form=form), 503
+
         do_login(user)
 
         return redirect("/")
@@ -107,10 +291,17 @@ def login():
     form = LoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
+        try:
+            user = User.authenticate(form.username.data,
+                                     form.password.data)
+        except HashingOverloaded:
+            flash("We're very busy right now. Please try again in a moment.",
+                  'danger')
+            return render_template('users/login.html', form=form), 503
 
         if user:
+            # keep the password hash if authenticate() upgraded it
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -135,54 +326,95 @@ def logout():
 
 @app.route('/users')
 def list_users():
-    """Page with listing of users.
+    """Page with listing of users, a page at a time.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username
+    ('page' pages through the results); otherwise lists everyone in signup
+    order ('after' continues from a user id).
     """
 
-    search = request.args.get('q')
+    term = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
+    if not term:
+        users, next_after = search.browse_users(
+            request.args.get('after', type=int))
+        more_url = next_after and url_for('list_users', after=next_after)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        page = request.args.get('page', 1, type=int)
+        users, has_more = search.search_users(term, page)
+        more_url = has_more and url_for('list_users', q=term, page=page + 1)
 
-    return render_template('users/index.html', users=users)
+    following_ids, follower_ids = follow_state(user.id for user in users)
+    return render_template('users/index.html', users=users,
+                           more_url=more_url,
+                           following_ids=following_ids,
+                           follower_ids=follower_ids)
 
 
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    user = User.active().filter_by(id=user_id).first_or_404()
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    page = paginate(Message.query.filter(Message.user_id == user_id),
+                    request.args.get('cursor'))
+    etag = caching.etag_for(
+        'users_show', user_profile_version(user),
+        [msg.id for msg in page.items], page.next_cursor)
+    return caching.render_conditional(
+        etag, 'users/show.html',
+        last_modified=page.items[0].timestamp if page.items else None,
+        user=user, messages=page.items, next_cursor=page.next_cursor)
 
 
 @app.route('/users/<int:user_id>/following')
 @login_required
 def show_following(user_id):
-    """Show list of people this user is following."""
+    """Show list of people this user is following, a page at a time."""
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = User.active().filter_by(id=user_id).first_or_404()
+    return render_follow_list('users/following.html', user,
+                              graph.index.following(user_id))
 
 
 @app.route('/users/<int:user_id>/followers')
 @login_required
 def users_followers(user_id):
-    """Show list of followers of this user."""
+    """Show list of followers of this user, a page at a time."""
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = User.active().filter_by(id=user_id).first_or_404()
+    return render_follow_list('users/followers.html', user,
+                              graph.index.followers(user_id))
+
+
+def render_follow_list(template, user, ids):
+    """Render one page (?page=) of the users in `ids`, a sorted id array.
+
+    Only the page's users are loaded, with just the columns their cards
+    show; whether the current user follows them / is followed by them comes
+    from the graph index.
+    """
+
+    number = request.args.get('page', 1, type=int)
+    page_ids, has_more = graph.page(ids, number, app.config['USERS_PER_PAGE'])
+
+    users = []
+    if page_ids:
+        by_id = {u.id: u for u in User.active()
+                 .options(load_only('id', 'username', 'image_url',
+                                    'header_image_url', 'bio'))
+                 .filter(User.id.in_(list(page_ids)))}
+        users = [by_id[user_id] for user_id in page_ids if user_id in by_id]
+
+    more_url = has_more and url_for(request.endpoint, user_id=user.id,
+                                    page=number + 1)
+    return render_template(
+        template, user=user, users=users, more_url=more_url,
+        following_ids=g.user_context.following_ids,
+        follower_ids=graph.index.followers_among(g.user.id, page_ids))
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -190,11 +422,19 @@ def users_followers(user_id):
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    followed_user = User.active().filter_by(id=follow_id).first_or_404()
+
+    # one conflict-ignoring INSERT that keeps the follower/following counts
+    # in step; the cached following_ids may be stale, so don't trust it here
+    Follows.follow(g.user.id, followed_user.id)
     db.session.commit()
+    invalidate_user_context(g.user.id)
+    graph.index.add(g.user.id, followed_user.id)
 
-    return redirect(url_for(show_following, user_id=g.user.id))
+    if timeline.fanout_enabled():
+        run_in_background(timeline.add_followed, g.user.id, followed_user.id)
+
+    return redirect(url_for('show_following', user_id=g.user.id))
 
 
 @app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
@@ -202,11 +442,17 @@ def add_follow(follow_id):
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    # a guarded DELETE, so racing unfollows can't un-count twice
+    if not Follows.unfollow(g.user.id, follow_id):
+        abort(404)
     db.session.commit()
+    invalidate_user_context(g.user.id)
+    graph.index.remove(g.user.id, follow_id)
+
+    if timeline.fanout_enabled():
+        run_in_background(timeline.remove_followed, g.user.id, follow_id)
 
-    return redirect(url_for(show_following, user_id=g.user.id))
+    return redirect(url_for('show_following', user_id=g.user.id))
 
 
 @app.route('/users/<int:user_id>/profile', methods=["GET", "POST"])
@@ -229,19 +475,29 @@ def profile(user_id):
         user.location = form.location.data
 
         db.session.commit()
-        return redirect(url_for(users_show, user_id = user.id))
+        invalidate_user_context(user.id)
+        fragments.invalidate_user(user.id)
+        return redirect(url_for('users_show', user_id = user.id))
     return render_template('users/edit.html', form=form)
 
 
 @app.route('/users/delete', methods=["POST"])
 @login_required
 def delete_user():
-    """Delete user."""
+    """Delete user.
+
+    The account is soft-deleted straight away; its messages, likes and
+    follows are purged later by `flask purge-deleted-users` (see purge.py).
+    """
 
     do_logout()
 
-    db.session.delete(g.user)
+    user_id = g.user.id
+    purge.soft_delete(g.user)
     db.session.commit()
+    invalidate_user_context(user_id)
+    fragments.invalidate_user(user_id)
+    graph.index.forget(user_id)
 
     return redirect("/signup")
 
@@ -264,7 +520,11 @@ def messages_add():
         g.user.messages.append(msg)
         db.session.commit()
 
-        return redirect(url_for(users_show, user_id = g.user.id))
+        if timeline.fanout_enabled():
+            run_in_background(timeline.fanout_message, msg.id)
+        live.publish_message(msg)
+
+        return redirect(url_for('users_show', user_id = g.user.id))
 
     return render_template('messages/new.html', form=form)
 
@@ -274,22 +534,31 @@ def messages_show(message_id):
     """Show a message."""
 
     msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+    if msg.user.deleted_at is not None:
+        abort(404)
+    etag = caching.etag_for('messages_show', msg.id,
+                            msg.user.username, msg.user.image_url)
+    return caching.render_conditional(etag, 'messages/show.html',
+                                      last_modified=msg.timestamp,
+                                      message=msg)
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
 @login_required
 def messages_destroy(message_id):
     """Delete a message."""
-    msg = Message.query.get(message_id)
+    msg = Message.query.get_or_404(message_id)
     if g.user.id != msg.user_id:
         flash('You are not authorized to delete that message.')
         return redirect(f'/users/{g.user.id}')
 
-    db.session.delete(msg)
+    # see Message.remove(): a racing second delete changes nothing
+    if not Message.remove(message_id, g.user.id):
+        abort(404)
     db.session.commit()
+    fragments.invalidate_message(message_id)
 
-    return redirect(url_for(users_show, user_id = g.user.id))
+    return redirect(url_for('users_show', user_id = g.user.id))
 
 
 ##############################################################################
@@ -297,29 +566,50 @@ def messages_destroy(message_id):
 
 @app.route('/messages/<int:user_id>/likes')
 def show_likes(user_id):
-    """Show a user's likes"""
-    user = User.query.get_or_404(user_id)
-    return render_template('messages/likes.html', user=user, likes=user.likes)
+    """Show a user's likes, a page at a time, streamed as it renders.
+
+    Authors are loaded in one batch for the page, and the viewer's likes and
+    follows come as sets, so rendering itself doesn't touch the database.
+    """
+    user = User.active().filter_by(id=user_id).first_or_404()
+    page = paginate(Message.with_authors(batched=True)
+                    .join(Likes, Likes.message_id == Message.id)
+                    .filter(Likes.user_id == user_id),
+                    request.args.get('cursor'))
+    following_ids, _ = follow_state(msg.user_id for msg in page.items)
+    etag = caching.etag_for(
+        'show_likes', user_profile_version(user),
+        [(msg.id, msg.user.username, msg.user.image_url)
+         for msg in page.items],
+        page.next_cursor)
+    return caching.render_conditional(
+        etag, 'messages/likes.html', stream=True,
+        user=user, likes=page.items, next_cursor=page.next_cursor,
+        following_ids=following_ids)
 
 @app.route('/messages/<int:message_id>/like', methods=['POST'])
 @login_required
 def toggle_like(message_id):
-    """Toggle a like on/off"""
-    
-    liked_message = Message.query.get_or_404(message_id)
-    if liked_message.user_id == g.user.id:
-        flash("You cannot like your own post...", "info")
-        return redirect("/")
+    """Toggle a like on/off.
 
-    user_likes = g.user.likes
+    JSON clients get {"liked": ..., "count": ...} back; browsers are
+    redirected to the home page.
+    """
 
-    if liked_message in user_likes:
-        g.user.likes = [like for like in g.user.likes if like != liked_message]
-    else:
-        g.user.likes.append(liked_message)
+    author_id = (db.session.query(Message.user_id)
+                 .filter(Message.id == message_id).scalar())
+    if author_id is None:
+        abort(404)
+    if author_id == g.user.id:
+        flash("You cannot like your own post...", "info")
+        return redirect("/")
 
+    liked, count = Likes.toggle(g.user.id, message_id)
     db.session.commit()
+    invalidate_user_context(g.user.id)
 
+    if wants_json():
+        return jsonify(liked=liked, count=count)
     return redirect('/')
 
 
@@ -332,41 +622,205 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time
     """
 
     if g.user:
-        user = User.query.get_or_404(session[CURR_USER_KEY])
-        following = [user.id for user in user.following]
-        messages = (Message
-                   .query
-                   .filter(or_(Message.user_id.in_(following),
-                           Message.user_id == user.id))
-                   .order_by(Message.timestamp.desc())
-                   .limit(100)
-                   .all())
-        return render_template('home.html', messages=messages)
+        page = timeline.home_timeline(g.user.id, request.args.get('cursor'))
+        return render_template('home.html', messages=page.items,
+                               next_cursor=page.next_cursor)
 
     else:
         return render_template('home-anon.html')
 
+
+@app.route('/timeline/items')
+@login_required
+def timeline_items():
+    """Home timeline items for just the messages in ?ids=, newest first.
+
+    The live updates script fetches new messages' cards with this (see
+    live.py). Ids that aren't from someone the user follows (or the user)
+    are left out.
+
+    These messages were announced moments ago, so they're read from the
+    primary: a replica may not have them yet.
+    """
+
+    replicas.read_from_primary()
+
+    ids = [int(part) for part in request.args.get('ids', '').split(',')
+           if part.isdigit()][:app.config['MESSAGES_PER_PAGE']]
+    authors = g.user_context.following_ids | {g.user.id}
+
+    messages = (Message.with_authors()
+                .filter(Message.id.in_(ids), Message.user_id.in_(authors))
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .all()) if ids else []
+    return render_template('messages/timeline-items.html', messages=messages)
+
 @app.errorhandler(404)
 def not_found(e):
     return render_template('404.html'), 404
 
+
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+# CLI commands
+
+
+@app.cli.command('rebuild-timeline')
+@click.argument('user_id', type=int)
+def rebuild_timeline_command(user_id):
+    """Rebuild one user's precomputed home timeline."""
+
+    User.query.get_or_404(user_id)
+    count = timeline.rebuild_timeline(user_id)
+    click.echo(f"Rebuilt timeline for user #{user_id}: {count} messages")
+
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines_command():
+    """Rebuild everyone's precomputed home timeline, e.g. to turn fan-out on."""
+
+    count = timeline.rebuild_timelines()
+    click.echo(f"Rebuilt timelines for {count} users")
+
+
+@app.cli.command('create-search-index')
+def create_search_index_command():
+    """Add the pg_trgm username index to an existing PostgreSQL database."""
+
+    with db.engine.begin() as connection:
+        if not search.trigram_available(connection):
+            raise click.ClickException("pg_trgm isn't available here; "
+                                       "search will use the in-process index")
+        search.create_trigram_index(connection)
+    click.echo(f"Created {search.TRIGRAM_INDEX_NAME}")
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Fingerprint and precompress static files into static/dist."""
+
+    manifest = assets.build(app.static_folder)
+    click.echo(f"Built {len(manifest)} assets into static/{assets.DIST_DIR}")
+
+
+@app.cli.command('migrate-likes')
+def migrate_likes_command():
+    """Swap the old unique index on likes.message_id for (user_id, message_id)."""
+
+    with db.engine.begin() as connection:
+        connection.execute("ALTER TABLE likes "
+                           "DROP CONSTRAINT IF EXISTS likes_message_id_key")
+        connection.execute("""
+            DO $$ BEGIN
+                ALTER TABLE likes ADD CONSTRAINT uq_likes_user_id_message_id
+                    UNIQUE (user_id, message_id);
+            EXCEPTION WHEN duplicate_table OR duplicate_object THEN NULL;
+            END $$""")
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_likes_message_id "
+                           "ON likes (message_id)")
+    click.echo("Migrated the likes table's unique constraint")
+
+
+@app.cli.command('migrate-counters')
+def migrate_counters_command():
+    """Add the users counter columns to an existing database and fill them."""
+
+    with db.engine.begin() as connection:
+        for column in ('message_count', 'following_count', 'follower_count',
+                       'like_count'):
+            connection.execute(f"ALTER TABLE users ADD COLUMN IF NOT EXISTS "
+                               f"{column} INTEGER NOT NULL DEFAULT 0")
+    count = User.reconcile_counters()
+    db.session.commit()
+    click.echo(f"Added counters and reconciled them for {count} users")
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    """Recompute every user's message/follow/like counts."""
+
+    count = User.reconcile_counters()
+    db.session.commit()
+    click.echo(f"Reconciled counters for {count} users")
+
+
+@app.cli.command('refresh-recommendations')
+@click.option('--full', is_flag=True,
+              help="Redo every user, not just those whose follows changed.")
+def refresh_recommendations_command(full):
+    """Recompute who-to-follow suggestions from the follow graph."""
+
+    count = recommendations.refresh(
+        full=full,
+        progress=lambda done, total: click.echo(f"  {done}/{total} users"))
+    click.echo(f"Refreshed recommendations for {count} users")
+
+
+@app.cli.command('purge-deleted-users')
+def purge_deleted_users_command():
+    """Purge deleted accounts, finishing any purge that was interrupted."""
+
+    count = purge.purge_pending(progress=lambda p: click.echo(
+        f"  #{p.user_id}: {p.messages_deleted} messages, "
+        f"{p.likes_deleted} likes, {p.follows_deleted} follows"))
+    click.echo(f"Purged {count} deleted users")
+
+
+@app.cli.command('migrate-soft-delete')
+def migrate_soft_delete_command():
+    """Add users.deleted_at, the user_purges table and the timelines index."""
+
+    with db.engine.begin() as connection:
+        connection.execute("ALTER TABLE users "
+                           "ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP")
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_timelines_message_id "
+                           "ON timelines (message_id)")
+    db.create_all()
+    click.echo("Migrated users for soft deletes")
+
+
+@app.cli.command('partition-messages')
+def partition_messages_command():
+    """Convert messages into monthly partitions (PostgreSQL; run it offline)."""
+
+    with db.engine.begin() as connection:
+        if connection.dialect.name != 'postgresql':
+            raise click.ClickException("Partitioning needs PostgreSQL")
+        if partitions.is_partitioned(connection):
+            raise click.ClickException("messages is already partitioned")
+        count = partitions.partition_messages(connection)
+    click.echo(f"Partitioned {count} messages by month")
+
+
+@app.cli.command('maintain-message-partitions')
+@click.option('--ahead', type=int, default=None,
+              help="Months to create ahead of this one.")
+@click.option('--keep-months', type=int, default=None,
+              help="Detach months older than this many (0 keeps them all).")
+@click.option('--archive', is_flag=True,
+              help=f"Move detached months into the "
+                   f"{partitions.ARCHIVE_SCHEMA} schema.")
+def maintain_message_partitions_command(ahead, keep_months, archive):
+    """Create upcoming message partitions and detach expired ones."""
+
+    with db.engine.begin() as connection:
+        if not partitions.is_partitioned(connection):
+            raise click.ClickException(
+                "messages isn't partitioned; run flask partition-messages")
+        created, detached = partitions.maintain(connection, ahead,
+                                                keep_months, archive)
+    for name in created:
+        click.echo(f"  created {name}")
+    for name in detached:
+        click.echo(f"  detached {name}")
+    click.echo(f"Created {len(created)} and detached {len(detached)} "
+               "message partitions")
+
+
+##############################################################################
+# HTTP caching; see caching.py
+
+app.after_request(caching.apply_cache_policy)
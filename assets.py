@@ -0,0 +1,191 @@
+"""Fingerprinted, precompressed static assets.
+
+`flask build-assets` copies everything under static/ into static/dist/ with
+a content hash in each file name (style.css -> style.3f2a9c1e04b7.css), so
+the files can be cached forever (see caching.py) and a changed file gets a
+new URL. url("/static/...") references inside stylesheets are rewritten to
+the hashed names too. Text files also get .gz and, if the brotli package is
+installed, .br variants, which are served to clients that accept them.
+
+Templates link to assets with asset_url('stylesheets/style.css'). It looks
+the name up in static/dist/manifest.json and falls back to the plain
+/static/ URL when there's no manifest (or the file isn't in it), so dev
+checkouts work without a build.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+
+from flask import current_app, request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional
+    brotli = None
+
+DIST_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.txt', '.json', '.html',
+                '.map'}
+
+# url("/static/images/nav-bg.png") and friends, in stylesheets
+CSS_URL = re.compile(r'''url\(\s*(['"]?)/static/([^'")]+)\1\s*\)''')
+
+_manifest = None
+_manifest_mtime = None
+_manifest_version = ''
+
+
+##############################################################################
+# Build
+
+
+def _hashed_name(path, content):
+    root, ext = os.path.splitext(path)
+    return f"{root}.{hashlib.sha256(content).hexdigest()[:12]}{ext}"
+
+
+def _source_files(static_folder):
+    """Paths (relative, with /) of everything under static/ but dist/."""
+
+    for dirpath, dirnames, filenames in os.walk(static_folder):
+        if dirpath == static_folder and DIST_DIR in dirnames:
+            dirnames.remove(DIST_DIR)
+        dirnames.sort()
+        for filename in sorted(filenames):
+            full = os.path.join(dirpath, filename)
+            yield os.path.relpath(full, static_folder).replace(os.sep, '/')
+
+
+def _write_compressed(path, content):
+    """Write .gz (and .br, if we can) variants of `content` next to `path`."""
+
+    # mtime=0 keeps the output the same from build to build
+    with open(path + '.gz', 'wb') as out:
+        out.write(gzip.compress(content, compresslevel=9, mtime=0))
+
+    if brotli is not None:
+        with open(path + '.br', 'wb') as out:
+            out.write(brotli.compress(content))
+
+
+def build(static_folder):
+    """Rebuild static_folder/dist and its manifest; returns the manifest."""
+
+    dist = os.path.join(static_folder, DIST_DIR)
+    shutil.rmtree(dist, ignore_errors=True)
+
+    sources = list(_source_files(static_folder))
+    # stylesheets last, so the files they point at already have hashed names
+    sources.sort(key=lambda path: path.endswith('.css'))
+
+    manifest = {}
+    for path in sources:
+        with open(os.path.join(static_folder, path), 'rb') as source:
+            content = source.read()
+
+        if path.endswith('.css'):
+            content = CSS_URL.sub(
+                lambda m: (f"url({m.group(1)}/static/"
+                           f"{manifest.get(m.group(2), m.group(2))}"
+                           f"{m.group(1)})"),
+                content.decode('utf-8')).encode('utf-8')
+
+        hashed = f"{DIST_DIR}/{_hashed_name(path, content)}"
+        target = os.path.join(static_folder, hashed)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as out:
+            out.write(content)
+
+        if os.path.splitext(path)[1].lower() in COMPRESSIBLE:
+            _write_compressed(target, content)
+
+        manifest[path] = hashed
+
+    with open(os.path.join(dist, MANIFEST_NAME), 'w') as out:
+        json.dump(manifest, out, indent=2, sort_keys=True)
+
+    return manifest
+
+
+##############################################################################
+# Runtime
+
+
+def _load_manifest():
+    """The manifest for the app's static folder ({} if there isn't one).
+
+    Reloaded when the file changes, so a rebuild is picked up without a
+    restart.
+    """
+
+    global _manifest, _manifest_mtime, _manifest_version
+
+    path = os.path.join(current_app.static_folder, DIST_DIR, MANIFEST_NAME)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        _manifest, _manifest_mtime, _manifest_version = {}, None, ''
+        return _manifest
+
+    if mtime != _manifest_mtime:
+        with open(path, 'rb') as manifest_file:
+            content = manifest_file.read()
+        _manifest = json.loads(content)
+        _manifest_version = hashlib.sha256(content).hexdigest()[:12]
+        _manifest_mtime = mtime
+
+    return _manifest
+
+
+def version():
+    """A short hash of the current build's manifest ('' with no build).
+
+    Pages that link to fingerprinted assets put this in their ETags, so a
+    deploy with new assets doesn't get them a stale 304.
+    """
+
+    _load_manifest()
+    return _manifest_version
+
+
+def asset_url(filename):
+    """URL for static `filename`, fingerprinted if it's been built."""
+
+    return url_for('static', filename=_load_manifest().get(filename, filename))
+
+
+def serve_static(filename):
+    """The static view, serving .br/.gz variants of built files if accepted."""
+
+    if filename.startswith(f"{DIST_DIR}/"):
+        mimetype = mimetypes.guess_type(filename)[0]
+        for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+            compressed = os.path.join(current_app.static_folder,
+                                      filename + suffix)
+            if (request.accept_encodings.quality(encoding) > 0
+                    and os.path.isfile(compressed)):
+                response = send_from_directory(
+                    current_app.static_folder, filename + suffix,
+                    mimetype=mimetype)
+                response.headers['Content-Encoding'] = encoding
+                response.vary.add('Accept-Encoding')
+                return response
+
+    response = current_app.send_static_file(filename)
+    if filename.startswith(f"{DIST_DIR}/"):
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+def init_app(app):
+    """Add asset_url() to templates and serve precompressed variants."""
+
+    app.add_template_global(asset_url)
+    app.view_functions['static'] = serve_static
@@ -0,0 +1,401 @@
+"""Load-test Warbler's hot routes.
+
+    BENCH_DATABASE_URL=postgresql:///warbler_bench python benchmark.py \\
+        --users 10000 --messages 200000 --follows 500000 --likes 100000 \\
+        --requests 200 --concurrency 8 --output results.json
+
+Seeds a throwaway database (it is dropped and recreated!) with generated data,
+then drives the home page, user list, profiles, likes pages, follow/unfollow
+and like toggles, first through the Flask test client and then through a real
+threaded WSGI server. For each route it reports p50/p95/p99 latency,
+throughput and SQL statements per request, and can write the results as JSON.
+
+Pass --compare to check a run against an earlier results file; the script
+exits non-zero if any route got slower (p95) or chattier (SQL per request) by
+more than --threshold.
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+DEFAULT_THRESHOLD = 0.2
+
+# so the script works from any directory
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# (name, method, path) -- paths are filled in with ids picked per request.
+# Every route sees the same sequence of ids, so "unfollow" undoes "follow"
+# and "unlike" undoes "like".
+SCENARIOS = [
+    ('home', 'GET', '/'),
+    ('users', 'GET', '/users'),
+    ('profile', 'GET', '/users/{user_id}'),
+    ('likes', 'GET', '/messages/{user_id}/likes'),
+    ('follow', 'POST', '/users/follow/{other_id}'),
+    ('unfollow', 'POST', '/users/stop-following/{other_id}'),
+    ('like', 'POST', '/messages/{message_id}/like'),
+    ('unlike', 'POST', '/messages/{message_id}/like'),
+]
+
+
+##############################################################################
+# Dataset
+
+
+def seed_dataset(args):
+    """Generate CSVs for the requested scale and load them, plus likes."""
+
+    from models import db, Likes, Message, User
+    from seed import seed, TABLES
+
+    with tempfile.TemporaryDirectory() as out:
+        subprocess.run([
+            sys.executable, os.path.join(HERE, 'generator', 'create_csvs.py'),
+            '--users', str(args.users), '--messages', str(args.messages),
+            '--follows', str(args.follows), '--seed', str(args.seed),
+            '--power-law', str(args.power_law), '--out', out,
+        ], check=True)
+        seed({name: os.path.join(out, f"{name}.csv")
+              for name, _, _ in TABLES})
+
+    # the generator doesn't make likes, so sprinkle some in
+    rng = random.Random(args.seed)
+    authors = dict(db.session.query(Message.id, Message.user_id))
+    liked = rng.sample(list(authors), min(args.likes, len(authors)))
+    rows = []
+    for message_id in liked:
+        user_id = rng.randint(1, args.users)
+        if authors[message_id] != user_id:
+            rows.append(dict(user_id=user_id, message_id=message_id))
+
+    for start in range(0, len(rows), 10000):
+        db.session.execute(Likes.__table__.insert(), rows[start:start + 10000])
+    User.reconcile_counters()
+    db.session.commit()
+    print(f"likes: {len(rows):,} rows", file=sys.stderr)
+
+
+##############################################################################
+# Measuring
+
+
+class SQLCounter:
+    """Counts SQL statements run on the app's engine."""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self.count = 0
+        self.lock = threading.Lock()
+        event.listen(engine, 'before_cursor_execute', self._record)
+
+    def _record(self, *args):
+        with self.lock:
+            self.count += 1
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of `values` (which must be sorted)."""
+
+    if not values:
+        return None
+    rank = max(math.ceil(pct * len(values) / 100) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def summarize(latencies, elapsed, statements, errors):
+    """Latency percentiles (ms), throughput and SQL/request for one route."""
+
+    latencies = sorted(latencies)
+    n = len(latencies)
+
+    def ms(seconds):
+        return round(seconds * 1000, 3) if seconds is not None else None
+
+    return dict(
+        requests=n,
+        errors=errors,
+        p50_ms=ms(percentile(latencies, 50)),
+        p95_ms=ms(percentile(latencies, 95)),
+        p99_ms=ms(percentile(latencies, 99)),
+        mean_ms=ms(sum(latencies) / n if n else None),
+        throughput_rps=round(n / elapsed, 2) if elapsed else None,
+        sql_per_request=round(statements / n, 2) if n else None,
+    )
+
+
+class Picker:
+    """Chooses the ids each request uses, repeatably."""
+
+    def __init__(self, seed, max_user_id, max_message_id):
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.max_user_id = max_user_id
+        self.max_message_id = max_message_id
+
+    def ids(self):
+        with self.lock:
+            user_id = self.rng.randint(1, self.max_user_id)
+            other_id = self.rng.randint(1, self.max_user_id)
+            message_id = self.rng.randint(1, self.max_message_id)
+        return dict(user_id=user_id, other_id=other_id, message_id=message_id)
+
+
+##############################################################################
+# Drivers
+
+
+def run_test_client(app, counter, args, max_ids):
+    """Drive every scenario through the Flask test client, one at a time."""
+
+    from app import CURR_USER_KEY
+
+    results = {}
+    for name, method, path in SCENARIOS:
+        picker = Picker(args.seed, *max_ids)
+        latencies, errors = [], 0
+        before = counter.count
+        started = time.perf_counter()
+
+        for _ in range(args.requests):
+            ids = picker.ids()
+            client = app.test_client()
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = ids['user_id']
+
+            start = time.perf_counter()
+            resp = client.open(path.format(**ids), method=method)
+            # a streamed page only renders (and queries) as it's read
+            resp.get_data()
+            resp.close()
+            latencies.append(time.perf_counter() - start)
+            errors += resp.status_code >= 500
+
+        results[name] = summarize(latencies, time.perf_counter() - started,
+                                  counter.count - before, errors)
+        print_row('test-client', name, results[name])
+
+    return results
+
+
+def run_server(app, counter, args, max_ids):
+    """Drive every scenario through a real threaded WSGI server."""
+
+    from werkzeug.serving import make_server
+    from app import CURR_USER_KEY
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    port = server.server_port
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    signer = app.session_interface.get_signing_serializer(app)
+    cookie_name = app.config.get('SESSION_COOKIE_NAME', 'session')
+
+    results = {}
+    try:
+        for name, method, path in SCENARIOS:
+            picker = Picker(args.seed, *max_ids)
+            latencies, errors = [], [0]
+            lock = threading.Lock()
+            remaining = [args.requests]
+
+            def worker():
+                conn = http.client.HTTPConnection('127.0.0.1', port)
+                while True:
+                    with lock:
+                        if remaining[0] <= 0:
+                            break
+                        remaining[0] -= 1
+                    ids = picker.ids()
+                    cookie = signer.dumps({CURR_USER_KEY: ids['user_id']})
+                    start = time.perf_counter()
+                    try:
+                        conn.request(method, path.format(**ids), headers={
+                            'Cookie': f"{cookie_name}={cookie}"})
+                        resp = conn.getresponse()
+                        resp.read()
+                        failed = resp.status >= 500
+                    except (OSError, http.client.HTTPException):
+                        conn.close()
+                        conn = http.client.HTTPConnection('127.0.0.1', port)
+                        failed = True
+                    elapsed = time.perf_counter() - start
+                    with lock:
+                        latencies.append(elapsed)
+                        errors[0] += failed
+                conn.close()
+
+            before = counter.count
+            started = time.perf_counter()
+            threads = [threading.Thread(target=worker)
+                       for _ in range(args.concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            results[name] = summarize(latencies, time.perf_counter() - started,
+                                      counter.count - before, errors[0])
+            print_row('server', name, results[name])
+    finally:
+        server.shutdown()
+
+    return results
+
+
+##############################################################################
+# Reporting
+
+
+def _number(value, width, places):
+    # a route with no successful requests has None for its stats
+    if value is None:
+        return f"{'-':>{width}}"
+    return f"{value:>{width}.{places}f}"
+
+
+def print_row(mode, name, result):
+    print(f"{mode:12} {name:10} "
+          f"p50 {_number(result['p50_ms'], 9, 2)}ms  "
+          f"p95 {_number(result['p95_ms'], 9, 2)}ms  "
+          f"p99 {_number(result['p99_ms'], 9, 2)}ms  "
+          f"{_number(result['throughput_rps'], 9, 1)} req/s  "
+          f"{_number(result['sql_per_request'], 6, 1)} sql/req"
+          + (f"  {result['errors']} errors" if result['errors'] else ""))
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True, cwd=HERE,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """Routes whose p95 or SQL/request grew by more than `threshold`.
+
+    A metric either run has no number for (no successful requests) is
+    skipped.
+    """
+
+    regressions = []
+    for mode, routes in results['results'].items():
+        for name, result in routes.items():
+            old = baseline.get('results', {}).get(mode, {}).get(name)
+            if not old:
+                continue
+            for metric in ('p95_ms', 'sql_per_request'):
+                before, after = old.get(metric), result.get(metric)
+                if not before or after is None:
+                    continue
+                if after > before * (1 + threshold):
+                    regressions.append(
+                        f"{mode} {name}: {metric} {before} -> {after}")
+    return regressions
+
+
+##############################################################################
+# Script
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Load-test Warbler's hot routes.")
+    parser.add_argument('--database-url',
+                        default=os.environ.get('BENCH_DATABASE_URL'),
+                        help="database to seed and test against (it is "
+                             "wiped!); defaults to $BENCH_DATABASE_URL")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=50000)
+    parser.add_argument('--likes', type=int, default=20000)
+    parser.add_argument('--power-law', type=float, default=1.2)
+    parser.add_argument('--seed', default='warbler-bench')
+    parser.add_argument('--skip-seed', action='store_true',
+                        help="reuse the data already in the database")
+    parser.add_argument('--requests', type=int, default=100,
+                        help="requests per route and mode")
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="client threads against the WSGI server")
+    parser.add_argument('--mode', choices=['test-client', 'server', 'both'],
+                        default='both')
+    parser.add_argument('--output', help="write results as JSON here")
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help="results JSON from an earlier run to compare to")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed slowdown before --compare fails "
+                             "(default 0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    if not args.database_url:
+        parser.error("set --database-url or BENCH_DATABASE_URL "
+                     "(the database will be wiped)")
+
+    # like the tests: point the app at our database before importing it
+    os.environ['DATABASE_URL'] = args.database_url
+
+    from app import app
+    from models import db, Message, User
+
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    if not args.skip_seed:
+        seed_dataset(args)
+
+    max_user_id = db.session.query(db.func.max(User.id)).scalar()
+    max_message_id = db.session.query(db.func.max(Message.id)).scalar()
+    db.session.remove()
+    if not max_user_id or not max_message_id:
+        sys.exit("No users or messages to benchmark with")
+
+    counter = SQLCounter(db.engine)
+    results = dict(
+        meta=dict(
+            timestamp=datetime.utcnow().isoformat(),
+            commit=git_commit(),
+            database=db.engine.dialect.name,
+            users=max_user_id,
+            messages=max_message_id,
+            requests=args.requests,
+            concurrency=args.concurrency,
+        ),
+        results={},
+    )
+
+    max_ids = (max_user_id, max_message_id)
+    if args.mode in ('test-client', 'both'):
+        results['results']['test-client'] = run_test_client(
+            app, counter, args, max_ids)
+    if args.mode in ('server', 'both'):
+        results['results']['server'] = run_server(app, counter, args, max_ids)
+
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file),
+                                  args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""HTTP caching policy.
+
+- Static files: fingerprinted ones (built into static/dist, or with a content
+  hash in the name) are cached for a year as immutable; the rest for
+  STATIC_MAX_AGE seconds. Flask already answers conditional requests for
+  them.
+- Profile, message and likes pages get an ETag (and, where there's a
+  sensible one, Last-Modified) built from the data they show plus, when
+  logged in, the viewer's version (see UserContext.version). A matching
+  If-None-Match gets a 304 before the template is rendered. The ETag also
+  covers the asset build (see assets.version()), so a deploy with new
+  assets invalidates it. Last-Modified (the newest message shown) is
+  informational: these pages also change when a profile or the viewer's
+  likes do, so If-Modified-Since alone can't be trusted and is ignored.
+- A page with flashed messages waiting gets neither an ETag nor a 304: the
+  flashes are only shown, and used up, when it renders.
+- Other dynamic responses must be revalidated (no-cache). Anything rendered
+  for a logged-in user, or with anything in their session (e.g. a flash), is
+  private so shared caches won't keep it; the rest is public.
+"""
+
+import hashlib
+import re
+
+from flask import (current_app, g, make_response, render_template, request,
+                   session, stream_with_context)
+
+import assets
+
+DEFAULT_STATIC_MAX_AGE = 60 * 60
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# template events gathered into each chunk of a streamed page
+STREAM_BUFFER_SIZE = 20
+
+# e.g. style.3f2a9c1e.css
+FINGERPRINTED = re.compile(r'\.[0-9a-f]{8,}\.\w+$')
+
+
+def etag_for(*parts):
+    """An ETag for a page showing `parts`, as seen by the current viewer."""
+
+    viewer = None
+    if g.get('user_context'):
+        user = g.user_context.user
+        viewer = (user.id, user.username, user.image_url, g.user_context.version)
+
+    return hashlib.sha1(
+        repr((parts, viewer, assets.version())).encode()).hexdigest()
+
+
+def stream_template(template_name, **context):
+    """Render a template bit by bit, as the response is sent.
+
+    Output is sent in chunks of STREAM_BUFFER_SIZE template events, not
+    each little piece as it's produced.
+    """
+
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    stream = template.stream(context)
+    stream.enable_buffering(STREAM_BUFFER_SIZE)
+    return stream_with_context(stream)
+
+
+def render_conditional(etag, template, last_modified=None, stream=False,
+                       **context):
+    """Render `template`, or a 304 if the client already has `etag`.
+
+    With `stream`, the page is sent as it renders, so the first bytes go
+    out before the whole page is built.
+    """
+
+    flashes = session.get('_flashes')
+
+    if not flashes and request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    elif stream:
+        response = current_app.response_class(
+            stream_template(template, **context))
+    else:
+        response = make_response(render_template(template, **context))
+
+    if not flashes:
+        response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+def apply_cache_policy(response):
+    """Set Cache-Control for static files and dynamic responses.
+
+    Responses that already have one are left alone.
+    """
+
+    if request.endpoint == 'static':
+        filename = request.view_args.get('filename', '')
+        if filename.startswith('dist/') or FINGERPRINTED.search(filename):
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.max_age = current_app.config.get(
+                'STATIC_MAX_AGE', DEFAULT_STATIC_MAX_AGE)
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        return response
+
+    if 'Cache-Control' in response.headers:
+        return response
+
+    if request.method not in ('GET', 'HEAD'):
+        response.cache_control.no_store = True
+        return response
+
+    response.cache_control.no_cache = True
+    if g.get('user') or session:
+        response.cache_control.private = True
+        response.vary.add('Cookie')
+    else:
+        response.cache_control.public = True
+    return response
@@ -0,0 +1,177 @@
+"""Cache of rendered message and user cards.
+
+A message card's HTML only depends on the message (which can't be edited)
+and on its author's username and avatar; a user card's only on that user's
+profile. So we render each card once and reuse it until those change. The
+per-viewer parts, like buttons and follow buttons, stay live in the page
+templates around the cached HTML.
+
+Entries are kept under the message or user id along with the "version" they
+were rendered from (the author/profile fields the card shows). A lookup
+whose version doesn't match is a miss, so a stale card is never served, even
+from a process that didn't see the edit. profile() and message deletion also
+drop entries explicitly, to free the space.
+
+There are two tiers: an in-process LRU (FRAGMENT_CACHE_MAX_ENTRIES), and,
+if FRAGMENT_CACHE_BACKEND is set, a shared backend behind it (anything with
+get/set/delete, e.g. a thin memcached or Redis wrapper). LocalBackend is a
+stand-in for one, for tests and single-process setups.
+"""
+
+import threading
+from collections import OrderedDict
+
+from flask import current_app, render_template
+from markupsafe import Markup
+
+DEFAULT_MAX_ENTRIES = 20000
+
+# where a user card's live parts (badge, follow button) go
+LIVE_MARKER = '<!-- live -->'
+
+
+class LocalBackend:
+    """In-memory stand-in for a shared cache backend."""
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self.data.get(key)
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+
+_lru = OrderedDict()
+_lock = threading.Lock()
+
+
+def _enabled():
+    return current_app.config.get('FRAGMENT_CACHE_ENABLED', True)
+
+
+def _backend():
+    return current_app.config.get('FRAGMENT_CACHE_BACKEND')
+
+
+def _get(key, version):
+    with _lock:
+        entry = _lru.get(key)
+        if entry is not None:
+            _lru.move_to_end(key)
+
+    if entry is None and _backend() is not None:
+        entry = _backend().get(key)
+        if entry is not None:
+            _put_local(key, entry)
+
+    if entry is None or entry[0] != version:
+        return None
+    return entry[1]
+
+
+def _put_local(key, entry):
+    max_entries = current_app.config.get('FRAGMENT_CACHE_MAX_ENTRIES',
+                                         DEFAULT_MAX_ENTRIES)
+    with _lock:
+        _lru[key] = entry
+        _lru.move_to_end(key)
+        while len(_lru) > max_entries:
+            _lru.popitem(last=False)
+
+
+def _set(key, version, html):
+    entry = (version, html)
+    _put_local(key, entry)
+    if _backend() is not None:
+        _backend().set(key, entry)
+
+
+def _delete(key):
+    with _lock:
+        _lru.pop(key, None)
+    if _backend() is not None:
+        _backend().delete(key)
+
+
+def _cached(key, version, template, **context):
+    """The HTML for `template`, from the cache if `version` matches."""
+
+    if not _enabled():
+        return render_template(template, **context)
+
+    html = _get(key, version)
+    if html is None:
+        html = render_template(template, **context)
+        _set(key, version, html)
+    return html
+
+
+##############################################################################
+# Public API
+
+
+def message_card(message, author):
+    """The cached parts of a message card, as Markup.
+
+    `author` is passed in, rather than read off `message.user`, so pages that
+    already have it (a profile) don't lazy-load it per message.
+    """
+
+    # the timestamp guards against ids reused after a reseed
+    return Markup(_cached(
+        f"message:{message.id}",
+        (message.timestamp, author.username, author.image_url),
+        'fragments/message.html', message=message, author=author))
+
+
+def user_card(user):
+    """The cached parts of a user card, as (head, tail) Markup.
+
+    The page puts the live parts (badge, follow button) between the two.
+    """
+
+    html = _cached(
+        f"user:{user.id}",
+        (user.username, user.image_url, user.header_image_url, user.bio),
+        'fragments/user.html', user=user)
+    head, tail = html.split(LIVE_MARKER)
+    return Markup(head), Markup(tail)
+
+
+def invalidate_user(user_id):
+    """Drop `user_id`'s cached user card.
+
+    Their message cards are left alone: they carry the old username and
+    avatar as their version, so they just miss from now on.
+    """
+
+    _delete(f"user:{user_id}")
+
+
+def invalidate_message(message_id):
+    """Drop `message_id`'s cached card."""
+
+    _delete(f"message:{message_id}")
+
+
+def clear_fragment_cache():
+    """Forget every entry in this process's LRU."""
+
+    with _lock:
+        _lru.clear()
+
+
+def init_app(app):
+    """Make message_card() and user_card() available to templates."""
+
+    app.add_template_global(message_card)
+    app.add_template_global(user_card)
@@ -2,15 +2,29 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. for load testing:
+
+    python generator/create_csvs.py --users 1000000 --messages 50000000 \\
+        --follows 100000000 --power-law 1.2 --workers 8
+
+Rows are streamed to disk as they're made, so memory use doesn't grow with
+the dataset. Output depends only on the options (--seed, --end, the counts),
+not on --workers: every table is cut into fixed-size shards, each generated
+from its own seeded RNG, possibly in a separate process, and then stitched
+together in order. Nothing is fetched over the network.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+import os
+import random
+import shutil
+import sys
+import time
+from datetime import datetime
+from multiprocessing import Pool
+
+from helpers import get_random_datetime, make_sentence, UserSampler
 
 MAX_WARBLER_LENGTH = 140
 
@@ -22,7 +36,71 @@ NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
 
-fake = Faker()
+# rows (users, messages) or followers (follows) per shard
+SHARD_SIZE = 50000
+
+# every seeded user's password is "password"
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+WORDS = """
+    able about above across act add again age agent air all almost alone
+    along already also always among amount and animal answer any appear
+    area arm around art ask attack away baby back bad bag ball bank bar base
+    beat beautiful bed behind believe best better beyond big bill bird black
+    blood blue board boat body book born both box boy break bring brother
+    build building business buy call camera campaign can car card care carry
+    case cat catch cause cell center central century chair chance change
+    charge check child choice city claim class clear close coach cold color
+    come common community company cost country couple course court cover
+    create crime cultural cup current cut dark data daughter day dead deal
+    decade decide deep defense degree design detail develop die different
+    dinner direction discover doctor dog door down draw dream drive drop
+    early east easy eat economy edge effect eight either else end energy
+    enjoy enough enter entire environment especially evening event every
+    exactly example expert eye face fact fall family far fast father fear
+    feel field fight figure fill film final find fine finger finish fire
+    firm first fish five floor fly focus follow food foot force forest
+    forget form forward four free friend front full fund future game garden
+    gas general generation girl give glass goal good great green ground
+    group grow guess gun hair half hand hang happen happy hard have head
+    hear heart heat heavy help here high history hit hold home hope hot
+    hotel hour house huge human hundred idea image imagine indeed inside
+    interest island issue item job join just keep key kid kind kitchen know
+    land language large last late laugh law lay lead learn leave left leg
+    letter level life light like line list listen little live local long
+    look lose lot love low machine magazine main major make man many market
+    matter maybe meet member memory message method middle might military
+    million mind minute miss model modern moment money month more morning
+    mother mountain move movie music nation nature near need network never
+    new news next nice night north note nothing notice number ocean offer
+    office often old once open option order other outside own page paint
+    paper parent part party pass past pattern pay peace people perhaps
+    person phone picture piece place plan plant play point police poor
+    popular power pretty price program pull push quality question quick
+    quite radio rain range rather reach read ready real reason record red
+    remember report rest rich right rise river road rock role room rule run
+    safe save say scene school science sea season seat second see seek sell
+    send sense serve set seven shake share short shot show side sign simple
+    sing sister sit six size skill skin small smile social soft soldier
+    song soon sound south space speak special sport spring stage stand star
+    start state stay step still stock stop store story street strong study
+    style success summer sun support sure table take talk task teach team
+    tell ten term test thank theory thing think third thousand three through
+    throw time today together tonight top total tough town trade travel tree
+    trial trip true truth try turn two type under unit until up use usually
+    value very view visit voice wait walk wall want war watch water wave way
+    wear weather week weight west what whole wide wife win wind window wish
+    woman wonder word work world worry write year yes yet young
+""".split()
+
+DOMAINS = ['gmail.com', 'yahoo.com', 'hotmail.com', 'example.com',
+           'example.org', 'example.net']
+
+CITIES = """
+    Springfield Riverside Franklin Greenville Bristol Clinton Fairview Salem
+    Madison Georgetown Arlington Ashland Burlington Manchester Milton Oxford
+    Newport Clayton Dayton Lexington Milford Winchester Auburn Jackson
+""".split()
 
 # Generate random profile image URLs to use for users
 
@@ -32,46 +110,193 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+# Header image URLs to use for users (a fixed set, so we can run offline)
 
 header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+    f"https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_{key}_1280.jpg"
+    for key in [
+        "mnh0n9pHJW1st5lhmo1", "mnh0uemhCk1st5lhmo1", "mnh121HEWa1st5lhmo1",
+        "mnh17lfd9R1st5lhmo1", "mnh1d7s3UD1st5lhmo1", "mnh1jdFvHR1st5lhmo1",
+        "mnh1uhYnog1st5lhmo1", "mnh25vNOvI1st5lhmo1", "mnh29fxz111st5lhmo1",
+        "mnh2m1hnS81st5lhmo1", "mo1h6tGOZf1st5lhmo1", "mo2wz2LTCs1st5lhmo1",
+    ]
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+
+##############################################################################
+# Row generators (one shard each)
+
+
+def user_rows(rng, start, stop, opts):
+    """Users start..stop-1 (1-based ids, in the order the DB will assign)."""
+
+    for i in range(start, stop):
+        username = f"{rng.choice(WORDS)}{rng.choice(WORDS)}{i}"
+        yield [
+            f"{username}@{rng.choice(DOMAINS)}",
+            username,
+            rng.choice(image_urls),
+            PASSWORD,
+            make_sentence(rng, WORDS, MAX_WARBLER_LENGTH),
+            rng.choice(header_image_urls),
+            rng.choice(CITIES),
+        ]
+
+
+def message_rows(rng, start, stop, opts):
+    """Messages start..stop-1, posted by (optionally power-law) random users."""
+
+    pick_author = UserSampler(opts['users'], opts['power_law'])
+
+    for _ in range(start, stop):
+        yield [
+            make_sentence(rng, WORDS, MAX_WARBLER_LENGTH),
+            get_random_datetime(rng=rng, now=opts['end']),
+            pick_author(rng),
+        ]
+
+
+def follow_rows(rng, start, stop, opts):
+    """Follows made by followers start..stop-1.
+
+    Each follower gets an even share of the total follow count and picks
+    that many distinct users to follow, without ever listing all the pairs.
+    """
+
+    num_users = opts['users']
+    base, extra = divmod(opts['follows'], num_users)
+    pick_followed = UserSampler(num_users, opts['power_law'])
+
+    for follower in range(start, stop):
+        count = min(base + (follower <= extra), num_users - 1)
+
+        if count > num_users // 2:
+            # dense: cheaper to sample directly than to reject repeats
+            followed = rng.sample(range(1, num_users + 1), count + 1)
+            followed = [user for user in followed if user != follower][:count]
+
+        else:
+            followed = set()
+            attempts = 0
+            while len(followed) < count:
+                # a very skewed sampler keeps picking the same few users,
+                # so fall back to uniform picks after a while
+                if attempts < count * 20:
+                    user = pick_followed(rng)
+                else:
+                    user = rng.randint(1, num_users)
+                attempts += 1
+                if user != follower:
+                    followed.add(user)
+            followed = sorted(followed)
+
+        for user in followed:
+            yield [user, follower]
+
+
+TABLES = {
+    'users': (USERS_CSV_HEADERS, user_rows),
+    'messages': (MESSAGES_CSV_HEADERS, message_rows),
+    'follows': (FOLLOWS_CSV_HEADERS, follow_rows),
+}
+
+
+##############################################################################
+# Sharding and output
+
+
+def write_shard(task):
+    """Generate one shard into its own part file; returns (path, rows)."""
+
+    table, shard, start, stop, opts = task
+    _, make_rows = TABLES[table]
+
+    rng = random.Random(f"{opts['seed']}:{table}:{shard}")
+    path = os.path.join(opts['out'], f"{table}.csv.part{shard:05d}")
+
+    rows = 0
+    with open(path, 'w', newline='') as part:
+        writer = csv.writer(part)
+        for row in make_rows(rng, start, stop, opts):
+            writer.writerow(row)
+            rows += 1
+
+    return path, rows
+
+
+def shards(table, opts):
+    """Tasks covering all of `table`, SHARD_SIZE rows (or followers) each."""
+
+    # users and follows are numbered from 1 (user ids); messages from 0
+    first = 0 if table == 'messages' else 1
+    total = opts['messages'] if table == 'messages' else opts['users']
+
+    return [(table, shard, start, min(start + SHARD_SIZE, first + total), opts)
+            for shard, start in enumerate(range(first, first + total,
+                                                SHARD_SIZE))]
+
+
+def generate(table, opts, pool=None):
+    """Write `table`'s CSV, generating its shards in `pool` if given."""
+
+    headers, _ = TABLES[table]
+    path = os.path.join(opts['out'], f"{table}.csv")
+    start = time.monotonic()
+    rows = 0
+
+    tasks = shards(table, opts)
+    results = pool.imap(write_shard, tasks) if pool else map(write_shard, tasks)
+
+    with open(path, 'w', newline='') as out:
+        csv.writer(out).writerow(headers)
+        for part_path, part_rows in results:
+            with open(part_path, newline='') as part:
+                shutil.copyfileobj(part, out)
+            os.remove(part_path)
+            rows += part_rows
+
+    elapsed = time.monotonic() - start
+    print(f"{path}: {rows:,} rows in {elapsed:.1f}s "
+          f"({rows / max(elapsed, 1e-9):,.0f} rows/sec)", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate CSVs of random data for Warbler.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS)
+    parser.add_argument('--seed', default='warbler',
+                        help="random seed (same seed, same data)")
+    parser.add_argument('--end', type=datetime.fromisoformat,
+                        default=datetime.utcnow().replace(hour=0, minute=0,
+                                                          second=0,
+                                                          microsecond=0),
+                        help="latest message time (UTC), YYYY-MM-DD "
+                             "(default: today)")
+    parser.add_argument('--power-law', type=float, default=0.0,
+                        metavar='ALPHA',
+                        help="skew followers and posting toward a few users "
+                             "(e.g. 1.2; default 0 = uniform)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="processes to generate shards in")
+    parser.add_argument('--out', default='generator',
+                        help="directory to write the CSVs to")
+    args = parser.parse_args(argv)
+
+    opts = dict(users=args.users, messages=args.messages,
+                follows=min(args.follows, args.users * (args.users - 1)),
+                seed=args.seed, end=args.end, power_law=args.power_law,
+                out=args.out)
+
+    if args.workers > 1:
+        with Pool(args.workers) as pool:
+            for table in TABLES:
+                generate(table, opts, pool)
+    else:
+        for table in TABLES:
+            generate(table, opts)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,67 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+import random
+from datetime import datetime, timedelta
+from math import floor, gcd
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def get_random_datetime(year_gap=2, rng=random, now=None):
+    """Get a random (naive, UTC) datetime within `year_gap` years before `now`.
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    Pass a seeded `rng` and a fixed `now` for repeatable output; it's plain
+    datetime arithmetic, so the machine's timezone doesn't come into it.
+    """
 
-    return datetime.fromtimestamp(random_timestamp)
+    now = now or datetime.utcnow()
+    span = timedelta(days=365 * year_gap)
+
+    return now - span + timedelta(
+        seconds=rng.uniform(0, span.total_seconds()))
+
+
+def make_sentence(rng, words, max_length):
+    """A capitalized run of random `words`, cut to at most `max_length`."""
+
+    sentence = ' '.join(rng.choice(words) for _ in range(rng.randint(4, 16)))
+    return (sentence[:max_length - 1].rstrip() + '.').capitalize()
+
+
+class UserSampler:
+    """Picks user ids in 1..num_users, uniformly or with a power-law skew.
+
+    With `alpha` > 0, ids are drawn from a bounded Pareto distribution, so a
+    few users get most of the picks (the way followers pile onto a few
+    accounts). Popularity ranks are spread over the id space with a
+    multiplicative shuffle, so the popular users aren't just the first ids.
+    Uses O(1) memory whatever the number of users.
+    """
+
+    def __init__(self, num_users, alpha=0.0):
+        self.num_users = num_users
+        self.alpha = alpha
+        self.stride = _coprime_stride(num_users)
+
+    def __call__(self, rng):
+        if self.alpha <= 0:
+            return rng.randint(1, self.num_users)
+
+        # inverse CDF of x^-alpha on [1, num_users + 1)
+        n = self.num_users + 1
+        u = rng.random()
+        if self.alpha == 1:
+            rank = n ** u
+        else:
+            a = 1 - self.alpha
+            rank = (1 + u * (n ** a - 1)) ** (1 / a)
+        rank = min(floor(rank), self.num_users) - 1
+
+        return (rank * self.stride) % self.num_users + 1
+
+
+def _coprime_stride(n):
+    """A stride coprime to `n`, for shuffling 0..n-1 by multiplication."""
+
+    stride = max(int(n * 0.6180339887), 1)
+    while gcd(stride, n) != 1:
+        stride += 1
+    return stride
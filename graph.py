@@ -0,0 +1,244 @@
+"""In-process index of who follows whom.
+
+Keeps each user's following and followers lists as sorted arrays of ids
+(8 bytes an edge), loaded from `follows` one list at a time with an
+index-only query, the first time they're asked for. Asking whether A follows
+B, for a page of someone's followers, or for their mutual follows is then a
+slice or a binary search, not a query.
+
+The follow/unfollow routes patch the lists they change. Changes
+made elsewhere (another process, a script) show up once an entry is older
+than GRAPH_INDEX_TTL seconds and gets reloaded; 0 turns the cache off.
+
+Memory is bounded: the lists live in an LRU capped at GRAPH_INDEX_MAX_BYTES,
+and stats() (served at /metrics) reports what they take up.
+"""
+
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+from flask import current_app
+
+from models import db, Follows, UserPurge
+
+DEFAULT_TTL = 60
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+FOLLOWING = 'following'
+FOLLOWERS = 'followers'
+
+_COLUMNS = {
+    # kind: (the user's column, the other user's column)
+    FOLLOWING: (Follows.user_following_id, Follows.user_being_followed_id),
+    FOLLOWERS: (Follows.user_being_followed_id, Follows.user_following_id),
+}
+
+
+class GraphIndex:
+    """An LRU of sorted id arrays, keyed by (kind, user id)."""
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        # key: [generation, loaders] for lists being loaded; a change to one
+        # meanwhile bumps its generation, and the load isn't cached
+        self.loading = {}
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _config(self):
+        config = current_app.config
+        return (config.get('GRAPH_INDEX_TTL', DEFAULT_TTL),
+                config.get('GRAPH_INDEX_MAX_BYTES', DEFAULT_MAX_BYTES))
+
+    def _get(self, kind, user_id):
+        key = (kind, user_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] >= time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            loading = self.loading.setdefault(key, [0, 0])
+            loading[1] += 1
+            generation = loading[0]
+
+        # accounts being purged still have follows rows; leave them out
+        mine, theirs = _COLUMNS[kind]
+        purging = (db.session.query(UserPurge.user_id)
+                   .filter(UserPurge.finished_at.is_(None)))
+        try:
+            ids = array('q', (other_id for (other_id,) in (
+                db.session.query(theirs)
+                .filter(mine == user_id, theirs.notin_(purging.subquery()))
+                .order_by(theirs))))
+        except Exception:
+            self._put(key, None, generation)
+            raise
+        self._put(key, ids, generation)
+        return ids
+
+    def _put(self, key, ids, generation):
+        # skips caching `ids` if the list changed while it was being loaded
+        ttl, max_bytes = self._config()
+        size = sys.getsizeof(ids)
+
+        with self.lock:
+            loading = self.loading[key]
+            loading[1] -= 1
+            if not loading[1]:
+                del self.loading[key]
+            if ids is None or loading[0] != generation:
+                return
+
+            self._drop(key)
+            if ttl <= 0 or size > max_bytes:
+                return
+            while self.bytes + size > max_bytes:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+            self.entries[key] = (time.monotonic() + ttl, ids, size)
+            self.bytes += size
+
+    def _drop(self, key):
+        # call with the lock held
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def _update(self, key, other_id, add):
+        with self.lock:
+            self._patch(key, other_id, add)
+
+    def _patch(self, key, other_id, add):
+        # call with the lock held; copy-on-write, so readers holding the old
+        # array aren't disturbed
+        if key in self.loading:
+            self.loading[key][0] += 1
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        expires_at, ids, size = entry
+        i = bisect_left(ids, other_id)
+        present = i < len(ids) and ids[i] == other_id
+        if add == present:
+            return
+        if add:
+            ids = ids[:i] + array('q', [other_id]) + ids[i:]
+        else:
+            ids = ids[:i] + ids[i + 1:]
+        new_size = sys.getsizeof(ids)
+        self.entries[key] = (expires_at, ids, new_size)
+        self.bytes += new_size - size
+
+    # Reads
+
+    def following(self, user_id):
+        """Sorted ids of the users `user_id` follows."""
+
+        return self._get(FOLLOWING, user_id)
+
+    def followers(self, user_id):
+        """Sorted ids of the users following `user_id`."""
+
+        return self._get(FOLLOWERS, user_id)
+
+    def is_following(self, user_id, other_id):
+        """Does `user_id` follow `other_id`?"""
+
+        return _contains(self.following(user_id), other_id)
+
+    def following_among(self, user_id, candidate_ids):
+        """Which of `candidate_ids` does `user_id` follow?"""
+
+        ids = self.following(user_id)
+        return {other_id for other_id in candidate_ids
+                if _contains(ids, other_id)}
+
+    def followers_among(self, user_id, candidate_ids):
+        """Which of `candidate_ids` follow `user_id`?"""
+
+        ids = self.followers(user_id)
+        return {other_id for other_id in candidate_ids
+                if _contains(ids, other_id)}
+
+    def mutuals(self, user_id):
+        """Sorted ids of the users `user_id` follows who follow them back."""
+
+        following, followers = self.following(user_id), self.followers(user_id)
+        if len(followers) < len(following):
+            following, followers = followers, following
+        return array('q', (other_id for other_id in following
+                           if _contains(followers, other_id)))
+
+    # Writes
+
+    def add(self, follower_id, followed_id):
+        """Record that `follower_id` now follows `followed_id`."""
+
+        self._update((FOLLOWING, follower_id), followed_id, True)
+        self._update((FOLLOWERS, followed_id), follower_id, True)
+
+    def remove(self, follower_id, followed_id):
+        """Record that `follower_id` no longer follows `followed_id`."""
+
+        self._update((FOLLOWING, follower_id), followed_id, False)
+        self._update((FOLLOWERS, followed_id), follower_id, False)
+
+    def forget(self, user_id):
+        """Drop `user_id` from the index (e.g. when they're deleted).
+
+        Their own lists go, and they're taken out of everyone else's.
+        """
+
+        with self.lock:
+            self._drop((FOLLOWING, user_id))
+            self._drop((FOLLOWERS, user_id))
+            # any list being loaded may have them in it
+            for loading in self.loading.values():
+                loading[0] += 1
+            for key in [key for key, entry in self.entries.items()
+                        if _contains(entry[1], user_id)]:
+                self._patch(key, user_id, False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """Size and hit rate, for /metrics."""
+
+        _, max_bytes = self._config()
+        with self.lock:
+            return dict(
+                entries=len(self.entries),
+                edges=sum(len(entry[1]) for entry in self.entries.values()),
+                bytes=self.bytes,
+                max_bytes=max_bytes,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+            )
+
+
+def _contains(ids, other_id):
+    i = bisect_left(ids, other_id)
+    return i < len(ids) and ids[i] == other_id
+
+
+def page(ids, number, per_page):
+    """Page `number` (from 1) of `ids`, and whether there's another."""
+
+    start = (max(number, 1) - 1) * per_page
+    return ids[start:start + per_page], len(ids) > start + per_page
+
+
+index = GraphIndex()
@@ -0,0 +1,231 @@
+"""Password hashing off the request thread.
+
+bcrypt is deliberately slow, and it holds the GIL while it works, so hashing
+inline ties up a web worker for the whole hash. Instead we hand hashes and
+checks to a small process pool. The pool's queue is bounded: once
+PASSWORD_HASH_MAX_PENDING jobs are waiting, new ones fail fast with
+HashingOverloaded rather than piling up behind a burst of logins. A job that
+takes longer than PASSWORD_HASH_TIMEOUT seconds, or a pool whose workers
+died, raises HashingOverloaded too (a broken pool is replaced).
+
+Set PASSWORD_HASH_WORKERS to 0 to hash inline (e.g. in scripts).
+"""
+
+import multiprocessing
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+from flask import current_app, has_app_context
+
+DEFAULT_ROUNDS = 12
+DEFAULT_WORKERS = 2
+DEFAULT_TIMEOUT = 10
+
+# upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+BCRYPT_COST = re.compile(r'^\$2[abxy]?\$(\d\d)\$')
+
+
+class HashingOverloaded(Exception):
+    """Too many password hashes are already waiting; try again later."""
+
+
+def _config(key, default):
+    # User.signup/authenticate are also called outside the app (seed scripts,
+    # model tests), where we just use the defaults
+    if has_app_context():
+        return current_app.config.get(key, default)
+    return default
+
+
+##############################################################################
+# Worker functions (these run in the pool's processes)
+
+
+def _hash(password, rounds):
+    salt = bcrypt.gensalt(rounds=rounds, prefix=b'2b')
+    return bcrypt.hashpw(password.encode('UTF-8'), salt).decode('UTF-8')
+
+
+def _check(pw_hash, password):
+    return bcrypt.checkpw(password.encode('UTF-8'), pw_hash.encode('UTF-8'))
+
+
+##############################################################################
+# Pool
+
+
+class _LatencyStats:
+    """Running count/total/max and histogram of hash latencies."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def as_dict(self):
+        bounds = [str(bound) for bound in LATENCY_BUCKETS] + ['+Inf']
+        return dict(
+            count=self.count,
+            total_seconds=round(self.total, 6),
+            max_seconds=round(self.max, 6),
+            buckets=dict(zip(bounds, self.buckets)),
+        )
+
+
+_pool = None
+_slots = None
+_lock = threading.Lock()
+_stats = dict(hash=_LatencyStats(), check=_LatencyStats())
+_rejected = 0
+_timed_out = 0
+
+
+def _workers():
+    return _config('PASSWORD_HASH_WORKERS', DEFAULT_WORKERS)
+
+
+def _get_pool():
+    global _pool, _slots
+
+    with _lock:
+        if _pool is None:
+            workers = _workers()
+            # spawn, so the workers don't inherit the app's open DB connections
+            _pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'))
+            _slots = threading.BoundedSemaphore(
+                _config('PASSWORD_HASH_MAX_PENDING', workers * 4))
+
+    return _pool, _slots
+
+
+def _discard_pool(pool):
+    """Stop using `pool` (its workers died); the next job starts a new one."""
+
+    global _pool
+
+    with _lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def _run(kind, fn, *args):
+    """Run fn(*args) on the pool (or inline), recording its latency."""
+
+    global _rejected, _timed_out
+
+    start = time.perf_counter()
+
+    if _workers() <= 0:
+        result = fn(*args)
+
+    else:
+        pool, slots = _get_pool()
+        if not slots.acquire(blocking=False):
+            with _lock:
+                _rejected += 1
+            raise HashingOverloaded()
+
+        try:
+            future = pool.submit(fn, *args)
+        except BrokenProcessPool as e:
+            slots.release()
+            _discard_pool(pool)
+            raise HashingOverloaded() from e
+        except Exception:
+            slots.release()
+            raise
+        future.add_done_callback(lambda f: slots.release())
+
+        try:
+            result = future.result(
+                timeout=_config('PASSWORD_HASH_TIMEOUT', DEFAULT_TIMEOUT))
+        except FutureTimeoutError as e:
+            future.cancel()
+            with _lock:
+                _timed_out += 1
+            raise HashingOverloaded() from e
+        except BrokenProcessPool as e:
+            _discard_pool(pool)
+            raise HashingOverloaded() from e
+
+    with _lock:
+        _stats[kind].record(time.perf_counter() - start)
+
+    return result
+
+
+##############################################################################
+# Public API
+
+
+def log_rounds():
+    """The configured bcrypt cost factor."""
+
+    return _config('BCRYPT_LOG_ROUNDS', DEFAULT_ROUNDS)
+
+
+def hash_password(password):
+    """Hash `password` with bcrypt at the configured cost.
+
+    Raises HashingOverloaded if the hashing queue is full, or the hash
+    takes too long.
+    """
+
+    if not password:
+        raise ValueError("Password must be non-empty.")
+
+    return _run('hash', _hash, password, log_rounds())
+
+
+def check_password(pw_hash, password):
+    """Does `password` match `pw_hash`?
+
+    Raises HashingOverloaded if the hashing queue is full, or the check
+    takes too long.
+    """
+
+    if not password:
+        return False
+
+    return _run('check', _check, pw_hash, password)
+
+
+def needs_rehash(pw_hash):
+    """Was `pw_hash` made with a different cost than we use now?"""
+
+    match = BCRYPT_COST.match(pw_hash)
+    return match is None or int(match.group(1)) != log_rounds()
+
+
+def metrics():
+    """Snapshot of hashing latency, rejection and timeout counts."""
+
+    with _lock:
+        return dict(
+            hash=_stats['hash'].as_dict(),
+            check=_stats['check'].as_dict(),
+            rejected=_rejected,
+            timed_out=_timed_out,
+        )
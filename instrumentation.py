@@ -0,0 +1,255 @@
+"""Always-on SQL instrumentation, per request and per route.
+
+Every statement run while handling a request is timed and fingerprinted
+(literals and IN-lists stripped out, so `... WHERE id = 1` and `... WHERE
+id = 2` count as the same statement). At the end of the request we know how
+many statements ran, how long they took in total, which one was slowest, and
+which fingerprints repeated. A SELECT repeated N_PLUS_ONE_THRESHOLD or more
+times is flagged as a likely N+1 (usually a lazy load in a template loop).
+
+The numbers go out three ways:
+
+- X-DB-* response headers, in debug or testing mode or on requests that
+  could read /metrics;
+- one structured (JSON) log line per request on the "warbler.sql" logger,
+  at WARNING when an N+1 was flagged and INFO otherwise;
+- running per-route totals at /metrics, alongside hashing.metrics(),
+  pooling.metrics() and the graph index's stats().
+
+Statements are only ever reported by fingerprint, never with their values.
+/metrics needs `Authorization: Bearer <METRICS_TOKEN>`. With no token set it
+answers no one, unless METRICS_ALLOW_LOCAL lets requests from the same
+machine in (don't set that behind a reverse proxy on the same host: every
+request would look local).
+
+Statements run while a streamed response is being sent, after the view
+returns, aren't counted.
+"""
+
+import hmac
+import ipaddress
+import json
+import logging
+import re
+import threading
+import time
+
+from flask import abort, current_app, g, has_request_context, jsonify, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import graph
+import hashing
+import pooling
+
+DEFAULT_N_PLUS_ONE_THRESHOLD = 10
+
+# how many distinct fingerprints to keep per route, and to report
+MAX_FINGERPRINTS = 200
+TOP_FINGERPRINTS = 10
+
+logger = logging.getLogger('warbler.sql')
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PARAM = re.compile(r'%\(\w+\)s|\?|:\w+')
+_IN_LIST = re.compile(r'\bIN\s*\((?:\s*\?\s*,?)+\)', re.IGNORECASE)
+_SPACE = re.compile(r'\s+')
+
+
+def fingerprint(statement):
+    """`statement` with literals and parameters replaced by '?'."""
+
+    statement = _STRING.sub('?', statement)
+    statement = _PARAM.sub('?', statement)
+    statement = _NUMBER.sub('?', statement)
+    statement = _IN_LIST.sub('IN (?)', statement)
+    return _SPACE.sub(' ', statement).strip()
+
+
+##############################################################################
+# Per-request stats
+
+
+class RequestStats:
+    """The statements one request has run so far."""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.slowest = (0.0, None)
+        self.fingerprints = {}
+
+    def record(self, statement, seconds):
+        self.queries += 1
+        self.db_time += seconds
+        key = fingerprint(statement)
+        if seconds > self.slowest[0]:
+            self.slowest = (seconds, key)
+        self.fingerprints[key] = self.fingerprints.get(key, 0) + 1
+
+    def n_plus_one(self, threshold):
+        """Fingerprints of SELECTs repeated at least `threshold` times."""
+
+        return sorted(
+            (key for key, count in self.fingerprints.items()
+             if count >= threshold and key.upper().startswith('SELECT')),
+            key=lambda key: -self.fingerprints[key])
+
+
+def current_stats():
+    """This request's RequestStats (None outside a request)."""
+
+    if not has_request_context():
+        return None
+    if 'db_stats' not in g:
+        g.db_stats = RequestStats()
+    return g.db_stats
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    context._query_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    stats = current_stats()
+    if stats is not None:
+        stats.record(statement, time.perf_counter() - context._query_start)
+
+
+##############################################################################
+# Per-route totals
+
+
+class RouteStats:
+    """Running totals for one route, across requests."""
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.db_time = 0.0
+        self.slowest = (0.0, None)
+        self.n_plus_one_requests = 0
+        self.fingerprints = {}
+
+    def add(self, stats, n_plus_one):
+        self.requests += 1
+        self.queries += stats.queries
+        self.max_queries = max(self.max_queries, stats.queries)
+        self.db_time += stats.db_time
+        if stats.slowest[0] > self.slowest[0]:
+            self.slowest = stats.slowest
+        self.n_plus_one_requests += bool(n_plus_one)
+        for key, count in stats.fingerprints.items():
+            if key in self.fingerprints or len(self.fingerprints) < MAX_FINGERPRINTS:
+                self.fingerprints[key] = self.fingerprints.get(key, 0) + count
+
+    def as_dict(self):
+        top = sorted(self.fingerprints.items(), key=lambda item: -item[1])
+        return dict(
+            requests=self.requests,
+            queries=self.queries,
+            queries_per_request=round(self.queries / self.requests, 2),
+            max_queries=self.max_queries,
+            db_seconds=round(self.db_time, 6),
+            slowest_seconds=round(self.slowest[0], 6),
+            slowest_statement=self.slowest[1],
+            n_plus_one_requests=self.n_plus_one_requests,
+            top_fingerprints=[dict(statement=key, count=count)
+                              for key, count in top[:TOP_FINGERPRINTS]],
+        )
+
+
+_routes = {}
+_lock = threading.Lock()
+
+
+def route_metrics():
+    """Snapshot of the per-route totals."""
+
+    with _lock:
+        return {route: stats.as_dict() for route, stats in _routes.items()}
+
+
+def reset_metrics():
+    """Forget the per-route totals."""
+
+    with _lock:
+        _routes.clear()
+
+
+##############################################################################
+# Flask wiring
+
+
+def init_app(app):
+    """Report each request's SQL stats and add the /metrics endpoint."""
+
+    app.after_request(_report)
+    app.add_url_rule('/metrics', 'metrics', metrics)
+
+
+def _report(response):
+    stats = g.get('db_stats') or RequestStats()
+    n_plus_one = stats.n_plus_one(current_app.config.get(
+        'N_PLUS_ONE_THRESHOLD', DEFAULT_N_PLUS_ONE_THRESHOLD))
+    route = request.url_rule.rule if request.url_rule else '<unmatched>'
+
+    with _lock:
+        _routes.setdefault(f"{request.method} {route}", RouteStats()).add(
+            stats, n_plus_one)
+
+    # fingerprints give away the schema, so only to those allowed to see it
+    if current_app.debug or current_app.testing or _allowed():
+        response.headers['X-DB-Queries'] = str(stats.queries)
+        response.headers['X-DB-Time-Ms'] = f"{stats.db_time * 1000:.2f}"
+        response.headers['X-DB-Slowest-Ms'] = f"{stats.slowest[0] * 1000:.2f}"
+        if n_plus_one:
+            response.headers['X-DB-N-Plus-One'] = n_plus_one[0][:200]
+
+    logger.log(
+        logging.WARNING if n_plus_one else logging.INFO,
+        json.dumps(dict(
+            method=request.method,
+            path=request.path,
+            route=route,
+            status=response.status_code,
+            queries=stats.queries,
+            db_ms=round(stats.db_time * 1000, 2),
+            slowest_ms=round(stats.slowest[0] * 1000, 2),
+            slowest_statement=stats.slowest[1],
+            n_plus_one=[dict(statement=key, count=stats.fingerprints[key])
+                        for key in n_plus_one],
+        )))
+
+    return response
+
+
+def _allowed():
+    token = current_app.config.get('METRICS_TOKEN')
+    if token:
+        given = request.headers.get('Authorization', '')
+        return hmac.compare_digest(given.encode(), f"Bearer {token}".encode())
+
+    if not current_app.config.get('METRICS_ALLOW_LOCAL'):
+        return False
+    try:
+        return ipaddress.ip_address(request.remote_addr or '').is_loopback
+    except ValueError:
+        return False
+
+
+def metrics():
+    """Per-route SQL totals, password hashing, pool and graph stats, as JSON."""
+
+    if not _allowed():
+        abort(403)
+
+    return jsonify(routes=route_metrics(), hashing=hashing.metrics(),
+                   pools=pooling.metrics(current_app),
+                   graph=graph.index.stats())
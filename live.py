@@ -0,0 +1,279 @@
+"""Live home timeline updates, over server-sent events.
+
+A logged-in page opens an EventSource on /stream. The stream subscribes to
+the authors the user follows (and the user), and messages_add() publishes
+each new message's id under its author once it's committed. The browser then
+fetches just those messages' cards from /timeline/items (see
+static/scripts/live.js) instead of reloading the whole home page.
+
+Events look like:
+
+    id: 42
+    event: message
+    data: {"id": 42, "user_id": 7}
+
+A comment line goes out every LIVE_KEEPALIVE_SECONDS so proxies don't drop
+an idle stream, and the stream ends after LIVE_MAX_SECONDS; the browser
+reconnects by itself, which also picks up follows made in the meantime. If a
+client falls LIVE_QUEUE_SIZE events behind, its backlog is dropped and it
+gets a "resync" event (reload the first page) instead.
+
+Where events go is up to LIVE_BROKER:
+
+- None (the default): a LocalBroker, which only reaches streams served by
+  this process. Fine for tests and single-process setups.
+- 'postgres': a PostgresBroker, which publishes through NOTIFY on the
+  primary, so every process's streams see every message.
+- any object with the same publish()/subscribe() methods.
+
+Each open stream ties up a worker for as long as it's connected, so serve
+the app from an async or greenlet worker (e.g. gunicorn -k gevent); a stream
+doesn't hold a database connection while it waits.
+"""
+
+import json
+import logging
+import queue
+import select
+import threading
+import time
+
+from flask import Response, abort, current_app, g
+from sqlalchemy import text
+
+from models import db
+
+DEFAULT_KEEPALIVE_SECONDS = 15
+DEFAULT_MAX_SECONDS = 5 * 60
+DEFAULT_QUEUE_SIZE = 100
+
+# how long the browser waits before reconnecting
+RETRY_MS = 3000
+
+# returned by Subscription.get() when events were dropped
+RESYNC = object()
+
+logger = logging.getLogger('warbler.live')
+
+
+class Subscription:
+    """One stream's queue of events for a set of keys."""
+
+    def __init__(self, broker, keys, max_queued):
+        self.broker = broker
+        self.keys = frozenset(keys)
+        self.queue = queue.Queue(max_queued)
+        self.overflowed = False
+
+    def deliver(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        """The next event, RESYNC, or None if `timeout` seconds pass first."""
+
+        if self.overflowed:
+            self.overflowed = False
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            return RESYNC
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    """Delivers events to subscriptions in this process."""
+
+    def __init__(self, max_queued=DEFAULT_QUEUE_SIZE):
+        self.max_queued = max_queued
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+
+    def publish(self, key, event):
+        """Send `event` (a JSON-able dict) to everyone subscribed to `key`."""
+
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(key, ()))
+        for subscription in subscriptions:
+            subscription.deliver(event)
+
+    def subscribe(self, keys):
+        """A new Subscription to events published under any of `keys`."""
+
+        subscription = Subscription(self, keys, self.max_queued)
+        with self.lock:
+            for key in subscription.keys:
+                self.subscriptions.setdefault(key, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for key in subscription.keys:
+                subscribers = self.subscriptions.get(key)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self.subscriptions[key]
+
+
+class PostgresBroker(LocalBroker):
+    """A LocalBroker whose events go through PostgreSQL NOTIFY.
+
+    publish() NOTIFYs on the primary. Each process LISTENs on one connection
+    of its own, from a background thread started by the first subscribe(),
+    and hands what it hears to its local subscriptions. Events published
+    while that connection is down (it reconnects after RECONNECT_SECONDS)
+    are missed.
+    """
+
+    CHANNEL = 'warbler_live'
+    RECONNECT_SECONDS = 1
+
+    def __init__(self, app, max_queued=DEFAULT_QUEUE_SIZE):
+        super().__init__(max_queued)
+        self.app = app
+        self._listener = None
+        self._listener_lock = threading.Lock()
+        # set while the listener is connected
+        self.listening = threading.Event()
+
+    def _engine(self):
+        return db.get_engine(self.app)
+
+    def publish(self, key, event):
+        payload = json.dumps({'key': key, 'event': event})
+        # its own transaction, so the NOTIFY goes out now, whatever happens
+        # to the request's
+        with self._engine().begin() as connection:
+            connection.execute(text("SELECT pg_notify(:channel, :payload)"),
+                               channel=self.CHANNEL, payload=payload)
+
+    def subscribe(self, keys):
+        with self._listener_lock:
+            if self._listener is None:
+                self._listener = threading.Thread(
+                    target=self._listen, daemon=True,
+                    name='warbler-live-listener')
+                self._listener.start()
+        return super().subscribe(keys)
+
+    def _listen(self):
+        while True:
+            connection = None
+            try:
+                # taken out of the pool for good: it only ever LISTENs
+                connection = self._engine().raw_connection()
+                connection.detach()
+                # (the pool's pre-ping may have left a transaction open)
+                connection.connection.rollback()
+                connection.connection.autocommit = True
+                with connection.connection.cursor() as cursor:
+                    cursor.execute(f"LISTEN {self.CHANNEL}")
+                self.listening.set()
+                self._relay(connection.connection)
+            except Exception:
+                logger.warning("Live update listener failed; reconnecting",
+                               exc_info=True)
+            finally:
+                self.listening.clear()
+                if connection is not None:
+                    connection.close()
+            time.sleep(self.RECONNECT_SECONDS)
+
+    def _relay(self, dbapi_connection):
+        while True:
+            if select.select([dbapi_connection], [], [], 5) == ([], [], []):
+                continue
+            dbapi_connection.poll()
+            while dbapi_connection.notifies:
+                notify = dbapi_connection.notifies.pop(0)
+                data = json.loads(notify.payload)
+                LocalBroker.publish(self, data['key'], data['event'])
+
+
+def broker():
+    """The app's broker; see LIVE_BROKER."""
+
+    return current_app.config['LIVE_BROKER']
+
+
+def publish_message(message):
+    """Tell the author's followers' streams about a just-committed message.
+
+    A broker failure is logged, not raised: the message is saved either way,
+    and followers see it on their next reload.
+    """
+
+    try:
+        broker().publish(message.user_id,
+                         {'id': message.id, 'user_id': message.user_id})
+    except Exception:
+        logger.warning("Couldn't publish message %s", message.id,
+                       exc_info=True)
+
+
+def _events(subscription, keepalive, max_seconds):
+    try:
+        yield f"retry: {RETRY_MS}\n\n"
+
+        deadline = time.monotonic() + max_seconds
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+
+            event = subscription.get(min(keepalive, remaining))
+            if event is None:
+                yield ": keepalive\n\n"
+            elif event is RESYNC:
+                yield "event: resync\ndata: {}\n\n"
+            else:
+                yield (f"id: {event['id']}\nevent: message\n"
+                       f"data: {json.dumps(event)}\n\n")
+    finally:
+        subscription.close()
+
+
+def stream():
+    """Server-sent events for the current user's home timeline."""
+
+    if not g.user:
+        abort(401)
+
+    subscription = broker().subscribe(
+        g.user_context.following_ids | {g.user.id})
+    config = current_app.config
+
+    # not stream_with_context: the request (and its DB session) is over by
+    # the time the events go out
+    response = Response(
+        _events(subscription,
+                config.get('LIVE_KEEPALIVE_SECONDS',
+                           DEFAULT_KEEPALIVE_SECONDS),
+                config.get('LIVE_MAX_SECONDS', DEFAULT_MAX_SECONDS)),
+        mimetype='text/event-stream')
+    response.cache_control.no_store = True
+    # and don't let nginx buffer it
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def init_app(app):
+    """Add the /stream endpoint, and set up the LIVE_BROKER."""
+
+    max_queued = app.config.get('LIVE_QUEUE_SIZE', DEFAULT_QUEUE_SIZE)
+    setting = app.config.get('LIVE_BROKER')
+    if setting is None:
+        app.config['LIVE_BROKER'] = LocalBroker(max_queued)
+    elif setting == 'postgres':
+        app.config['LIVE_BROKER'] = PostgresBroker(app, max_queued)
+
+    app.add_url_rule('/stream', 'stream', stream)
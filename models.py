@@ -1,12 +1,19 @@
 """SQLAlchemy models for Warbler."""
 
+import logging
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, event, exists, func, literal, or_, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import contains_eager, selectinload
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+import hashing
+import replicas
+from replicas import RoutingSQLAlchemy
+
+db = RoutingSQLAlchemy()
+
+logger = logging.getLogger('warbler.auth')
 
 
 class Follows(db.Model):
@@ -26,6 +33,87 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # the primary key covers "who follows X"; this covers "who does X follow"
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
+    @classmethod
+    def relationships(cls, user_id, candidate_ids):
+        """Which of `candidate_ids` does `user_id` follow, and which follow them?
+
+        Answers both with one indexed query. Returns a pair of sets:
+        (ids user_id follows, ids following user_id).
+        """
+
+        candidate_ids = list(candidate_ids)
+        if not candidate_ids:
+            return set(), set()
+
+        rows = (db.session
+                .query(cls.user_being_followed_id, cls.user_following_id)
+                .filter(or_(
+                    and_(cls.user_following_id == user_id,
+                         cls.user_being_followed_id.in_(candidate_ids)),
+                    and_(cls.user_being_followed_id == user_id,
+                         cls.user_following_id.in_(candidate_ids)),
+                )))
+
+        following, followers = set(), set()
+        for followed_id, follower_id in rows:
+            if follower_id == user_id:
+                following.add(followed_id)
+            if followed_id == user_id:
+                followers.add(follower_id)
+
+        return following, followers
+
+    @classmethod
+    def follow(cls, follower_id, followed_id):
+        """Have `follower_id` follow `followed_id`; True if they didn't already.
+
+        An INSERT that ignores an existing row, so a repeated or racing
+        follow can't fail or double-count. Core statements skip the ORM
+        counter events, so the counts are bumped here.
+        """
+
+        follows = cls.__table__
+        connection = replicas.write_connection(db.session)
+
+        values = dict(user_following_id=follower_id,
+                      user_being_followed_id=followed_id)
+        if connection.dialect.name == 'postgresql':
+            insert = (postgresql.insert(follows).values(values)
+                      .on_conflict_do_nothing(index_elements=[
+                          follows.c.user_being_followed_id,
+                          follows.c.user_following_id]))
+        else:
+            insert = follows.insert().values(values).prefix_with('OR IGNORE')
+
+        if connection.execute(insert).rowcount:
+            _bump(connection, 'following_count', follower_id, 1)
+            _bump(connection, 'follower_count', followed_id, 1)
+            _note_follow_change(connection, follower_id)
+            return True
+        return False
+
+    @classmethod
+    def unfollow(cls, follower_id, followed_id):
+        """Have `follower_id` stop following `followed_id`; True if they did."""
+
+        follows = cls.__table__
+        connection = replicas.write_connection(db.session)
+
+        deleted = connection.execute(follows.delete().where(and_(
+            follows.c.user_following_id == follower_id,
+            follows.c.user_being_followed_id == followed_id))).rowcount
+        if deleted:
+            _bump(connection, 'following_count', follower_id, -1)
+            _bump(connection, 'follower_count', followed_id, -1)
+            _note_follow_change(connection, follower_id)
+        return bool(deleted)
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -42,10 +130,238 @@ class Likes(db.Model):
         db.ForeignKey('users.id', ondelete='cascade')
     )
 
+    # once messages is partitioned, a trigger does this FK's cascade
+    # instead (here and on timelines); see partitions.py
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+    )
+
+    # a user likes a message at most once; the index also serves "does X
+    # like Y?" and "what does X like?", and the second one "who likes Y?"
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id',
+                            name='uq_likes_user_id_message_id'),
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
+
+    @classmethod
+    def like(cls, user_id, message_id):
+        """Like `message_id` as `user_id`; True if they didn't already.
+
+        An INSERT ... SELECT that ignores a conflicting row, so racing likes
+        can't double-count, and inserts nothing unless the message exists
+        (once messages is partitioned no foreign key checks that, and a
+        detached month's messages don't count). Core statements skip the
+        ORM counter events, so like_count is bumped here.
+        """
+
+        likes = cls.__table__
+        messages = Message.__table__
+        connection = replicas.write_connection(db.session)
+
+        row = select([literal(user_id), literal(message_id)]).where(
+            exists().where(messages.c.id == message_id))
+        if connection.dialect.name == 'postgresql':
+            insert = (postgresql.insert(likes)
+                      .from_select(['user_id', 'message_id'], row)
+                      .on_conflict_do_nothing(
+                          constraint='uq_likes_user_id_message_id'))
+        else:
+            insert = (likes.insert()
+                      .from_select(['user_id', 'message_id'], row)
+                      .prefix_with('OR IGNORE'))
+
+        if connection.execute(insert).rowcount:
+            _bump(connection, 'like_count', user_id, 1)
+            return True
+        return False
+
+    @classmethod
+    def unlike(cls, user_id, message_id):
+        """Un-like `message_id` as `user_id`; True if they liked it."""
+
+        likes = cls.__table__
+        connection = replicas.write_connection(db.session)
+
+        deleted = connection.execute(likes.delete().where(and_(
+            likes.c.user_id == user_id,
+            likes.c.message_id == message_id))).rowcount
+        if deleted:
+            _bump(connection, 'like_count', user_id, -1)
+        return bool(deleted)
+
+    @classmethod
+    def count_for(cls, message_id):
+        """How many likes `message_id` has."""
+
+        likes = cls.__table__
+        return db.session.connection().execute(
+            select([func.count()]).where(likes.c.message_id == message_id)
+        ).scalar()
+
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Like `message_id` as `user_id`, or unlike it if they already do.
+
+        One indexed DELETE, then (if nothing was deleted) an INSERT; see
+        like() and unlike(). Returns (liked, number of likes the message
+        now has).
+        """
+
+        liked = (not cls.unlike(user_id, message_id)
+                 and cls.like(user_id, message_id))
+        return liked, cls.count_for(message_id)
+
+
+class Timeline(db.Model):
+    """Precomputed home timeline entry: follower <-> message.
+
+    Filled in by fan-out-on-write (see timeline.py), so the home page can read
+    a ready-made list of message ids instead of querying every followed user.
+    """
+
+    __tablename__ = 'timelines'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
+    )
+
+    # copied from the message so a timeline can be read and trimmed
+    # in order without joining back to `messages`
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    # the second one serves ON DELETE CASCADE when messages are deleted
+    __table_args__ = (
+        db.Index('ix_timelines_user_id_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+        db.Index('ix_timelines_message_id', 'message_id'),
+    )
+
+
+class HeavyPoster(db.Model):
+    """An author whose messages followers pull instead of having them pushed.
+
+    Set by fan-out (see timeline.py) once an author has too many followers
+    to fan out to, and cleared once they've dropped well below that, when
+    their recent messages are pushed after all.
+    """
+
+    __tablename__ = 'heavy_posters'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+
+class Recommendation(db.Model):
+    """A "who to follow" suggestion: user <-> suggested user.
+
+    Written by the batch job in recommendations.py; `score` is how many of
+    the people the user follows already follow the suggestion.
+    """
+
+    __tablename__ = 'recommendations'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    recommended_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+
+class FollowChange(db.Model):
+    """A user whose follows changed since recommendations were last refreshed.
+
+    One row per user, kept up to date by the Follows events below.
+    """
+
+    __tablename__ = 'follow_changes'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    changed_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+class UserPurge(db.Model):
+    """Progress of purging a deleted account's data; see purge.py.
+
+    Kept (with finished_at set) after the user's row is gone.
+    """
+
+    __tablename__ = 'user_purges'
+
+    # no foreign key: this outlives the user
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    requested_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    # what's being deleted now: messages, archived, likes, following,
+    # followers, user
+    stage = db.Column(
+        db.Text,
+        nullable=False,
+        default='messages',
+    )
+
+    messages_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    likes_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    follows_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
     )
 
 
@@ -94,6 +410,45 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counts, kept in step by the listeners at the bottom of
+    # this file. They only see changes made through Message/Follows/Likes
+    # rows, not through the collections below; User.reconcile_counters()
+    # recomputes them from scratch.
+
+    message_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    follower_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # set when the account is deleted; its data is purged in the
+    # background and then the row goes too (see purge.py)
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -121,23 +476,30 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        _, followers = Follows.relationships(self.id, [other_user.id])
+        return other_user.id in followers
 
     def is_following(self, other_user):
         """Is this user following `other_user`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        following, _ = Follows.relationships(self.id, [other_user.id])
+        return other_user.id in following
+
+    @classmethod
+    def active(cls):
+        """Query for users whose accounts haven't been deleted."""
+
+        return cls.query.filter(cls.deleted_at.is_(None))
 
     @classmethod
     def signup(cls, username, email, password, image_url):
         """Sign up user.
 
-        Hashes password and adds user to system.
+        Hashes password and adds user to system. Hashing happens off this
+        thread (see hashing.py) and may raise HashingOverloaded.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hashing.hash_password(password)
 
         user = User(
             username=username,
@@ -158,17 +520,54 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the stored hash was made with an old cost factor, it's replaced
+        with a fresh one; the caller commits that change. If that rehash
+        fails (e.g. the hashing pool is overloaded), it's logged and left
+        for a later login. The check itself may raise HashingOverloaded.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.active().filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hashing.check_password(user.password, password)
             if is_auth:
+                if hashing.needs_rehash(user.password):
+                    try:
+                        user.password = hashing.hash_password(password)
+                    except Exception:
+                        # the password checked out; the upgrade can wait
+                        logger.warning("Skipped rehashing user #%s's "
+                                       "password", user.id, exc_info=True)
                 return user
 
         return False
 
+    @classmethod
+    def reconcile_counters(cls):
+        """Recompute every user's denormalized counts from the source tables.
+
+        Runs as a single UPDATE; returns the number of users touched.
+        """
+
+        users = cls.__table__
+
+        def count_of(table, column):
+            return (select([func.count()])
+                    .select_from(table)
+                    .where(column == users.c.id)
+                    .as_scalar())
+
+        result = db.session.execute(users.update().values(
+            message_count=count_of(Message.__table__, Message.user_id),
+            following_count=count_of(Follows.__table__,
+                                     Follows.user_following_id),
+            follower_count=count_of(Follows.__table__,
+                                    Follows.user_being_followed_id),
+            like_count=count_of(Likes.__table__, Likes.user_id),
+        ))
+        return result.rowcount
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
@@ -188,7 +587,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -199,6 +598,179 @@ class Message(db.Model):
 
     user = db.relationship('User')
 
+    @classmethod
+    def remove(cls, message_id, user_id):
+        """Delete `user_id`'s message `message_id`; True if it was there.
+
+        A Core DELETE guarded by its rowcount, so when two deletes race only
+        the one that removed the row un-counts it (the ORM would bump the
+        counters for both). Its likes go with it by ON DELETE CASCADE, so
+        their likers are counted first and un-counted after.
+        """
+
+        messages, likes = cls.__table__, Likes.__table__
+        connection = replicas.write_connection(db.session)
+
+        likers = connection.execute(
+            select([likes.c.user_id]).where(likes.c.message_id == message_id)
+        ).fetchall()
+        deleted = connection.execute(messages.delete().where(and_(
+            messages.c.id == message_id,
+            messages.c.user_id == user_id))).rowcount
+        if not deleted:
+            return False
+
+        _bump(connection, 'message_count', user_id, -1)
+        if likers:
+            _bump(connection, 'like_count', [liker for (liker,) in likers], -1)
+        return True
+
+    @classmethod
+    def with_authors(cls, batched=False):
+        """Query for messages that loads each one's author in the same query.
+
+        Listings touch msg.user on every row; without this, that's one lazy
+        load per message. Only the columns a message card shows are loaded.
+
+        With `batched`, the authors come from one extra IN query for the
+        distinct author ids instead, which is leaner when a few authors
+        cover most of the rows.
+
+        Messages by soft-deleted users are left out (see purge.py), so they
+        vanish at once, not as the purge gets to them.
+        """
+
+        loader = selectinload(cls.user) if batched else contains_eager(cls.user)
+        return (cls.query
+                .join(cls.user)
+                .filter(User.deleted_at.is_(None))
+                .options(loader.load_only('id', 'username', 'image_url')))
+
+    # keyset pagination walks (timestamp, id) newest first, either across
+    # everyone or within one user's messages; see pagination.py. On
+    # PostgreSQL the table can be partitioned by month (partitions.py)
+    __table_args__ = (
+        db.Index('ix_messages_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_messages_user_id_timestamp_id',
+                 'user_id', 'timestamp', 'id'),
+    )
+
+
+##############################################################################
+# Denormalized counter maintenance
+#
+# These run inside the flush, on the same connection, so the counts commit
+# (or roll back) together with the change that caused them. Follows changes
+# also note the follower in follow_changes, for recommendations.py.
+
+
+def _bump(connection, column, user_ids, delta):
+    """Add `delta` to `column` for the user(s) selected by `user_ids`."""
+
+    users = User.__table__
+    if isinstance(user_ids, int):
+        condition = users.c.id == user_ids
+    else:
+        condition = users.c.id.in_(user_ids)
+
+    connection.execute(users.update()
+                       .where(condition)
+                       .values({column: users.c[column] + delta}))
+
+
+@event.listens_for(Message, 'after_insert')
+def _message_inserted(mapper, connection, message):
+    _bump(connection, 'message_count', message.user_id, 1)
+
+
+@event.listens_for(Message, 'before_delete')
+def _message_deleting(mapper, connection, message):
+    # its likes go with it (ON DELETE CASCADE), so un-count them first
+    likers = (select([Likes.user_id])
+              .where(Likes.message_id == message.id))
+    _bump(connection, 'like_count', likers, -1)
+    _bump(connection, 'message_count', message.user_id, -1)
+
+
+def _note_follow_change(connection, user_ids):
+    """Mark the user(s) `user_ids`' recommendations as due for a refresh."""
+
+    if isinstance(user_ids, int):
+        user_ids = [user_ids]
+    if not user_ids:
+        return
+
+    changes = FollowChange.__table__
+    now = datetime.utcnow()
+    values = [dict(user_id=user_id, changed_at=now) for user_id in user_ids]
+    if connection.dialect.name == 'postgresql':
+        upsert = postgresql.insert(changes).values(values)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=[changes.c.user_id],
+            set_=dict(changed_at=upsert.excluded.changed_at))
+    else:
+        upsert = changes.insert().values(values).prefix_with('OR REPLACE')
+    connection.execute(upsert)
+
+
+@event.listens_for(Follows, 'after_insert')
+def _follow_inserted(mapper, connection, follow):
+    _bump(connection, 'following_count', follow.user_following_id, 1)
+    _bump(connection, 'follower_count', follow.user_being_followed_id, 1)
+    _note_follow_change(connection, follow.user_following_id)
+
+
+@event.listens_for(Follows, 'after_delete')
+def _follow_deleted(mapper, connection, follow):
+    _bump(connection, 'following_count', follow.user_following_id, -1)
+    _bump(connection, 'follower_count', follow.user_being_followed_id, -1)
+    _note_follow_change(connection, follow.user_following_id)
+
+
+@event.listens_for(Likes, 'after_insert')
+def _like_inserted(mapper, connection, like):
+    _bump(connection, 'like_count', like.user_id, 1)
+
+
+@event.listens_for(Likes, 'after_delete')
+def _like_deleted(mapper, connection, like):
+    _bump(connection, 'like_count', like.user_id, -1)
+
+
+@event.listens_for(db.session, 'before_flush')
+def _users_deleting(session, flush_context, instances):
+    """Un-count a deleted user's follows and the likes on their messages.
+
+    This has to happen before the flush, while the follows/likes rows that
+    the ORM and ON DELETE CASCADE are about to remove still exist.
+    """
+
+    for user in [obj for obj in session.deleted if isinstance(obj, User)]:
+        connection = session.connection()
+
+        followed = (select([Follows.user_being_followed_id])
+                    .where(Follows.user_following_id == user.id))
+        followers = (select([Follows.user_following_id])
+                     .where(Follows.user_being_followed_id == user.id))
+        _bump(connection, 'follower_count', followed, -1)
+        _bump(connection, 'following_count', followers, -1)
+
+        # a liker can like several of this user's messages
+        likes = (select([Likes.user_id, func.count().label('n')])
+                 .select_from(Likes.__table__.join(
+                     Message.__table__, Likes.message_id == Message.id))
+                 .where(Message.user_id == user.id)
+                 .group_by(Likes.user_id)
+                 .alias('likes_on_messages'))
+        users = User.__table__
+        connection.execute(
+            users.update()
+            .where(users.c.id.in_(select([likes.c.user_id])))
+            .values(like_count=users.c.like_count - (
+                select([likes.c.n])
+                .where(likes.c.user_id == users.c.id)
+                .as_scalar())))
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
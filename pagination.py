@@ -0,0 +1,111 @@
+"""Keyset ("load older") pagination for message listings.
+
+Pages are ordered newest first by (Message.timestamp, Message.id), and each
+page hands back an opaque cursor pointing just past its last message. Asking
+for the next page filters on that key instead of using OFFSET, so a deep page
+costs the same as the first one (see the composite indexes on Message).
+
+With MESSAGES_HOT_WINDOW_DAYS set, a page is first looked for among the
+messages from that many days before where it starts (now, or the cursor),
+and only if those don't fill it among the older ones. On a partitioned
+`messages` (see partitions.py) the first query then touches only the
+latest month or two; the old months are reached when a page runs into them.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from flask import abort, current_app
+from sqlalchemy import tuple_
+
+from models import Message
+
+CURSOR_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+DEFAULT_PER_PAGE = 100
+DEFAULT_HOT_WINDOW_DAYS = 0
+
+Page = namedtuple('Page', ['items', 'next_cursor'])
+
+
+def encode_cursor(message):
+    """Make an opaque cursor for the page after `message`."""
+
+    key = f"{message.timestamp.strftime(CURSOR_TIMESTAMP_FORMAT)}|{message.id}"
+    return urlsafe_b64encode(key.encode('UTF-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Turn a cursor back into a (timestamp, id) key.
+
+    Raises ValueError if the cursor wasn't made by encode_cursor.
+    """
+
+    try:
+        key = urlsafe_b64decode(cursor.encode('ascii')).decode('UTF-8')
+        timestamp, message_id = key.split('|')
+        return (datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT),
+                int(message_id))
+    except (UnicodeError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+
+
+def per_page():
+    """Configured page size for message listings."""
+
+    return current_app.config.get('MESSAGES_PER_PAGE', DEFAULT_PER_PAGE)
+
+
+def hot_window():
+    """How far back the first try at a page looks, or None to look at all."""
+
+    days = current_app.config.get('MESSAGES_HOT_WINDOW_DAYS',
+                                  DEFAULT_HOT_WINDOW_DAYS)
+    return timedelta(days=days) if days else None
+
+
+def _newest(query, limit):
+    return (query
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(limit)
+            .all())
+
+
+def paginate(query, cursor=None, limit=None):
+    """Return one Page of messages from `query`, newest first.
+
+    `cursor` is the next_cursor of the previous page (or None for the first
+    page); a malformed cursor is a 400. `limit` defaults to MESSAGES_PER_PAGE.
+    """
+
+    limit = limit or per_page()
+    start = None
+
+    if cursor:
+        try:
+            timestamp, message_id = decode_cursor(cursor)
+        except ValueError:
+            abort(400)
+        # the plain bound lets PostgreSQL skip partitions; the row
+        # comparison alone doesn't
+        query = query.filter(
+            Message.timestamp <= timestamp,
+            tuple_(Message.timestamp, Message.id) < tuple_(timestamp, message_id))
+        start = timestamp
+
+    # fetch one extra row to find out whether there's an older page
+    window = hot_window()
+    if window:
+        boundary = (start or datetime.utcnow()) - window
+        items = _newest(query.filter(Message.timestamp >= boundary), limit + 1)
+        if len(items) <= limit:
+            items += _newest(query.filter(Message.timestamp < boundary),
+                             limit + 1 - len(items))
+    else:
+        items = _newest(query, limit + 1)
+
+    if len(items) > limit:
+        items = items[:limit]
+        return Page(items, encode_cursor(items[-1]))
+
+    return Page(items, None)
@@ -0,0 +1,274 @@
+"""Monthly range partitions for `messages` on PostgreSQL.
+
+Almost every read of `messages` wants the newest rows, so on a big database
+the table is split by month on its timestamp (messages_2024_05 and so on,
+plus messages_default for anything no month covers). Queries bounded by
+timestamp only touch the months they need; see the hot window in
+pagination.py.
+
+`flask partition-messages` converts an existing table, once. PostgreSQL can
+only partition a table whose unique keys include the partition key, so the
+primary key becomes (id, timestamp). Foreign keys from likes and timelines
+to messages.id can't be kept, so the conversion drops them and an AFTER
+DELETE trigger on messages does their ON DELETE CASCADE instead.
+
+`flask maintain-message-partitions` (run it from cron, say daily) creates
+the coming MESSAGE_PARTITIONS_AHEAD months, and detaches months older than
+MESSAGE_PARTITIONS_KEEP_MONTHS (0 keeps everything), optionally moving them
+into the `archive` schema. A detached month is an ordinary table: its
+messages drop out of the site, but nothing is deleted (their likes and
+timeline entries stay too). Authors' message_count stops counting them, as
+`flask reconcile-counters` would; attaching a month again by hand means
+reconciling the counters after. A deleted account's messages are purged
+from detached months too (see detached_tables() and purge.py).
+"""
+
+from datetime import date, datetime
+
+from flask import current_app
+from sqlalchemy import DDL, text
+
+DEFAULT_AHEAD = 3
+DEFAULT_KEEP_MONTHS = 0
+
+DEFAULT_PARTITION = 'messages_default'
+ARCHIVE_SCHEMA = 'archive'
+
+# set (locally) while rows are moved out of the default partition, so the
+# cascade trigger doesn't take their likes and timeline entries with them
+MOVING_SETTING = 'warbler.moving_messages'
+
+
+def _config(key, default):
+    return current_app.config.get(key, default)
+
+
+def month_start(when):
+    """The first day of `when`'s month."""
+
+    return date(when.year, when.month, 1)
+
+
+def add_months(month, months):
+    """The first day of the month `months` after `month`'s (may be < 0)."""
+
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"messages_{month:%Y_%m}"
+
+
+def _month_of(name):
+    # the month a partition's name is for, or None (e.g. the default)
+    try:
+        return datetime.strptime(name, 'messages_%Y_%m').date()
+    except ValueError:
+        return None
+
+
+def is_partitioned(connection):
+    """Is `messages` a partitioned table in this database?"""
+
+    if connection.dialect.name != 'postgresql':
+        return False
+
+    return connection.execute(
+        "SELECT relkind FROM pg_class "
+        "WHERE oid = to_regclass('public.messages')").scalar() == 'p'
+
+
+def attached_partitions(connection):
+    """Names of the partitions of `messages`, oldest month first."""
+
+    names = [name for (name,) in connection.execute(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'public.messages'::regclass")]
+    return sorted(names, key=lambda name: (_month_of(name) is None, name))
+
+
+def detached_tables(connection):
+    """Schema-qualified names of the months detached from `messages`.
+
+    Both those still in public and those moved into the archive schema.
+    """
+
+    if not is_partitioned(connection):
+        return []
+
+    return [f"{schema}.{name}" for schema, name in connection.execute(
+        "SELECT n.nspname, c.relname FROM pg_class c "
+        "JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE c.relkind = 'r' AND n.nspname IN ('public', %s) "
+        "AND c.relname ~ '^messages_[0-9]{4}_[0-9]{2}$' "
+        "AND NOT c.relispartition "
+        "ORDER BY c.relname", (ARCHIVE_SCHEMA,))]
+
+
+##############################################################################
+# Creating and detaching months
+
+
+def create_partition(connection, month):
+    """Add `month`'s partition, unless it's there; True if it was added.
+
+    The new table is filled with any of the month's rows that landed in the
+    default partition, then attached (which locks `messages` less than
+    CREATE TABLE ... PARTITION OF would).
+    """
+
+    name = partition_name(month)
+    if connection.execute("SELECT to_regclass(%s)",
+                          (f'public.{name}',)).scalar() is not None:
+        return False
+
+    bounds = dict(start=month, end=add_months(month, 1))
+    connection.execute(DDL(
+        f"CREATE TABLE {name} (LIKE messages INCLUDING DEFAULTS)"))
+    connection.execute(f"SET LOCAL {MOVING_SETTING} = 'on'")
+    connection.execute(text(
+        f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} "
+        '                WHERE "timestamp" >= :start AND "timestamp" < :end '
+        "                RETURNING *) "
+        f"INSERT INTO {name} SELECT * FROM moved"), **bounds)
+    connection.execute(f"SET LOCAL {MOVING_SETTING} = 'off'")
+    connection.execute(DDL(
+        f"ALTER TABLE messages ATTACH PARTITION {name} "
+        f"FOR VALUES FROM ('{bounds['start']}') TO ('{bounds['end']}')"))
+    return True
+
+
+def detach_partition(connection, name, archive=False):
+    """Detach partition `name`, moving it into the archive schema if asked.
+
+    Its messages no longer count towards their authors' message_count.
+    """
+
+    connection.execute(DDL(f"ALTER TABLE messages DETACH PARTITION {name}"))
+    connection.execute(DDL(f"""
+        UPDATE users SET message_count = message_count - detached.n
+        FROM (SELECT user_id, count(*) AS n FROM {name} GROUP BY user_id)
+            AS detached
+        WHERE users.id = detached.user_id"""))
+    if archive:
+        connection.execute(DDL(f"CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA}"))
+        connection.execute(DDL(f"ALTER TABLE {name} SET SCHEMA {ARCHIVE_SCHEMA}"))
+
+
+def maintain(connection, ahead=None, keep_months=None, archive=False,
+             today=None):
+    """Create the coming months and detach the expired ones.
+
+    Returns (names created, names detached).
+    """
+
+    if ahead is None:
+        ahead = _config('MESSAGE_PARTITIONS_AHEAD', DEFAULT_AHEAD)
+    if keep_months is None:
+        keep_months = _config('MESSAGE_PARTITIONS_KEEP_MONTHS',
+                              DEFAULT_KEEP_MONTHS)
+    this_month = month_start(today or datetime.utcnow())
+
+    created = [partition_name(month)
+               for month in (add_months(this_month, n)
+                             for n in range(ahead + 1))
+               if create_partition(connection, month)]
+
+    detached = []
+    if keep_months:
+        oldest_kept = add_months(this_month, -keep_months)
+        for name in attached_partitions(connection):
+            month = _month_of(name)
+            if month is not None and month < oldest_kept:
+                detach_partition(connection, name, archive)
+                detached.append(name)
+
+    return created, detached
+
+
+##############################################################################
+# Converting an existing table
+
+
+def _create_cascade_trigger(connection):
+    connection.execute(DDL(f"""
+        CREATE OR REPLACE FUNCTION messages_delete_cascade() RETURNS trigger
+        AS $$
+        BEGIN
+            IF current_setting('{MOVING_SETTING}', true) = 'on' THEN
+                RETURN NULL;
+            END IF;
+            DELETE FROM likes WHERE message_id = OLD.id;
+            DELETE FROM timelines WHERE message_id = OLD.id;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql"""))
+    connection.execute(DDL(
+        "CREATE TRIGGER messages_delete_cascade AFTER DELETE ON messages "
+        "FOR EACH ROW EXECUTE FUNCTION messages_delete_cascade()"))
+
+
+def partition_messages(connection, ahead=None, today=None):
+    """Rebuild `messages` as a table partitioned by month.
+
+    Runs in the caller's transaction and holds `messages` (and the tables
+    that referenced it) locked throughout, so run it while the site's down.
+    Returns the number of messages copied.
+    """
+
+    if ahead is None:
+        ahead = _config('MESSAGE_PARTITIONS_AHEAD', DEFAULT_AHEAD)
+
+    # likes and timelines can't reference a partitioned messages.id
+    for table, constraint in connection.execute(
+            "SELECT conrelid::regclass::text, conname FROM pg_constraint "
+            "WHERE contype = 'f' AND confrelid = 'public.messages'::regclass"
+    ).fetchall():
+        connection.execute(DDL(
+            f"ALTER TABLE {table} DROP CONSTRAINT {constraint}"))
+
+    # the old table goes at the end; free up the names the new one needs
+    connection.execute(DDL("ALTER TABLE messages RENAME TO messages_unpartitioned"))
+    connection.execute(DDL("ALTER TABLE messages_unpartitioned "
+                           "RENAME CONSTRAINT messages_pkey "
+                           "TO messages_unpartitioned_pkey"))
+    connection.execute(DDL("DROP INDEX IF EXISTS ix_messages_timestamp_id, "
+                           "ix_messages_user_id_timestamp_id"))
+    connection.execute(DDL("ALTER SEQUENCE messages_id_seq OWNED BY NONE"))
+
+    connection.execute(DDL("""
+        CREATE TABLE messages (
+            LIKE messages_unpartitioned INCLUDING DEFAULTS,
+            CONSTRAINT messages_pkey PRIMARY KEY (id, "timestamp"),
+            CONSTRAINT messages_user_id_fkey FOREIGN KEY (user_id)
+                REFERENCES users (id) ON DELETE CASCADE
+        ) PARTITION BY RANGE ("timestamp")"""))
+    connection.execute(DDL(
+        f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF messages DEFAULT"))
+
+    # every month from the oldest message on, plus the months ahead
+    oldest = connection.execute(
+        'SELECT min("timestamp") FROM messages_unpartitioned').scalar()
+    this_month = month_start(today or datetime.utcnow())
+    month = month_start(oldest) if oldest else this_month
+    while month <= add_months(this_month, ahead):
+        create_partition(connection, month)
+        month = add_months(month, 1)
+
+    copied = connection.execute(
+        "INSERT INTO messages SELECT * FROM messages_unpartitioned").rowcount
+    connection.execute(DDL("ALTER SEQUENCE messages_id_seq "
+                           "OWNED BY messages.id"))
+    connection.execute(DDL("DROP TABLE messages_unpartitioned"))
+
+    # on the parent, so every partition (and each new one) gets them
+    connection.execute(DDL('CREATE INDEX ix_messages_timestamp_id '
+                           'ON messages ("timestamp", id)'))
+    connection.execute(DDL('CREATE INDEX ix_messages_user_id_timestamp_id '
+                           'ON messages (user_id, "timestamp", id)'))
+    _create_cascade_trigger(connection)
+
+    connection.execute(DDL("ANALYZE messages"))
+    return copied
@@ -0,0 +1,214 @@
+"""Database connection pool settings, statement timeouts and pool metrics.
+
+Pool settings come from config (DB_POOL_SIZE, DB_MAX_OVERFLOW,
+DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING) and apply to every
+PostgreSQL engine, primary and replicas alike. Their pools are
+InstrumentedQueuePools, which count connects, closes and timeouts and time
+each checkout's wait; metrics() adds live gauges (checked out, overflow) and
+is served at /metrics.
+
+Each request's transactions run with `SET LOCAL statement_timeout` of
+DB_STATEMENT_TIMEOUT_MS, or what the view asked for with @statement_timeout.
+Background tasks and CLI commands aren't limited.
+
+warm_up() opens DB_POOL_WARMUP connections ahead of the first request. The
+app starts it in a background thread; under a pre-forking server, call it
+from the worker's post-fork hook instead, so connections aren't shared
+across processes.
+"""
+
+import threading
+import time
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+DEFAULT_POOL_TIMEOUT = 10
+DEFAULT_POOL_RECYCLE = 1800
+DEFAULT_STATEMENT_TIMEOUT_MS = 5000
+
+
+class PoolStats:
+    """Counters for one pool."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+        self.connects = 0
+        self.closes = 0
+
+    def record_wait(self, seconds):
+        with self.lock:
+            self.checkouts += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def bump(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def as_dict(self):
+        with self.lock:
+            return dict(
+                checkouts=self.checkouts,
+                wait_total_seconds=round(self.wait_total, 6),
+                wait_max_seconds=round(self.wait_max, 6),
+                timeouts=self.timeouts,
+                connects=self.connects,
+                closes=self.closes,
+            )
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long checkouts wait for a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+        event.listen(self, 'connect',
+                     lambda *args: self.stats.bump('connects'))
+        event.listen(self, 'close',
+                     lambda *args: self.stats.bump('closes'))
+        event.listen(self, 'close_detached',
+                     lambda *args: self.stats.bump('closes'))
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            # only the pool running dry; failed connects aren't timeouts
+            self.stats.bump('timeouts')
+            raise
+        finally:
+            self.stats.record_wait(time.perf_counter() - start)
+
+
+def apply_pool_options(app, sa_url, options):
+    """Fill in engine options for a PostgreSQL `sa_url` from app config."""
+
+    if not sa_url.drivername.startswith('postgres'):
+        return options
+
+    config = app.config
+    options.setdefault('poolclass', InstrumentedQueuePool)
+    options.setdefault('pool_size',
+                       config.get('DB_POOL_SIZE', DEFAULT_POOL_SIZE))
+    options.setdefault('max_overflow',
+                       config.get('DB_MAX_OVERFLOW', DEFAULT_MAX_OVERFLOW))
+    options.setdefault('pool_timeout',
+                       config.get('DB_POOL_TIMEOUT', DEFAULT_POOL_TIMEOUT))
+    options.setdefault('pool_recycle',
+                       config.get('DB_POOL_RECYCLE', DEFAULT_POOL_RECYCLE))
+    options.setdefault('pool_pre_ping', config.get('DB_POOL_PRE_PING', True))
+    return options
+
+
+##############################################################################
+# Statement timeouts
+
+
+def statement_timeout(milliseconds):
+    """Decorator giving a view its own statement timeout (0 for none)."""
+
+    def decorator(view):
+        view.statement_timeout_ms = milliseconds
+        return view
+    return decorator
+
+
+def _request_timeout_ms():
+    view = current_app.view_functions.get(request.endpoint)
+    timeout = getattr(view, 'statement_timeout_ms', None)
+    if timeout is None:
+        timeout = current_app.config.get('DB_STATEMENT_TIMEOUT_MS',
+                                         DEFAULT_STATEMENT_TIMEOUT_MS)
+    return timeout
+
+
+@event.listens_for(Engine, 'begin')
+def _set_statement_timeout(conn):
+    if conn.dialect.name != 'postgresql' or not has_request_context():
+        return
+
+    if 'statement_timeout_ms' not in g:
+        g.statement_timeout_ms = _request_timeout_ms()
+    if g.statement_timeout_ms:
+        # straight on the DBAPI connection, so it isn't counted as one of
+        # the request's queries (see instrumentation.py)
+        with conn.connection.cursor() as cursor:
+            cursor.execute("SET LOCAL statement_timeout = %s",
+                           (int(g.statement_timeout_ms),))
+
+
+##############################################################################
+# Metrics and warm-up
+
+
+def _engines(app):
+    from models import db
+
+    binds = [None] + sorted((app.config.get('SQLALCHEMY_BINDS') or {}))
+    for bind in binds:
+        yield bind or 'primary', db.get_engine(app, bind=bind)
+
+
+def metrics(app):
+    """Gauges and counters for each of the app's instrumented pools."""
+
+    pools = {}
+    for name, engine in _engines(app):
+        pool = engine.pool
+        if not isinstance(pool, InstrumentedQueuePool):
+            continue
+        pools[name] = dict(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+            **pool.stats.as_dict(),
+        )
+    return pools
+
+
+def warm_up(app, count=None):
+    """Open `count` (default DB_POOL_WARMUP) connections on each pool.
+
+    Failures are logged, not raised: a cold pool is only slower.
+    """
+
+    count = app.config.get('DB_POOL_WARMUP', 0) if count is None else count
+    opened = 0
+
+    for name, engine in _engines(app):
+        if not isinstance(engine.pool, QueuePool):
+            continue
+
+        connections = []
+        try:
+            for _ in range(min(count, engine.pool.size())):
+                connections.append(engine.connect())
+        except Exception:
+            app.logger.warning("Couldn't warm up the %s pool", name,
+                               exc_info=True)
+        finally:
+            opened += len(connections)
+            for connection in connections:
+                connection.close()
+
+    return opened
+
+
+def start_warm_up(app):
+    """Run warm_up() in a background thread, if DB_POOL_WARMUP is set."""
+
+    if app.config.get('DB_POOL_WARMUP', 0) > 0:
+        threading.Thread(target=warm_up, args=(app,), daemon=True,
+                         name='warbler-pool-warm-up').start()
@@ -0,0 +1,249 @@
+"""Deleting accounts: a soft delete now, the data purged in the background.
+
+delete_user() only stamps the user's deleted_at and records a UserPurge.
+From then on the account can't log in, and its profile, cards and directory
+entries are gone. purge_user() then deletes the account's data a batch of
+PURGE_BATCH_SIZE rows at a time, in this order:
+
+- messages: so they drop out of timelines first (their likes and timeline
+  entries go with them, by ON DELETE CASCADE)
+- archived: their messages in months detached from a partitioned
+  `messages` (see partitions.py), with those messages' likes and timeline
+  entries
+- likes the user made
+- following: the user's follows of others
+- followers: others' follows of the user
+- user: a last sweep of the above, then the users row itself
+
+Each batch is its own short transaction, which also keeps the affected
+users' counters in step and records progress on the UserPurge row, and
+the job pauses PURGE_BATCH_PAUSE_SECONDS between batches. Readers never
+wait on it (PostgreSQL readers don't block on deletes), and no one lock is
+held for long. Purges run from `flask purge-deleted-users` (e.g. from
+cron), not in the web process: one big account can take minutes, which
+would tie up the task pool that fan-out uses, and a restart would lose it.
+A purge that's interrupted picks up where it left off on the next run.
+"""
+
+import time
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import column, func, select, table
+
+from models import (db, _bump, _note_follow_change, Follows, Likes, Message,
+                    Timeline, User, UserPurge)
+import partitions
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_BATCH_PAUSE_SECONDS = 0.05
+
+STAGES = ('messages', 'archived', 'likes', 'following', 'followers', 'user')
+
+
+def soft_delete(user):
+    """Mark `user` deleted and queue their purge; the caller commits."""
+
+    user.deleted_at = datetime.utcnow()
+    if UserPurge.query.get(user.id) is None:
+        db.session.add(UserPurge(user_id=user.id))
+
+
+##############################################################################
+# One batch of each stage
+#
+# Each takes the connection, the user id and the batch size, deletes up to
+# that many rows, and returns how many it deleted.
+
+
+def _uncount_likes(connection, ids):
+    """Take the likes of messages `ids` off their likers' like_count."""
+
+    likes = Likes.__table__
+    likers = (select([likes.c.user_id, func.count().label('n')])
+              .where(likes.c.message_id.in_(ids))
+              .group_by(likes.c.user_id)
+              .alias('likers'))
+    users = User.__table__
+    connection.execute(
+        users.update()
+        .where(users.c.id.in_(select([likers.c.user_id])))
+        .values(like_count=users.c.like_count - (
+            select([likers.c.n])
+            .where(likers.c.user_id == users.c.id)
+            .as_scalar())))
+
+
+def _purge_messages(connection, user_id, limit):
+    messages = Message.__table__
+    ids = [message_id for (message_id,) in connection.execute(
+        select([messages.c.id])
+        .where(messages.c.user_id == user_id)
+        .order_by(messages.c.id)
+        .limit(limit))]
+    if not ids:
+        return 0
+
+    # un-count the likes that are about to cascade away
+    _uncount_likes(connection, ids)
+    connection.execute(messages.delete().where(messages.c.id.in_(ids)))
+    _bump(connection, 'message_count', user_id, -len(ids))
+    return len(ids)
+
+
+def _purge_archived(connection, user_id, limit):
+    # nothing cascades from a detached month, and its messages were taken
+    # off message_count when it was detached
+    deleted = 0
+    for qualified in partitions.detached_tables(connection):
+        schema, name = qualified.split('.')
+        month = table(name, column('id'), column('user_id'), schema=schema)
+        ids = [message_id for (message_id,) in connection.execute(
+            select([month.c.id])
+            .where(month.c.user_id == user_id)
+            .order_by(month.c.id)
+            .limit(limit - deleted))]
+        if not ids:
+            continue
+
+        _uncount_likes(connection, ids)
+        likes, timelines = Likes.__table__, Timeline.__table__
+        connection.execute(likes.delete().where(likes.c.message_id.in_(ids)))
+        connection.execute(
+            timelines.delete().where(timelines.c.message_id.in_(ids)))
+        connection.execute(month.delete().where(month.c.id.in_(ids)))
+
+        deleted += len(ids)
+        if deleted == limit:
+            break
+    return deleted
+
+
+def _purge_likes(connection, user_id, limit):
+    likes = Likes.__table__
+    ids = [like_id for (like_id,) in connection.execute(
+        select([likes.c.id])
+        .where(likes.c.user_id == user_id)
+        .limit(limit))]
+    if not ids:
+        return 0
+
+    connection.execute(likes.delete().where(likes.c.id.in_(ids)))
+    _bump(connection, 'like_count', user_id, -len(ids))
+    return len(ids)
+
+
+def _purge_follows(mine, theirs, my_count, their_count):
+    """A stage deleting the follows where `mine` is the user."""
+
+    def purge(connection, user_id, limit):
+        follows = Follows.__table__
+        other_ids = [other_id for (other_id,) in connection.execute(
+            select([follows.c[theirs]])
+            .where(follows.c[mine] == user_id)
+            .limit(limit))]
+        if not other_ids:
+            return 0
+
+        connection.execute(follows.delete().where(
+            (follows.c[mine] == user_id)
+            & follows.c[theirs].in_(other_ids)))
+        _bump(connection, their_count, other_ids, -1)
+        _bump(connection, my_count, user_id, -len(other_ids))
+
+        # a follower's own follows changed; see recommendations.py
+        if mine == 'user_being_followed_id':
+            _note_follow_change(connection, other_ids)
+        return len(other_ids)
+
+    return purge
+
+
+_STAGE_BATCHES = {
+    'messages': (_purge_messages, 'messages_deleted'),
+    'archived': (_purge_archived, 'messages_deleted'),
+    'likes': (_purge_likes, 'likes_deleted'),
+    'following': (_purge_follows('user_following_id',
+                                 'user_being_followed_id',
+                                 'following_count', 'follower_count'),
+                  'follows_deleted'),
+    'followers': (_purge_follows('user_being_followed_id',
+                                 'user_following_id',
+                                 'follower_count', 'following_count'),
+                  'follows_deleted'),
+}
+
+
+##############################################################################
+# The job
+
+
+def _drain(progress, stage, limit, pause):
+    """Run `stage`'s batches until there's nothing left for it to delete."""
+
+    batch, counter = _STAGE_BATCHES[stage]
+    while True:
+        deleted = batch(db.session.connection(), progress.user_id, limit)
+        setattr(progress, counter, getattr(progress, counter) + deleted)
+        db.session.commit()
+        if deleted < limit:
+            return
+        if pause:
+            time.sleep(pause)
+
+
+def purge_user(user_id):
+    """Purge a soft-deleted user's data, batch by batch; returns the UserPurge.
+
+    Safe to run again on a purge that was interrupted, or has finished.
+    """
+
+    config = current_app.config
+    limit = config.get('PURGE_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+    pause = config.get('PURGE_BATCH_PAUSE_SECONDS',
+                       DEFAULT_BATCH_PAUSE_SECONDS)
+
+    progress = UserPurge.query.get(user_id)
+    if progress is None or progress.finished_at is not None:
+        return progress
+
+    for stage in STAGES[STAGES.index(progress.stage):-1]:
+        progress.stage = stage
+        db.session.commit()
+        _drain(progress, stage, limit, pause)
+
+    progress.stage = 'user'
+    db.session.commit()
+
+    # anything still left would go by ON DELETE CASCADE with the user row,
+    # without un-counting it; normally these find nothing
+    for stage in STAGES[:-1]:
+        _drain(progress, stage, limit, pause)
+
+    users = User.__table__
+    db.session.connection().execute(
+        users.delete().where((users.c.id == user_id)
+                             & users.c.deleted_at.isnot(None)))
+    progress.finished_at = datetime.utcnow()
+    db.session.commit()
+
+    return progress
+
+
+def purge_pending(progress=None):
+    """Finish every purge that hasn't finished; returns how many there were.
+
+    Calls progress(purge) after each one.
+    """
+
+    user_ids = [user_id for (user_id,) in (
+        db.session.query(UserPurge.user_id)
+        .filter(UserPurge.finished_at.is_(None))
+        .order_by(UserPurge.requested_at))]
+
+    for user_id in user_ids:
+        finished = purge_user(user_id)
+        if progress:
+            progress(finished)
+
+    return len(user_ids)
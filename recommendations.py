@@ -0,0 +1,300 @@
+"""Who-to-follow recommendations, from friends of friends.
+
+`flask refresh-recommendations` is a batch job, meant for cron. It loads the
+whole follows table into a FollowGraph (compressed sparse rows: two flat
+integer arrays, not ORM objects) and suggests, for each user, the people
+most followed by the people they follow. The top RECOMMENDATIONS_PER_USER
+go in the `recommendations` table.
+
+After a first --full run, a run only refreshes users whose suggestions may
+have changed: anyone whose follows changed since the last run (Follows
+events note them in `follow_changes`; see models.py) and anyone following
+them. Follows removed along with a deleted user aren't noted; a periodic
+--full run catches those.
+
+The home page sidebar reads a user's suggestions with for_user(), which
+keeps them in an in-process cache for RECOMMENDATIONS_CACHE_TTL seconds and
+gives the query RECOMMENDATIONS_BUDGET_MS to answer on PostgreSQL; a slow
+or failed lookup just leaves the sidebar out.
+
+NumPy does the counting if it's installed; otherwise plain Python does.
+"""
+
+import heapq
+import logging
+import threading
+import time
+from array import array
+from collections import Counter
+from datetime import datetime
+from itertools import accumulate
+
+from flask import current_app
+from sqlalchemy import func, text
+from sqlalchemy.exc import DBAPIError
+
+from models import db, Follows, FollowChange, Recommendation, User
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - optional
+    np = None
+
+DEFAULT_PER_USER = 10
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_BUDGET_MS = 50
+DEFAULT_CACHE_TTL = 5 * 60
+DEFAULT_MAX_ENTRIES = 10000
+
+logger = logging.getLogger('warbler.recommendations')
+
+_cache = {}
+_lock = threading.Lock()
+
+
+##############################################################################
+# The follow graph
+
+
+class FollowGraph:
+    """Who follows whom, as compressed sparse rows.
+
+    The ids user #n follows are indices[indptr[n]:indptr[n + 1]], in order.
+    Rows are numbered by user id, so there are (highest user id + 1) of them.
+    """
+
+    def __init__(self, indptr, indices):
+        if np is not None:
+            # same memory, no copy
+            indptr = np.frombuffer(indptr, dtype=np.int64)
+            indices = np.frombuffer(indices, dtype=np.int64)
+        self.indptr = indptr
+        self.indices = indices
+
+    @classmethod
+    def load(cls, batch_size=DEFAULT_BATCH_SIZE):
+        """Read the follows table, streaming it in follower order."""
+
+        max_id = db.session.query(func.max(User.id)).scalar() or 0
+        counts = array('q', bytes(8 * (max_id + 2)))
+        indices = array('q')
+
+        rows = (db.session
+                .query(Follows.user_following_id,
+                       Follows.user_being_followed_id)
+                .order_by(Follows.user_following_id,
+                          Follows.user_being_followed_id)
+                .yield_per(batch_size))
+        for follower_id, followed_id in rows:
+            # users who signed up since we started wait for the next run
+            if follower_id <= max_id and followed_id <= max_id:
+                counts[follower_id + 1] += 1
+                indices.append(followed_id)
+
+        return cls(array('q', accumulate(counts)), indices)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def following(self, user_id):
+        """The ids `user_id` follows."""
+
+        if not 0 <= user_id < len(self):
+            return self.indices[:0]
+        return self.indices[self.indptr[user_id]:self.indptr[user_id + 1]]
+
+    def recommend(self, user_id, limit=DEFAULT_PER_USER):
+        """Up to `limit` (user id, score) pairs for `user_id`, best first.
+
+        A candidate's score is how many of the people `user_id` follows
+        follow them; ties go to the lower (older) id.
+        """
+
+        following = self.following(user_id)
+        if not len(following):
+            return []
+
+        if np is not None:
+            candidates = np.concatenate([self.following(followed_id)
+                                         for followed_id in following])
+            ids, counts = np.unique(candidates, return_counts=True)
+            keep = ~np.isin(ids, following) & (ids != user_id)
+            ids, counts = ids[keep], counts[keep]
+            best = np.lexsort((ids, -counts))[:limit]
+            return [(int(ids[i]), int(counts[i])) for i in best]
+
+        counts = Counter()
+        for followed_id in following:
+            counts.update(self.following(followed_id))
+
+        skip = set(following)
+        skip.add(user_id)
+        return heapq.nsmallest(
+            limit,
+            ((candidate, count) for candidate, count in counts.items()
+             if candidate not in skip),
+            key=lambda pair: (-pair[1], pair[0]))
+
+
+##############################################################################
+# Batch job
+
+
+def _chunks(ids, size):
+    ids = list(ids)
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def _with_followers(user_ids, batch_size):
+    """`user_ids`, plus everyone who follows any of them."""
+
+    affected = set(user_ids)
+    for chunk in _chunks(user_ids, batch_size):
+        affected.update(follower_id for (follower_id,) in (
+            db.session.query(Follows.user_following_id)
+            .filter(Follows.user_being_followed_id.in_(chunk))))
+    return affected
+
+
+def refresh(full=False, progress=None):
+    """Recompute recommendations; returns how many users were refreshed.
+
+    `full` redoes every user; otherwise only those affected by follow
+    changes since the last run. Results are written (and committed) in
+    batches of RECOMMENDATIONS_BATCH_SIZE users, calling progress(done,
+    total) after each.
+    """
+
+    config = current_app.config
+    per_user = config.get('RECOMMENDATIONS_PER_USER', DEFAULT_PER_USER)
+    batch_size = config.get('RECOMMENDATIONS_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+
+    # changes made after this are left for the next run
+    started = datetime.utcnow()
+    noted = FollowChange.query.filter(FollowChange.changed_at <= started)
+
+    if full:
+        user_ids = [user_id for (user_id,) in db.session.query(User.id)]
+    else:
+        changed = [user_id for (user_id,) in
+                   noted.with_entities(FollowChange.user_id)]
+        user_ids = _with_followers(changed, batch_size)
+    user_ids = sorted(user_ids)
+
+    if user_ids:
+        graph = FollowGraph.load(batch_size)
+        recommendations = Recommendation.__table__
+
+        done = 0
+        for chunk in _chunks(user_ids, batch_size):
+            rows = [dict(user_id=user_id, recommended_user_id=other_id,
+                         score=score)
+                    for user_id in chunk
+                    for other_id, score in graph.recommend(user_id, per_user)]
+
+            db.session.execute(recommendations.delete().where(
+                recommendations.c.user_id.in_(chunk)))
+            if rows:
+                db.session.execute(recommendations.insert(), rows)
+            db.session.commit()
+
+            done += len(chunk)
+            if progress:
+                progress(done, len(user_ids))
+
+    noted.delete(synchronize_session=False)
+    db.session.commit()
+    return len(user_ids)
+
+
+##############################################################################
+# Serving
+
+
+def _query(user_id, limit):
+    return (db.session
+            .query(User.id, User.username, User.image_url)
+            .join(Recommendation,
+                  Recommendation.recommended_user_id == User.id)
+            .filter(Recommendation.user_id == user_id,
+                    User.deleted_at.is_(None))
+            .order_by(Recommendation.score.desc(), User.id)
+            .limit(limit))
+
+
+def _load(user_id):
+    """Read `user_id`'s suggestions within the latency budget."""
+
+    config = current_app.config
+    query = _query(user_id, config.get('RECOMMENDATIONS_PER_USER',
+                                       DEFAULT_PER_USER))
+    budget = config.get('RECOMMENDATIONS_BUDGET_MS', DEFAULT_BUDGET_MS)
+
+    connection = db.session.connection()
+    if not budget or connection.dialect.name != 'postgresql':
+        return query.all()
+
+    # a tighter statement_timeout, just for this query; a timeout rolls the
+    # savepoint (and the SET) back, otherwise we put the old one back
+    try:
+        with db.session.begin_nested():
+            previous = connection.execute(
+                text("SHOW statement_timeout")).scalar()
+            set_timeout = text(
+                "SELECT set_config('statement_timeout', :value, true)")
+            connection.execute(set_timeout, value=f"{int(budget)}ms")
+            rows = query.all()
+            connection.execute(set_timeout, value=previous)
+        return rows
+    except DBAPIError:
+        logger.warning("Recommendations for #%s took over %sms; skipped",
+                       user_id, budget, exc_info=True)
+        return []
+
+
+def for_user(user_id):
+    """`user_id`'s suggestions, as (id, username, image_url) rows."""
+
+    with _lock:
+        entry = _cache.get(user_id)
+    if entry is not None and entry[0] >= time.monotonic():
+        return entry[1]
+
+    rows = _load(user_id)
+
+    config = current_app.config
+    ttl = config.get('RECOMMENDATIONS_CACHE_TTL', DEFAULT_CACHE_TTL)
+    if ttl > 0:
+        max_entries = config.get('RECOMMENDATIONS_CACHE_MAX_ENTRIES',
+                                 DEFAULT_MAX_ENTRIES)
+        with _lock:
+            _cache.pop(user_id, None)
+            # dicts keep insertion order, so the first key is the oldest
+            while len(_cache) >= max_entries:
+                del _cache[next(iter(_cache))]
+            _cache[user_id] = (time.monotonic() + ttl, rows)
+
+    return rows
+
+
+def clear_cache():
+    """Forget every cached user's suggestions."""
+
+    with _lock:
+        _cache.clear()
+
+
+def who_to_follow(user_context, limit=None):
+    """Suggestions to show the current user, minus anyone they now follow."""
+
+    limit = limit or current_app.config.get('RECOMMENDATIONS_SHOWN', 3)
+    following = user_context.following_ids
+    return [row for row in for_user(user_context.user.id)
+            if row.id not in following][:limit]
+
+
+def init_app(app):
+    """Make who_to_follow() available to templates."""
+
+    app.add_template_global(who_to_follow)
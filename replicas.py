@@ -0,0 +1,135 @@
+"""Read/write splitting across the primary and read replicas.
+
+Set SQLALCHEMY_REPLICA_URIS to a list of replica database URIs. Reads made
+while handling a GET (or HEAD) request then go to one of the replicas, picked
+at random per request; everything else goes to the primary: flushes, INSERT/
+UPDATE/DELETE statements, other methods' requests, and work outside a request
+(background tasks, CLI commands, scripts).
+
+Replicas lag, so a client that has just written is "sticky": its session
+cookie remembers to read from the primary for the next DB_STICKY_SECONDS,
+so e.g. the profile page messages_add() redirects to shows the new message.
+
+With no replicas configured, everything goes to the primary as before.
+"""
+
+import random
+import time
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, get_state
+from sqlalchemy import orm
+from sqlalchemy.sql.dml import UpdateBase
+
+import pooling
+
+DEFAULT_STICKY_SECONDS = 10
+
+STICKY_KEY = '_db_sticky_until'
+
+READ_METHODS = ('GET', 'HEAD')
+
+
+def replica_binds(app):
+    """Bind keys for the app's replicas, registering them on first use."""
+
+    uris = app.config.get('SQLALCHEMY_REPLICA_URIS') or []
+    binds = app.config.setdefault('SQLALCHEMY_BINDS', None) or {}
+
+    keys = []
+    for i, uri in enumerate(uris):
+        key = f"replica_{i}"
+        binds[key] = uri
+        keys.append(key)
+
+    app.config['SQLALCHEMY_BINDS'] = binds or None
+    return keys
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends a GET request's reads to a replica."""
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            note_write()
+        else:
+            replica = g.get('db_replica') if has_request_context() else None
+            if replica is not None:
+                return get_state(self.app).db.get_engine(self.app,
+                                                         bind=replica)
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, with sessions that route reads to replicas.
+
+    It also applies our connection pool settings to each engine.
+    """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        # pool settings for the primary and every replica; see pooling.py
+        sa_url, options = super().apply_driver_hacks(app, sa_url, options)
+        return sa_url, pooling.apply_pool_options(app, sa_url, options)
+
+
+def note_write():
+    """Remember that this request wrote, so the client reads its writes."""
+
+    if has_request_context():
+        g.db_wrote = True
+        # anything else this request reads should see the write, too
+        g.db_replica = None
+
+
+def write_connection(session):
+    """`session`'s connection to the primary, for Core writes run on it.
+
+    session.connection() can't tell a write is coming (get_bind() sees no
+    statement), so this notes one first; see note_write().
+    """
+
+    note_write()
+    return session.connection()
+
+
+def read_from_primary():
+    """Send the rest of this request's reads to the primary.
+
+    For reads of rows that were only just written, e.g. by another client,
+    which a lagging replica may not have yet.
+    """
+
+    if has_request_context():
+        g.db_replica = None
+
+
+def _choose_replica():
+    g.db_replica = None
+
+    if request.method not in READ_METHODS:
+        return
+    if session.get(STICKY_KEY, 0) > time.time():
+        return
+
+    binds = replica_binds(current_app)
+    if binds:
+        g.db_replica = random.choice(binds)
+
+
+def _stick_after_write(response):
+    if g.get('db_wrote'):
+        session[STICKY_KEY] = time.time() + current_app.config.get(
+            'DB_STICKY_SECONDS', DEFAULT_STICKY_SECONDS)
+    return response
+
+
+def init_app(app):
+    """Route each request's reads; call before other before_request hooks."""
+
+    replica_binds(app)
+    app.before_request(_choose_replica)
+    app.after_request(_stick_after_write)
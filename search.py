@@ -0,0 +1,270 @@
+"""Username search and the paged user directory.
+
+On PostgreSQL with the pg_trgm extension, substring searches are served by a
+trigram GIN index on users.username (created along with the tables, or by
+`flask create-search-index` for an existing database) and ranked in SQL.
+
+Anywhere else (SQLite test runs, or Postgres without pg_trgm) we keep an
+in-process trigram index of usernames instead. It's loaded on first use, and
+this process's own changes are patched in by the User mapper events below.
+Changes made elsewhere (another worker, seed.py, a script) show up once the
+index is older than SEARCH_INDEX_TTL seconds and gets reloaded.
+
+Either way, searches return at most SEARCH_MAX_RESULTS users, a page at a
+time.
+"""
+
+import threading
+import time
+from collections import defaultdict
+
+from flask import current_app
+from sqlalchemy import DDL, event, func
+
+from models import db, User
+
+DEFAULT_MAX_RESULTS = 100
+DEFAULT_PER_PAGE = 24
+DEFAULT_INDEX_TTL = 60
+
+TRIGRAM_INDEX_NAME = 'ix_users_username_trgm'
+
+
+def _config(key, default):
+    return current_app.config.get(key, default)
+
+
+def escape_like(text):
+    """Escape LIKE wildcards in user input (use with escape='\\')."""
+
+    return (text.replace('\\', '\\\\')
+                .replace('%', '\\%')
+                .replace('_', '\\_'))
+
+
+##############################################################################
+# Trigram index on PostgreSQL
+
+
+def trigram_available(connection):
+    """Can this database build pg_trgm indexes?"""
+
+    if connection.dialect.name != 'postgresql':
+        return False
+
+    return connection.execute(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    ).scalar() is not None
+
+
+def create_trigram_index(connection):
+    """Create pg_trgm and the username trigram index, if they're missing."""
+
+    connection.execute(DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    connection.execute(DDL(
+        f"CREATE INDEX IF NOT EXISTS {TRIGRAM_INDEX_NAME} "
+        "ON users USING gin (username gin_trgm_ops)"))
+
+
+@event.listens_for(User.__table__, 'after_create')
+def _users_created(target, connection, **kw):
+    if trigram_available(connection):
+        create_trigram_index(connection)
+
+
+_uses_trigram_index = {}
+
+
+def uses_trigram_index():
+    """Is pg_trgm installed in the app's database? (Checked once per engine.)"""
+
+    engine = db.engine
+    if engine not in _uses_trigram_index:
+        _uses_trigram_index[engine] = (
+            engine.dialect.name == 'postgresql' and
+            engine.execute("SELECT 1 FROM pg_extension "
+                           "WHERE extname = 'pg_trgm'").scalar() is not None)
+    return _uses_trigram_index[engine]
+
+
+def _search_ids_sql(search, limit):
+    """Ranked ids of users matching `search`, using the trigram index."""
+
+    term = search.lower()
+    username = func.lower(User.username)
+
+    return [user_id for (user_id,) in (
+        db.session
+        .query(User.id)
+        .filter(User.username.ilike(f"%{escape_like(search)}%", escape='\\'))
+        .order_by((username == term).desc(),
+                  username.like(f"{escape_like(term)}%", escape='\\').desc(),
+                  func.similarity(User.username, search).desc(),
+                  User.username)
+        .limit(limit))]
+
+
+##############################################################################
+# In-process fallback index
+
+
+def trigrams(text):
+    """Set of 3-character substrings of `text`."""
+
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class UsernameIndex:
+    """Trigram index of lowercased usernames, for substring search."""
+
+    def __init__(self):
+        self.usernames = {}
+        self.postings = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.usernames)
+
+    def add(self, user_id, username):
+        """Index (or re-index) one user."""
+
+        with self.lock:
+            self._remove(user_id)
+            username = username.lower()
+            self.usernames[user_id] = username
+            for gram in trigrams(username):
+                self.postings[gram].add(user_id)
+
+    def remove(self, user_id):
+        """Drop one user from the index."""
+
+        with self.lock:
+            self._remove(user_id)
+
+    def _remove(self, user_id):
+        old = self.usernames.pop(user_id, None)
+        if old is None:
+            return
+        for gram in trigrams(old):
+            self.postings[gram].discard(user_id)
+            if not self.postings[gram]:
+                del self.postings[gram]
+
+    def search(self, search, limit):
+        """Ranked ids of users whose username contains `search`.
+
+        Exact matches come first, then prefix matches, then earlier and
+        shorter matches.
+        """
+
+        term = search.lower()
+
+        with self.lock:
+            grams = trigrams(term)
+            if grams:
+                # every trigram of the term has to be in a matching name
+                lists = sorted((self.postings.get(gram, set())
+                                for gram in grams), key=len)
+                candidates = set.intersection(*lists)
+            else:
+                candidates = self.usernames.keys()
+
+            matches = [(self.usernames[user_id], user_id)
+                       for user_id in candidates
+                       if term in self.usernames[user_id]]
+
+        matches.sort(key=lambda match: (match[0] != term,
+                                        match[0].find(term),
+                                        len(match[0]),
+                                        match[0]))
+        return [user_id for _, user_id in matches[:limit]]
+
+
+_index = None
+_index_expires_at = 0
+_index_lock = threading.Lock()
+
+
+def get_username_index():
+    """The in-process username index, (re)loaded once it's SEARCH_INDEX_TTL old."""
+
+    global _index, _index_expires_at
+
+    with _index_lock:
+        if _index is None or _index_expires_at <= time.monotonic():
+            index = UsernameIndex()
+            for user_id, username in (db.session
+                                      .query(User.id, User.username)
+                                      .yield_per(10000)):
+                index.add(user_id, username)
+            _index = index
+            _index_expires_at = time.monotonic() + _config(
+                'SEARCH_INDEX_TTL', DEFAULT_INDEX_TTL)
+
+    return _index
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+def _user_saved(mapper, connection, user):
+    if _index is not None and user.username is not None:
+        _index.add(user.id, user.username)
+
+
+@event.listens_for(User, 'after_delete')
+def _user_deleted(mapper, connection, user):
+    if _index is not None:
+        _index.remove(user.id)
+
+
+##############################################################################
+# Public API
+
+
+def search_users(search, page=1):
+    """One page of users whose username contains `search`, best match first.
+
+    Returns (users, has_more). Only the first SEARCH_MAX_RESULTS matches are
+    ever paged through.
+    """
+
+    per_page = _config('USERS_PER_PAGE', DEFAULT_PER_PAGE)
+    limit = _config('SEARCH_MAX_RESULTS', DEFAULT_MAX_RESULTS)
+
+    if uses_trigram_index():
+        ids = _search_ids_sql(search, limit)
+    else:
+        ids = get_username_index().search(search, limit)
+
+    start = (max(page, 1) - 1) * per_page
+    page_ids = ids[start:start + per_page]
+
+    # the fallback index can lag a rolled-back or out-of-band change, so
+    # re-check the match against the rows we actually load
+    term = search.lower()
+    users = {user.id: user
+             for user in User.active().filter(User.id.in_(page_ids))
+             if term in user.username.lower()} if page_ids else {}
+
+    return ([users[user_id] for user_id in page_ids if user_id in users],
+            start + per_page < len(ids))
+
+
+def browse_users(after=None):
+    """One page of all users, in signup order, starting after id `after`.
+
+    Returns (users, next_after), where next_after is None on the last page.
+    """
+
+    per_page = _config('USERS_PER_PAGE', DEFAULT_PER_PAGE)
+
+    query = User.active()
+    if after:
+        query = query.filter(User.id > after)
+    users = query.order_by(User.id).limit(per_page + 1).all()
+
+    if len(users) > per_page:
+        users = users[:per_page]
+        return users, users[-1].id
+
+    return users, None
@@ -1,20 +1,266 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+    python seed.py [--users CSV] [--messages CSV] [--follows CSV]
+                   [--chunk-size N]
 
+Rows are streamed straight from the CSVs: on PostgreSQL with COPY FROM STDIN,
+elsewhere with chunked executemany INSERTs. Secondary indexes are dropped
+before each table is loaded and rebuilt afterwards, sequences are moved past
+the loaded ids, and the denormalized user counters are recomputed at the end.
+Every user who follows anyone is noted in follow_changes, so the next
+`flask refresh-recommendations` covers them.
+"""
 
-db.drop_all()
-db.create_all()
+import argparse
+import csv
+import os
+import sys
+import time
+from datetime import datetime
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+from sqlalchemy import literal, select
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+from app import app, db
+from models import User, Message, Follows, FollowChange
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+DEFAULT_CHUNK_SIZE = 10000
+PROGRESS_EVERY = 5  # seconds
 
-db.session.commit()
+TABLES = [
+    ('users', User.__table__, 'generator/users.csv'),
+    ('messages', Message.__table__, 'generator/messages.csv'),
+    ('follows', Follows.__table__, 'generator/follows.csv'),
+]
+
+
+class Progress:
+    """Prints how far through a table load we are, every few seconds."""
+
+    def __init__(self, name, total_bytes):
+        self.name = name
+        self.total_bytes = total_bytes or 1
+        self.start = self.last = time.monotonic()
+
+    def update(self, rows, bytes_read):
+        now = time.monotonic()
+        if now - self.last >= PROGRESS_EVERY:
+            self.last = now
+            print(f"  {self.name}: {rows or '?'} rows, "
+                  f"{100 * bytes_read / self.total_bytes:.0f}% "
+                  f"({self.rate(rows)})", file=sys.stderr)
+
+    def rate(self, rows):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        return f"{rows / elapsed:,.0f} rows/sec" if rows else "..."
+
+    def done(self, rows):
+        elapsed = time.monotonic() - self.start
+        print(f"{self.name}: {rows:,} rows in {elapsed:.1f}s "
+              f"({self.rate(rows)})")
+
+
+class _CountingFile:
+    """File wrapper that reports how much COPY has read so far."""
+
+    def __init__(self, file, progress):
+        self.file = file
+        self.progress = progress
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.bytes_read += len(data)
+        self.progress.update(None, self.bytes_read)
+        return data
+
+
+##############################################################################
+# Loading
+
+
+def copy_csv(connection, table, file, columns, progress):
+    """Stream a CSV into `table` with PostgreSQL's COPY FROM STDIN."""
+
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table.name} ({', '.join(columns)}) "
+        "FROM STDIN WITH (FORMAT csv)",
+        _CountingFile(file, progress))
+    return cursor.rowcount
+
+
+def _converters(table, columns):
+    """Per-column functions turning CSV text into what the DB driver expects.
+
+    Mirrors COPY's CSV rules: an empty field is NULL.
+    """
+
+    def converter(column):
+        if isinstance(column.type, db.DateTime):
+            parse = datetime.fromisoformat
+        else:
+            parse = str
+        return lambda value: parse(value) if value != '' else None
+
+    return [converter(table.c[name]) for name in columns]
+
+
+def insert_csv(connection, table, file, columns, progress, chunk_size):
+    """Stream a CSV into `table` with one executemany INSERT per chunk."""
+
+    rows = 0
+    bytes_read = 0
+    chunk = []
+    insert = table.insert()
+    converters = _converters(table, columns)
+
+    for values in csv.reader(file):
+        chunk.append({name: convert(value) for name, convert, value
+                      in zip(columns, converters, values)})
+        # close enough for a progress report
+        bytes_read += sum(map(len, values)) + len(values)
+        if len(chunk) >= chunk_size:
+            connection.execute(insert, chunk)
+            rows += len(chunk)
+            chunk = []
+            progress.update(rows, bytes_read)
+
+    if chunk:
+        connection.execute(insert, chunk)
+        rows += len(chunk)
+
+    return rows
+
+
+def load_table(name, table, path, chunk_size):
+    """Load one CSV into one table, with its secondary indexes dropped."""
+
+    with db.engine.begin() as connection:
+        dropped = drop_indexes(connection, table)
+
+        with open(path, newline='') as file:
+            columns = next(csv.reader([file.readline()]))
+            progress = Progress(name, os.path.getsize(path))
+
+            if connection.dialect.name == 'postgresql':
+                rows = copy_csv(connection, table, file, columns, progress)
+            else:
+                rows = insert_csv(connection, table, file, columns, progress,
+                                  chunk_size)
+
+        rebuild_indexes(connection, dropped)
+        reset_sequence(connection, table)
+
+    progress.done(rows)
+    return rows
+
+
+##############################################################################
+# Indexes and sequences
+
+
+def drop_indexes(connection, table):
+    """Drop `table`'s secondary indexes; returns what's needed to rebuild them.
+
+    Indexes that back a primary key or unique constraint are kept, since the
+    load relies on them.
+    """
+
+    if connection.dialect.name == 'postgresql':
+        indexes = connection.execute("""
+            SELECT i.indexname, i.indexdef
+              FROM pg_indexes i
+             WHERE i.tablename = %(table)s
+               AND NOT EXISTS (SELECT 1 FROM pg_constraint c
+                                WHERE c.conname = i.indexname)
+            """, table=table.name).fetchall()
+        for index_name, _ in indexes:
+            connection.execute(f'DROP INDEX "{index_name}"')
+        return [indexdef for _, indexdef in indexes]
+
+    indexes = [index for index in table.indexes if not index.unique]
+    for index in indexes:
+        index.drop(bind=connection)
+    return indexes
+
+
+def rebuild_indexes(connection, dropped):
+    """Recreate indexes removed by drop_indexes()."""
+
+    for index in dropped:
+        if isinstance(index, str):
+            connection.execute(index)
+        else:
+            index.create(bind=connection)
+
+
+def reset_sequence(connection, table):
+    """Move `table`'s id sequence past the largest id now in it (PostgreSQL)."""
+
+    if connection.dialect.name != 'postgresql' or 'id' not in table.c:
+        return
+
+    connection.execute(f"""
+        SELECT setval(pg_get_serial_sequence('{table.name}', 'id'),
+                      COALESCE(MAX(id), 1), MAX(id) IS NOT NULL)
+          FROM {table.name}
+        """)
+
+
+def note_followers():
+    """Note everyone who follows someone in follow_changes; returns how many."""
+
+    followers = (select([Follows.user_following_id,
+                         literal(datetime.utcnow())])
+                 .distinct())
+    with db.engine.begin() as connection:
+        return connection.execute(
+            FollowChange.__table__.insert().from_select(
+                ['user_id', 'changed_at'], followers)).rowcount
+
+
+##############################################################################
+# Script
+
+
+def seed(paths, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Recreate the tables and load them from `paths` ({table name: csv})."""
+
+    db.drop_all()
+    db.create_all()
+
+    start = time.monotonic()
+    total = sum(load_table(name, table, paths[name], chunk_size)
+                for name, table, _ in TABLES)
+
+    count = User.reconcile_counters()
+    db.session.commit()
+    print(f"Reconciled counters for {count:,} users")
+
+    # COPY and Core inserts skip the Follows events that note these
+    noted = note_followers()
+    print(f"Noted {noted:,} followers for `flask refresh-recommendations`")
+
+    elapsed = time.monotonic() - start
+    print(f"Loaded {total:,} rows in {elapsed:.1f}s "
+          f"({total / max(elapsed, 1e-9):,.0f} rows/sec)")
+
+    if app.config.get('TIMELINE_FANOUT_ENABLED'):
+        print("Timelines are empty; run `flask rebuild-timelines`")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    for name, _, path in TABLES:
+        parser.add_argument(f'--{name}', default=path,
+                            help=f"CSV for {name} (default: {path})")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="rows per INSERT when COPY isn't available")
+    args = parser.parse_args(argv)
+
+    seed({name: getattr(args, name) for name, _, _ in TABLES},
+         chunk_size=args.chunk_size)
+
+
+if __name__ == '__main__':
+    main()
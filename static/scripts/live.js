@@ -0,0 +1,72 @@
+// Live home timeline updates; see live.py.
+//
+// Listens on /stream for new messages from the people we follow, then
+// fetches just their cards from /timeline/items and puts them at the top of
+// the list. Only the first page of the timeline updates itself.
+
+(function () {
+  const list = document.getElementById('messages');
+  const params = new URLSearchParams(window.location.search);
+  if (!list || !window.EventSource || params.has('cursor')) {
+    return;
+  }
+
+  // message id -> fetches tried; ids stay here until their card arrives
+  const pending = new Map();
+  const MAX_TRIES = 5;
+  let timer = null;
+  let fetching = false;
+
+  function schedule(delay) {
+    if (timer === null && !fetching && pending.size) {
+      timer = setTimeout(fetchPending, delay);
+    }
+  }
+
+  async function fetchPending() {
+    timer = null;
+    fetching = true;
+    const ids = Array.from(pending.keys());
+    ids.forEach(function (id) { pending.set(id, pending.get(id) + 1); });
+
+    try {
+      const resp = await fetch('/timeline/items?ids=' + ids.join(','),
+                               {credentials: 'same-origin'});
+      if (resp.ok) {
+        const items = document.createElement('template');
+        items.innerHTML = await resp.text();
+        items.content.querySelectorAll('[data-message-id]').forEach(
+          function (item) { pending.delete(Number(item.dataset.messageId)); });
+        list.insertBefore(items.content, list.firstChild);
+      }
+    } catch (err) {
+      // offline for a moment; try again below
+    }
+
+    // the rest may not have reached the database we read from yet; give
+    // up on ones that never show (e.g. deleted since)
+    ids.forEach(function (id) {
+      if (pending.get(id) >= MAX_TRIES) {
+        pending.delete(id);
+      }
+    });
+    fetching = false;
+    schedule(1000);
+  }
+
+  const source = new EventSource('/stream');
+
+  source.addEventListener('message', function (e) {
+    const id = JSON.parse(e.data).id;
+    if (!pending.has(id)) {
+      pending.set(id, 0);
+    }
+    // a burst of messages turns into one request
+    schedule(250);
+  });
+
+  // we fell too far behind to catch up one message at a time
+  source.addEventListener('resync', function () {
+    window.location.reload();
+  });
+})();
@@ -0,0 +1,55 @@
+"""Background tasks for Warbler.
+
+Work that doesn't need to finish before we send a response (timeline fan-out,
+rebuilds, ...) is handed to a small thread pool so it runs off the request
+thread. Each task gets its own app context, and so its own DB session.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from models import db
+
+_executor = None
+
+
+def get_executor(app):
+    """Return the shared task executor, creating it on first use."""
+
+    global _executor
+
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=app.config.get('TASKS_MAX_WORKERS', 2),
+            thread_name_prefix='warbler-tasks',
+        )
+    return _executor
+
+
+def run_in_background(fn, *args, **kwargs):
+    """Run `fn(*args, **kwargs)` off the request thread.
+
+    If TASKS_ALWAYS_EAGER is set (handy for tests and CLI commands), the task
+    runs inline instead and its result is returned. Otherwise, returns a
+    Future for the task.
+    """
+
+    app = current_app._get_current_object()
+
+    if app.config.get('TASKS_ALWAYS_EAGER'):
+        return fn(*args, **kwargs)
+
+    return get_executor(app).submit(_run_task, app, fn, args, kwargs)
+
+
+def _run_task(app, fn, args, kwargs):
+    """Run a task inside its own app context, logging any failure."""
+
+    with app.app_context():
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            db.session.rollback()
+            app.logger.exception("Background task %s failed", fn.__name__)
+            raise
@@ -0,0 +1,205 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+#
+# Query budgets are read from the X-DB-Queries header instrumentation.py
+# adds to every response.
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from fragments import clear_fragment_cache
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['USER_CONTEXT_TTL'] = 0
+app.config['TESTING'] = True
+
+WRITE = {'X-Requested-With': 'fetch'}
+
+
+class APITestCase(TestCase):
+    """Do the API endpoints answer correctly, within their query budgets?"""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        clear_fragment_cache()
+
+        users = [User.signup(f"user{i}", f"user{i}@test.com", 'password', None)
+                 for i in range(6)]
+        db.session.commit()
+        self.me, *others = [user.id for user in users]
+        self.others = others
+
+        for other_id in others[:4]:
+            db.session.add(Follows(user_being_followed_id=other_id,
+                                   user_following_id=self.me))
+        db.session.add(Follows(user_being_followed_id=self.me,
+                               user_following_id=others[0]))
+        for i, other_id in enumerate(others):
+            db.session.add(Message(text=f"Warble {i}", user_id=other_id))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, client):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.me
+
+    def get(self, client, url):
+        resp = client.get(url)
+        self.assertEqual(resp.status_code, 200, resp.data)
+        return resp.get_json(), int(resp.headers['X-DB-Queries'])
+
+    def test_user_detail(self):
+        data, queries = self.get(self.client, f'/api/v1/users/{self.me}')
+        self.assertEqual(data['username'], 'user0')
+        self.assertEqual(data['following_count'], 4)
+        self.assertEqual(data['follower_count'], 1)
+        self.assertNotIn('email', data)
+        self.assertNotIn('password', data)
+        self.assertEqual(queries, 1)
+
+        resp = self.client.get('/api/v1/users/99999')
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.get_json()['error'], 'Not Found')
+
+    def test_users_batch(self):
+        ids = ','.join(map(str, [self.others[2], self.me, 99999]))
+        data, queries = self.get(self.client, f'/api/v1/users?ids={ids}')
+        self.assertEqual([user['username'] for user in data['users']],
+                         ['user3', 'user0'])
+        self.assertEqual(queries, 1)
+
+        ids = ','.join(map(str, [self.me] + self.others))
+        data, queries = self.get(self.client, f'/api/v1/users?ids={ids}')
+        self.assertEqual(len(data['users']), 6)
+        self.assertEqual(queries, 1)
+
+    def test_users_batch_limits(self):
+        self.assertEqual(self.client.get('/api/v1/users?ids=1,x').status_code,
+                         400)
+
+        app.config['API_MAX_BATCH'] = 2
+        try:
+            resp = self.client.get('/api/v1/users?ids=1,2,3')
+        finally:
+            app.config['API_MAX_BATCH'] = 100
+        self.assertEqual(resp.status_code, 400)
+
+    def test_timeline(self):
+        self.assertEqual(self.client.get('/api/v1/timeline').status_code, 401)
+
+        with self.client as c:
+            self.login(c)
+            data, queries = self.get(c, '/api/v1/timeline')
+
+            # four followed users, newest first
+            self.assertEqual([m['text'] for m in data['messages']],
+                             [f"Warble {i}" for i in (3, 2, 1, 0)])
+            self.assertEqual(set(data['users']),
+                             {str(user_id) for user_id in self.others[:4]})
+            self.assertIsNone(data['next_cursor'])
+
+            # a fixed budget, however many messages and authors come back
+            page, paged_queries = self.get(c, '/api/v1/timeline?limit=1')
+            self.assertEqual(len(page['messages']), 1)
+            self.assertEqual(paged_queries, queries)
+
+            rest, _ = self.get(
+                c, f"/api/v1/timeline?cursor={page['next_cursor']}")
+            self.assertEqual(len(rest['messages']), 3)
+
+        # user row + liked ids + followed ids, then the page
+        self.assertLessEqual(queries, 4)
+
+    def test_user_messages(self):
+        data, queries = self.get(self.client,
+                                 f'/api/v1/users/{self.others[0]}/messages')
+        self.assertEqual([m['text'] for m in data['messages']], ["Warble 0"])
+        self.assertEqual(queries, 2)
+
+        resp = self.client.get('/api/v1/users/99999/messages')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_relationships(self):
+        ids = ','.join(map(str, self.others))
+        with self.client as c:
+            self.login(c)
+            data, queries = self.get(c, f'/api/v1/relationships?ids={ids}')
+
+        found = {r['id']: (r['following'], r['followed_by'])
+                 for r in data['relationships']}
+        self.assertEqual(found[self.others[0]], (True, True))
+        self.assertEqual(found[self.others[3]], (True, False))
+        self.assertEqual(found[self.others[4]], (False, False))
+        self.assertLessEqual(queries, 4)
+
+    def test_like(self):
+        message_id = Message.query.filter_by(user_id=self.others[0]).one().id
+
+        with self.client as c:
+            self.login(c)
+
+            # writes need a header a cross-site form can't send
+            resp = c.post(f'/api/v1/messages/{message_id}/like')
+            self.assertEqual(resp.status_code, 400)
+
+            for _ in range(2):
+                resp = c.post(f'/api/v1/messages/{message_id}/like',
+                              headers=WRITE)
+                self.assertEqual(resp.get_json(), {'liked': True, 'count': 1})
+            self.assertEqual(User.query.get(self.me).like_count, 1)
+
+            data, _ = self.get(c, '/api/v1/timeline')
+            liked = {m['id']: m['liked'] for m in data['messages']}
+            self.assertTrue(liked[message_id])
+
+            resp = c.delete(f'/api/v1/messages/{message_id}/like',
+                            headers=WRITE)
+            self.assertEqual(resp.get_json(), {'liked': False, 'count': 0})
+            self.assertEqual(Likes.query.count(), 0)
+            self.assertEqual(User.query.get(self.me).like_count, 0)
+
+            resp = c.post('/api/v1/messages/99999/like', headers=WRITE)
+            self.assertEqual(resp.status_code, 404)
+
+    def test_follow(self):
+        other_id = self.others[4]
+
+        self.assertEqual(
+            self.client.post(f'/api/v1/users/{other_id}/follow',
+                             headers=WRITE).status_code, 401)
+
+        with self.client as c:
+            self.login(c)
+
+            for status in (201, 200):
+                resp = c.post(f'/api/v1/users/{other_id}/follow', json={})
+                self.assertEqual(resp.status_code, status)
+                self.assertEqual(resp.get_json(),
+                                 {'following': True, 'follower_count': 1})
+            self.assertEqual(User.query.get(self.me).following_count, 5)
+
+            resp = c.delete(f'/api/v1/users/{other_id}/follow', headers=WRITE)
+            self.assertEqual(resp.get_json(),
+                             {'following': False, 'follower_count': 0})
+            self.assertEqual(User.query.get(self.me).following_count, 4)
+
+            resp = c.post('/api/v1/users/99999/follow', headers=WRITE)
+            self.assertEqual(resp.status_code, 404)
+            resp = c.post(f'/api/v1/users/{self.me}/follow', headers=WRITE)
+            self.assertEqual(resp.status_code, 403)
@@ -0,0 +1,89 @@
+"""Static asset build tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+import assets
+import caching
+
+
+class AssetsTestCase(TestCase):
+    """Tests for build-assets, asset_url() and precompressed serving."""
+
+    def setUp(self):
+        self.original_static = app.static_folder
+        self.tmp = tempfile.mkdtemp()
+        self.static = os.path.join(self.tmp, 'static')
+        shutil.copytree(self.original_static, self.static)
+        app.static_folder = self.static
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.static_folder = self.original_static
+        shutil.rmtree(self.tmp)
+
+    def test_fallback_without_manifest(self):
+        with app.test_request_context():
+            self.assertEqual(assets.asset_url('stylesheets/style.css'),
+                             '/static/stylesheets/style.css')
+
+        resp = self.client.get('/users')
+        self.assertIn(b'href="/static/stylesheets/style.css"', resp.data)
+
+    def test_build(self):
+        manifest = assets.build(self.static)
+        css = manifest['stylesheets/style.css']
+        self.assertRegex(css, r'^dist/stylesheets/style\.[0-9a-f]{12}\.css$')
+
+        # image references in the stylesheet point at hashed names
+        with open(os.path.join(self.static, css)) as built:
+            self.assertIn(f"/static/{manifest['images/nav-bg.png']}",
+                          built.read())
+
+        # the same input builds the same names
+        self.assertEqual(assets.build(self.static), manifest)
+
+        with app.test_request_context():
+            self.assertEqual(assets.asset_url('stylesheets/style.css'),
+                             f'/static/{css}')
+            self.assertEqual(assets.asset_url('missing.js'),
+                             '/static/missing.js')
+
+    def test_serve_precompressed(self):
+        css = assets.build(self.static)['stylesheets/style.css']
+
+        resp = self.client.get(f'/static/{css}',
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        with open(os.path.join(self.static, css), 'rb') as built:
+            self.assertEqual(gzip.decompress(resp.data), built.read())
+        resp.close()
+
+        resp = self.client.get(f'/static/{css}')
+        self.assertNotIn('Content-Encoding', resp.headers)
+        resp.close()
+
+    def test_version(self):
+        with app.test_request_context():
+            self.assertEqual(assets.version(), '')
+            assets.build(self.static)
+            self.assertTrue(assets.version())
+
+            # a build is part of every page's ETag
+            etag = caching.etag_for('page')
+            os.remove(os.path.join(self.static, assets.DIST_DIR,
+                                   assets.MANIFEST_NAME))
+            self.assertNotEqual(caching.etag_for('page'), etag)
@@ -0,0 +1,67 @@
+"""Benchmark script tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_benchmark.py
+
+
+import json
+from unittest import TestCase
+
+import benchmark
+
+
+def run(**routes):
+    return dict(results={'server': routes})
+
+
+class SummarizeTestCase(TestCase):
+    """Are a route's latencies summed up right?"""
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(benchmark.percentile(values, 50), 50)
+        self.assertEqual(benchmark.percentile(values, 95), 95)
+        self.assertEqual(benchmark.percentile(values, 100), 100)
+        self.assertIsNone(benchmark.percentile([], 50))
+
+    def test_summarize(self):
+        result = benchmark.summarize([0.002, 0.001, 0.003, 0.004], 2.0, 10, 1)
+        self.assertEqual(result['requests'], 4)
+        self.assertEqual(result['errors'], 1)
+        self.assertEqual(result['p50_ms'], 2.0)
+        self.assertEqual(result['mean_ms'], 2.5)
+        self.assertEqual(result['throughput_rps'], 2.0)
+        self.assertEqual(result['sql_per_request'], 2.5)
+
+        # survives the round trip through a results file
+        self.assertEqual(json.loads(json.dumps(result)), result)
+
+    def test_no_samples(self):
+        result = benchmark.summarize([], 1.0, 0, 5)
+        self.assertIsNone(result['p95_ms'])
+        self.assertIsNone(result['sql_per_request'])
+        benchmark.print_row('server', 'home', result)
+
+
+class CompareTestCase(TestCase):
+    """Does --compare flag regressions, and only those?"""
+
+    def test_regressions(self):
+        baseline = run(home=dict(p95_ms=10.0, sql_per_request=4.0),
+                       users=dict(p95_ms=10.0, sql_per_request=4.0))
+        results = run(home=dict(p95_ms=11.0, sql_per_request=4.0),
+                      users=dict(p95_ms=10.0, sql_per_request=6.0),
+                      new=dict(p95_ms=99.0, sql_per_request=99.0))
+
+        self.assertEqual(benchmark.compare(results, baseline, 0.2),
+                         ["server users: sql_per_request 4.0 -> 6.0"])
+
+    def test_missing_numbers(self):
+        baseline = run(home=dict(p95_ms=None, sql_per_request=4.0),
+                       users=dict(p95_ms=10.0, sql_per_request=4.0))
+        results = run(home=dict(p95_ms=50.0, sql_per_request=4.0),
+                      users=dict(p95_ms=None, sql_per_request=None))
+
+        self.assertEqual(benchmark.compare(results, baseline, 0.2), [])
+        self.assertEqual(benchmark.compare(results, {}, 0.2), [])
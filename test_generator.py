@@ -0,0 +1,64 @@
+"""CSV generator tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_generator.py
+
+
+import filecmp
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+from unittest import TestCase, mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'generator'))
+
+import create_csvs
+from helpers import get_random_datetime
+
+
+class RandomDatetimeTestCase(TestCase):
+    """Are generated timestamps in range and repeatable?"""
+
+    def test_leap_day(self):
+        end = datetime(2024, 2, 29, 12, 0)
+        when = get_random_datetime(rng=random.Random(1), now=end)
+        self.assertLessEqual(when, end)
+        self.assertGreaterEqual(when, datetime(2022, 2, 28))
+
+    def test_independent_of_timezone(self):
+        end = datetime(2024, 3, 31, 1, 30)
+        seen = set()
+        for zone in ('UTC', 'America/New_York', 'Pacific/Auckland'):
+            with mock.patch.dict(os.environ, TZ=zone):
+                time.tzset()
+                seen.add(get_random_datetime(rng=random.Random('x'), now=end))
+        time.tzset()
+
+        self.assertEqual(len(seen), 1)
+
+
+class WorkersTestCase(TestCase):
+    """Is the output the same however many processes make it?"""
+
+    def generate(self, workers):
+        out = tempfile.TemporaryDirectory()
+        self.addCleanup(out.cleanup)
+        create_csvs.main([
+            '--users', '40', '--messages', '120', '--follows', '300',
+            '--power-law', '1.2', '--seed', 'test', '--end', '2024-02-29',
+            '--workers', str(workers), '--out', out.name])
+        return out.name
+
+    def test_workers_dont_change_output(self):
+        # small shards, so each table is split among the workers
+        with mock.patch.object(create_csvs, 'SHARD_SIZE', 7):
+            one, three = self.generate(1), self.generate(3)
+
+        for table in create_csvs.TABLES:
+            self.assertTrue(filecmp.cmp(os.path.join(one, f"{table}.csv"),
+                                        os.path.join(three, f"{table}.csv"),
+                                        shallow=False), table)
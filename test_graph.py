@@ -0,0 +1,203 @@
+"""Follow graph index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_graph.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from fragments import clear_fragment_cache
+import graph
+import purge
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['USER_CONTEXT_TTL'] = 0
+
+
+class GraphIndexTestCase(TestCase):
+    """Does the index answer from memory, stay current, and stay small?"""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        clear_fragment_cache()
+
+        self.index = graph.GraphIndex()
+        app.config['GRAPH_INDEX_TTL'] = 60
+
+        users = [User.signup(f"user{i}", f"user{i}@test.com", 'password', None)
+                 for i in range(5)]
+        db.session.commit()
+        self.ids = [user.id for user in users]
+        a, b, c, d, e = self.ids
+
+        # a -> b, c, d; b -> a; c -> a; e -> a
+        for follower, followed in ((a, b), (a, c), (a, d),
+                                   (b, a), (c, a), (e, a)):
+            db.session.add(Follows(user_following_id=follower,
+                                   user_being_followed_id=followed))
+        db.session.commit()
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.ctx.pop()
+        app.config['GRAPH_INDEX_TTL'] = 0
+        app.config['GRAPH_INDEX_MAX_BYTES'] = 64 * 1024 * 1024
+        graph.index.clear()
+
+    def test_reads(self):
+        a, b, c, d, e = self.ids
+
+        self.assertEqual(list(self.index.following(a)), [b, c, d])
+        self.assertEqual(list(self.index.followers(a)), [b, c, e])
+        self.assertEqual(list(self.index.mutuals(a)), [b, c])
+        self.assertTrue(self.index.is_following(a, d))
+        self.assertFalse(self.index.is_following(d, a))
+        self.assertEqual(self.index.followers_among(a, [b, d, e]), {b, e})
+        self.assertEqual(self.index.following_among(a, [b, e]), {b})
+
+        self.assertEqual(graph.page(self.index.following(a), 1, 2),
+                         (self.index.following(a)[:2], True))
+        self.assertEqual(list(graph.page(self.index.following(a), 2, 2)[0]),
+                         [d])
+
+    def test_answers_from_memory(self):
+        a, b, *_ = self.ids
+        self.index.following(a)
+        self.index.followers(a)
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            self.index.is_following(a, b)
+            self.index.mutuals(a)
+            graph.page(self.index.followers(a), 1, 10)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertEqual(statements, [])
+        self.assertEqual(self.index.stats()['hits'], 4)
+
+    def test_updates(self):
+        a, b, c, d, e = self.ids
+        self.index.following(d)
+        self.index.followers(e)
+
+        self.index.add(d, e)
+        self.index.add(d, e)
+        self.assertEqual(list(self.index.following(d)), [e])
+        self.assertEqual(list(self.index.followers(e)), [d])
+
+        self.index.remove(d, e)
+        self.assertEqual(list(self.index.following(d)), [])
+        self.assertEqual(list(self.index.followers(e)), [])
+
+    def test_change_while_loading(self):
+        a, b, c, d, e = self.ids
+
+        def follow_meanwhile(*args):
+            # as if d's follow of e committed just after the list was read
+            self.index.add(d, e)
+
+        event.listen(db.engine, 'after_cursor_execute', follow_meanwhile)
+        try:
+            self.assertEqual(list(self.index.following(d)), [])
+        finally:
+            event.remove(db.engine, 'after_cursor_execute', follow_meanwhile)
+
+        # the stale list isn't cached over the change
+        self.assertEqual(self.index.stats()['entries'], 0)
+        self.assertEqual(self.index.loading, {})
+
+    def test_large_ids(self):
+        a, b, c, d, e = self.ids
+        self.index.following(d)
+        self.index.add(d, 2 ** 40)
+        self.assertTrue(self.index.is_following(d, 2 ** 40))
+
+    def test_forget(self):
+        a, b, c, d, e = self.ids
+        self.index.following(a)
+        self.index.following(b)
+        self.index.followers(b)
+        self.index.followers(c)
+
+        # deleted, but not yet purged: the follows rows are still there
+        purge.soft_delete(User.query.get(a))
+        db.session.commit()
+        self.index.forget(a)
+
+        self.assertEqual(list(self.index.following(b)), [])
+        self.assertEqual(list(self.index.followers(c)), [])
+        self.assertEqual(self.index.stats()['misses'], 4)
+
+        # nor do they come back when a list is loaded again
+        self.index.clear()
+        self.assertEqual(list(self.index.following(b)), [])
+        self.assertEqual(list(self.index.followers(c)), [])
+
+    def test_memory_bounded(self):
+        a, b, c, d, e = self.ids
+        self.index.following(a)
+        one_list = self.index.stats()['bytes']
+        self.assertGreater(one_list, 0)
+
+        app.config['GRAPH_INDEX_MAX_BYTES'] = one_list * 2
+        for user_id in self.ids:
+            self.index.following(user_id)
+
+        stats = self.index.stats()
+        self.assertLessEqual(stats['bytes'], one_list * 2)
+        self.assertLessEqual(stats['entries'], 2)
+        self.assertGreater(stats['evictions'], 0)
+
+    def test_follow_pages(self):
+        a, b, _, _, e = self.ids
+        app.config['USERS_PER_PAGE'] = 2
+        client = app.test_client()
+
+        try:
+            with client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = a
+
+                html = c.get(f'/users/{a}/following').get_data(as_text=True)
+                self.assertIn('@user1', html)
+                self.assertIn('@user2', html)
+                self.assertNotIn('@user3', html)
+                self.assertIn(f'/users/{a}/following?page=2', html)
+
+                html = c.get(f'/users/{a}/following?page=2').get_data(
+                    as_text=True)
+                self.assertIn('@user3', html)
+                self.assertNotIn('page=3', html)
+
+                # the follow route keeps the shared index current
+                graph.index.following(a)
+                c.post(f'/users/follow/{e}')
+                self.assertTrue(graph.index.is_following(a, e))
+                c.post(f'/users/stop-following/{b}')
+                self.assertFalse(graph.index.is_following(a, b))
+        finally:
+            app.config['USERS_PER_PAGE'] = 24
+
+        self.assertEqual(Follows.query.filter_by(user_following_id=a).count(),
+                         3)
@@ -0,0 +1,134 @@
+"""SQL instrumentation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_instrumentation.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, Message, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import instrumentation
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['USER_CONTEXT_TTL'] = 0
+app.config['TESTING'] = True
+
+
+class FingerprintTestCase(TestCase):
+    """Tests for statement fingerprints."""
+
+    def test_literals_and_params(self):
+        self.assertEqual(
+            instrumentation.fingerprint(
+                "SELECT * FROM users\n  WHERE id = %(param_1)s AND bio = 'x'"),
+            "SELECT * FROM users WHERE id = ? AND bio = ?")
+        self.assertEqual(
+            instrumentation.fingerprint("SELECT 1 FROM t WHERE id IN (1, 2, 3)"),
+            instrumentation.fingerprint("SELECT 1 FROM t WHERE id IN (4)"))
+
+
+class InstrumentationTestCase(TestCase):
+    """Tests for per-request stats, headers and /metrics."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        instrumentation.reset_metrics()
+
+        self.client = app.test_client()
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        db.session.commit()
+        self.testuser_id = self.testuser.id
+
+    def tearDown(self):
+        app.config['METRICS_TOKEN'] = None
+        app.config['METRICS_ALLOW_LOCAL'] = False
+        app.config['TESTING'] = True
+        db.session.rollback()
+        db.session.remove()
+
+    def test_headers(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get('/')
+
+        self.assertGreater(int(resp.headers['X-DB-Queries']), 0)
+        self.assertIn('X-DB-Time-Ms', resp.headers)
+        self.assertIn('X-DB-Slowest-Ms', resp.headers)
+        self.assertNotIn('X-DB-N-Plus-One', resp.headers)
+
+    def test_n_plus_one(self):
+        with app.test_request_context('/'):
+            for _ in range(app.config['N_PLUS_ONE_THRESHOLD']):
+                User.query.filter_by(id=self.testuser_id).first()
+            db.session.execute("INSERT INTO messages (text, timestamp, user_id) "
+                               "VALUES ('hi', now(), :id)",
+                               dict(id=self.testuser_id))
+
+            stats = instrumentation.current_stats()
+            flagged = stats.n_plus_one(app.config['N_PLUS_ONE_THRESHOLD'])
+
+        self.assertEqual(len(flagged), 1)
+        self.assertTrue(flagged[0].startswith('SELECT users.id'))
+        self.assertIn('WHERE users.id = ?', flagged[0])
+
+    def test_headers_need_access(self):
+        app.config['TESTING'] = False
+        self.assertNotIn('X-DB-Queries', self.client.get('/users').headers)
+
+        app.config['METRICS_TOKEN'] = 'sekrit'
+        resp = self.client.get('/users',
+                               headers={'Authorization': 'Bearer sekrit'})
+        self.assertIn('X-DB-Queries', resp.headers)
+
+    def test_metrics(self):
+        app.config['METRICS_ALLOW_LOCAL'] = True
+        self.client.get('/users')
+        self.client.get('/users')
+
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+
+        routes = resp.get_json()['routes']
+        self.assertEqual(routes['GET /users']['requests'], 2)
+        self.assertGreater(routes['GET /users']['queries'], 0)
+        self.assertIn('hashing', resp.get_json())
+
+    def test_metrics_access(self):
+        # no one, without a token
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+        # only local requests, when those are allowed
+        app.config['METRICS_ALLOW_LOCAL'] = True
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+        resp = self.client.get('/metrics',
+                               environ_overrides={'REMOTE_ADDR': '203.0.113.9'})
+        self.assertEqual(resp.status_code, 403)
+
+        app.config['METRICS_TOKEN'] = 'sekrit'
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        resp = self.client.get('/metrics', environ_overrides={
+            'REMOTE_ADDR': '203.0.113.9'},
+            headers={'Authorization': 'Bearer sekrit'})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_slowest_is_fingerprinted(self):
+        with app.test_request_context('/'):
+            db.session.execute(
+                "SELECT id FROM users WHERE username = 'testuser'")
+            slowest = instrumentation.current_stats().slowest[1]
+
+        self.assertEqual(slowest, "SELECT id FROM users WHERE username = ?")
@@ -0,0 +1,159 @@
+"""Live timeline update tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_live.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from fragments import clear_fragment_cache
+import live
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['USER_CONTEXT_TTL'] = 0
+
+
+class BrokerTestCase(TestCase):
+    """Do brokers deliver events to the right subscriptions?"""
+
+    def test_local_broker(self):
+        broker = live.LocalBroker()
+        both = broker.subscribe([1, 2])
+        one = broker.subscribe([1])
+
+        broker.publish(2, {'id': 10})
+        broker.publish(3, {'id': 11})
+        broker.publish(1, {'id': 12})
+
+        self.assertEqual(both.get(0), {'id': 10})
+        self.assertEqual(both.get(0), {'id': 12})
+        self.assertIsNone(both.get(0))
+        self.assertEqual(one.get(0), {'id': 12})
+        self.assertIsNone(one.get(0))
+
+        both.close()
+        one.close()
+        self.assertEqual(broker.subscriptions, {})
+
+    def test_overflow_resyncs(self):
+        broker = live.LocalBroker(max_queued=2)
+        subscription = broker.subscribe([1])
+
+        for i in range(5):
+            broker.publish(1, {'id': i})
+
+        self.assertIs(subscription.get(0), live.RESYNC)
+        self.assertIsNone(subscription.get(0))
+        broker.publish(1, {'id': 5})
+        self.assertEqual(subscription.get(0), {'id': 5})
+
+    def test_postgres_broker(self):
+        broker = live.PostgresBroker(app)
+        subscription = broker.subscribe([7])
+        self.assertTrue(broker.listening.wait(5))
+
+        with app.app_context():
+            broker.publish(8, {'id': 1})
+            broker.publish(7, {'id': 2, 'user_id': 7})
+
+        self.assertEqual(subscription.get(5), {'id': 2, 'user_id': 7})
+        self.assertIsNone(subscription.get(0.2))
+        subscription.close()
+
+
+class LiveViewsTestCase(TestCase):
+    """Do new messages reach followers' streams, and their cards the page?"""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        clear_fragment_cache()
+
+        author = User.signup("Author", 'author@test.com', 'password', None)
+        fan = User.signup("Fan", 'fan@test.com', 'password', None)
+        other = User.signup("Other", 'other@test.com', 'password', None)
+        db.session.commit()
+        self.author_id, self.fan_id, self.other_id = (
+            author.id, fan.id, other.id)
+
+        db.session.add(Follows(user_being_followed_id=self.author_id,
+                               user_following_id=self.fan_id))
+        db.session.commit()
+
+        self.broker = live.LocalBroker()
+        app.config['LIVE_BROKER'] = self.broker
+        app.config['LIVE_KEEPALIVE_SECONDS'] = 0.05
+        app.config['LIVE_MAX_SECONDS'] = 0.3
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['LIVE_BROKER'] = live.LocalBroker()
+        app.config['LIVE_KEEPALIVE_SECONDS'] = 15
+        app.config['LIVE_MAX_SECONDS'] = 5 * 60
+
+    def login(self, client, user_id):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_messages_add_publishes(self):
+        fan = self.broker.subscribe([self.author_id])
+        other = self.broker.subscribe([self.other_id])
+
+        with self.client as c:
+            self.login(c, self.author_id)
+            c.post('/messages/new', data={"text": "Hot off the press"})
+
+        msg = Message.query.one()
+        self.assertEqual(fan.get(0), {'id': msg.id, 'user_id': self.author_id})
+        self.assertIsNone(other.get(0))
+
+    def test_stream(self):
+        self.assertEqual(self.client.get('/stream').status_code, 401)
+
+        with self.client as c:
+            self.login(c, self.fan_id)
+            resp = c.get('/stream')
+            self.assertEqual(resp.mimetype, 'text/event-stream')
+            self.assertIn('no-store', resp.headers['Cache-Control'])
+
+            # the stream is subscribed once the view has returned
+            self.broker.publish(self.other_id, {'id': 1, 'user_id': 2})
+            self.broker.publish(self.author_id,
+                                {'id': 42, 'user_id': self.author_id})
+            body = resp.get_data(as_text=True)
+
+        self.assertTrue(body.startswith('retry: '))
+        self.assertIn('id: 42\nevent: message\ndata: {"id": 42', body)
+        self.assertNotIn('id: 1\n', body)
+        self.assertIn(': keepalive', body)
+
+        # and it unsubscribed when it ended
+        self.assertEqual(self.broker.subscriptions, {})
+
+    def test_timeline_items(self):
+        mine = Message(text="From the author", user_id=self.author_id)
+        theirs = Message(text="From a stranger", user_id=self.other_id)
+        db.session.add_all([mine, theirs])
+        db.session.commit()
+        ids = f"{mine.id},{theirs.id},x"
+
+        with self.client as c:
+            self.login(c, self.fan_id)
+            resp = c.get(f'/timeline/items?ids={ids}')
+
+        html = resp.get_data(as_text=True)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("From the author", html)
+        self.assertNotIn("From a stranger", html)
+        self.assertEqual(html.count('<li'), 1)
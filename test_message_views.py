@@ -8,7 +8,9 @@
 import os
 from unittest import TestCase
 
-from models import db, Message, User
+from sqlalchemy import event
+
+from models import db, Message, User, Likes
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,6 +23,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+import fragments
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -32,6 +35,11 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# ids are reused between tests, so don't cache the current user's
+# likes/follows across requests
+
+app.config['USER_CONTEXT_TTL'] = 0
+
 
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
@@ -97,6 +105,47 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertNotIn('I like jellyfishing', html)
     
+    def test_delete_message_twice(self):
+        """Does a repeated delete 404 without un-counting again?"""
+        m2 = Message(text="Krabby patties", user_id=self.testuser.id)
+        db.session.add(m2)
+        db.session.commit()
+        uid, mid = self.testuser.id, m2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = uid
+
+            resp = c.post(f'/messages/{mid}/delete')
+            self.assertEqual(resp.status_code, 302)
+            resp = c.post(f'/messages/{mid}/delete')
+            self.assertEqual(resp.status_code, 404)
+
+        self.assertIsNone(Message.query.get(mid))
+        self.assertEqual(User.query.get(uid).message_count, 0)
+
+    def test_delete_message_drops_card(self):
+        """Does deleting a message drop its cached card, shared tier too?"""
+        backend = fragments.LocalBackend()
+        app.config['FRAGMENT_CACHE_BACKEND'] = backend
+        m2 = Message(text="Krabby patties", user_id=self.testuser.id)
+        db.session.add(m2)
+        db.session.commit()
+        uid, mid = self.testuser.id, m2.id
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = uid
+
+                c.get(f'/users/{uid}')
+                self.assertIn(f'message:{mid}', backend.data)
+
+                c.post(f'/messages/{mid}/delete')
+                self.assertNotIn(f'message:{mid}', backend.data)
+        finally:
+            app.config['FRAGMENT_CACHE_BACKEND'] = None
+
     def test_add_message_no_user(self):
         """Can a user add or delete a message when not logged in?"""
 
@@ -179,4 +228,42 @@ class MessageViewTestCase(TestCase):
             
             resp = c.get('/messages/999999999999')
 
-            self.assertEqual(resp.status_code, 404)
\ No newline at end of file
+            self.assertEqual(resp.status_code, 404)
+
+    def count_queries(self, url):
+        """How many SQL statements does a GET of `url` run?"""
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            resp = self.client.get(url)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertEqual(resp.status_code, 200)
+        return len(statements)
+
+    def test_likes_query_count(self):
+        """Do message authors load in batches, whatever the page size?"""
+        uid = self.testuser.id
+        for i in range(4):
+            author = User.signup(f"author{i}", f"author{i}@test.com", "password", None)
+            db.session.commit()
+            msg = Message(text=f"Message {i}", user_id=author.id)
+            db.session.add(msg)
+            db.session.commit()
+            db.session.add(Likes(user_id=uid, message_id=msg.id))
+            db.session.commit()
+
+        app.config['MESSAGES_PER_PAGE'] = 1
+        try:
+            one_per_page = self.count_queries(f'/messages/{uid}/likes')
+            app.config['MESSAGES_PER_PAGE'] = 4
+            four_per_page = self.count_queries(f'/messages/{uid}/likes')
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 100
+
+        self.assertEqual(one_per_page, four_per_page)
@@ -0,0 +1,252 @@
+"""Partitioned message storage tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_partitions.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Likes, Timeline
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+from fragments import clear_fragment_cache
+import partitions
+import purge
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['USER_CONTEXT_TTL'] = 0
+app.config['TESTING'] = True
+app.config['GRAPH_INDEX_TTL'] = 0
+
+
+def drop_leftovers():
+    """Drop the partitioned messages and any months detached from it."""
+
+    db.session.rollback()
+    with db.engine.begin() as connection:
+        connection.execute("DROP TABLE IF EXISTS messages CASCADE")
+        connection.execute(
+            f"DROP SCHEMA IF EXISTS {partitions.ARCHIVE_SCHEMA} CASCADE")
+        for (name,) in connection.execute(
+                "SELECT tablename FROM pg_tables WHERE schemaname = 'public' "
+                "AND tablename LIKE 'messages\\_%%'").fetchall():
+            connection.execute(f"DROP TABLE {name}")
+
+
+class PartitionsTestCase(TestCase):
+    """Is messages split by month, with the old months reached last?"""
+
+    def setUp(self):
+        drop_leftovers()
+        db.drop_all()
+        db.create_all()
+        clear_fragment_cache()
+
+        self.now = datetime.utcnow()
+        self.this_month = partitions.month_start(self.now)
+
+        author = User.signup("author", 'author@test.com', 'password', None)
+        fan = User.signup("fan", 'fan@test.com', 'password', None)
+        db.session.commit()
+        self.author_id, self.fan_id = author.id, fan.id
+
+        # days old: two in the last month, two long before
+        for days in (0, 10, 100, 400):
+            db.session.add(Message(text=f"{days} days old", user_id=author.id,
+                                   timestamp=self.now - timedelta(days=days)))
+        db.session.commit()
+
+        for msg in Message.query:
+            db.session.add(Likes(user_id=fan.id, message_id=msg.id))
+            db.session.add(Timeline(user_id=fan.id, message_id=msg.id,
+                                    timestamp=msg.timestamp))
+        db.session.commit()
+        db.session.close()
+
+    def tearDown(self):
+        app.config['MESSAGES_HOT_WINDOW_DAYS'] = 0
+        app.config['PURGE_BATCH_PAUSE_SECONDS'] = 0.05
+        drop_leftovers()
+
+    def partition(self):
+        with db.engine.begin() as connection:
+            return partitions.partition_messages(connection, ahead=2)
+
+    def partition_of(self, message_id):
+        return db.session.execute(
+            "SELECT tableoid::regclass::text FROM messages WHERE id = :id",
+            dict(id=message_id)).scalar()
+
+    def test_month_arithmetic(self):
+        month = partitions.month_start(datetime(2024, 11, 30, 23, 59))
+        self.assertEqual(month, datetime(2024, 11, 1).date())
+        self.assertEqual(partitions.add_months(month, 2),
+                         datetime(2025, 1, 1).date())
+        self.assertEqual(partitions.add_months(month, -11),
+                         datetime(2023, 12, 1).date())
+        self.assertEqual(partitions.partition_name(month), 'messages_2024_11')
+
+    def test_partition_messages(self):
+        self.assertEqual(self.partition(), 4)
+
+        with db.engine.connect() as connection:
+            self.assertTrue(partitions.is_partitioned(connection))
+            names = partitions.attached_partitions(connection)
+
+        oldest = partitions.month_start(self.now - timedelta(days=400))
+        self.assertEqual(names[0], partitions.partition_name(oldest))
+        self.assertEqual(names[-2], partitions.partition_name(
+            partitions.add_months(self.this_month, 2)))
+        self.assertEqual(names[-1], partitions.DEFAULT_PARTITION)
+
+        # a new message gets the next id and lands in this month
+        msg = Message(text="New", user_id=self.author_id)
+        db.session.add(msg)
+        db.session.commit()
+        self.assertGreater(msg.id, 4)
+        self.assertEqual(self.partition_of(msg.id),
+                         partitions.partition_name(self.this_month))
+        self.assertEqual(User.query.get(self.author_id).message_count, 5)
+
+        # the trigger stands in for the dropped foreign keys' cascade
+        old = Message.query.filter_by(text="400 days old").one()
+        db.session.delete(old)
+        db.session.commit()
+        self.assertEqual(Likes.query.count(), 3)
+        self.assertEqual(Timeline.query.count(), 3)
+        self.assertEqual(User.query.get(self.fan_id).like_count, 3)
+
+    def test_maintain(self):
+        self.partition()
+
+        # a message past the months that exist goes to the default partition
+        later = partitions.add_months(self.this_month, 4)
+        msg = Message(text="From the future", user_id=self.author_id,
+                      timestamp=datetime(later.year, later.month, 2))
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+        db.session.add(Likes(user_id=self.fan_id, message_id=msg_id))
+        db.session.commit()
+        self.assertEqual(self.partition_of(msg_id), partitions.DEFAULT_PARTITION)
+        db.session.close()
+
+        with db.engine.begin() as connection:
+            created, detached = partitions.maintain(
+                connection, ahead=4, keep_months=2, archive=True)
+
+        self.assertEqual(created, [
+            partitions.partition_name(partitions.add_months(self.this_month, n))
+            for n in (3, 4)])
+        # every month before the last two is gone, from 400 days ago on
+        oldest = partitions.month_start(self.now - timedelta(days=400))
+        self.assertEqual(detached[0], partitions.partition_name(oldest))
+        self.assertEqual(detached[-1], partitions.partition_name(
+            partitions.add_months(self.this_month, -3)))
+
+        # moved out of the default, and its like survived the move
+        self.assertEqual(self.partition_of(msg_id),
+                         partitions.partition_name(later))
+        self.assertEqual(Likes.query.filter_by(message_id=msg_id).count(), 1)
+
+        # archived rows are out of the site, but still there
+        self.assertEqual(Message.query.count(), 3)
+        self.assertEqual(db.session.execute(
+            f"SELECT count(*) FROM {partitions.ARCHIVE_SCHEMA}."
+            f"{detached[0]}").scalar(), 1)
+
+        # their author no longer counts them, as reconciling would agree
+        self.assertEqual(User.query.get(self.author_id).message_count, 3)
+        db.session.expire_all()
+        User.reconcile_counters()
+        db.session.commit()
+        self.assertEqual(User.query.get(self.author_id).message_count, 3)
+
+        # and a second run has nothing to do
+        db.session.close()
+        with db.engine.begin() as connection:
+            self.assertEqual(partitions.maintain(
+                connection, ahead=4, keep_months=2), ([], []))
+
+    def test_hot_window(self):
+        self.partition()
+        app.config['MESSAGES_HOT_WINDOW_DAYS'] = 30
+        client = app.test_client()
+        url = f'/api/v1/users/{self.author_id}/messages'
+
+        # the newest message and the one after it are in the window: one
+        # query finds the page and that there's more
+        resp = client.get(f'{url}?limit=1')
+        self.assertEqual([m['text'] for m in resp.get_json()['messages']],
+                         ["0 days old"])
+        hot_queries = int(resp.headers['X-DB-Queries'])
+
+        # two plus one to look ahead aren't, so this one reaches past it
+        resp = client.get(f'{url}?limit=2')
+        first = resp.get_json()
+        self.assertEqual([m['text'] for m in first['messages']],
+                         ["0 days old", "10 days old"])
+        self.assertEqual(int(resp.headers['X-DB-Queries']), hot_queries + 1)
+
+        resp = client.get(f"{url}?limit=2&cursor={first['next_cursor']}")
+        second = resp.get_json()
+        self.assertEqual([m['text'] for m in second['messages']],
+                         ["100 days old", "400 days old"])
+        self.assertIsNone(second['next_cursor'])
+
+        # with the window off, the same pages come back
+        app.config['MESSAGES_HOT_WINDOW_DAYS'] = 0
+        self.assertEqual(client.get(f'{url}?limit=2').get_json(), first)
+
+    def detach_old_months(self):
+        self.partition()
+        with db.engine.begin() as connection:
+            _, detached = partitions.maintain(
+                connection, ahead=2, keep_months=2, archive=True)
+        return detached
+
+    def test_like_needs_message(self):
+        self.detach_old_months()
+        archived_id = db.session.execute(
+            f"SELECT id FROM {partitions.ARCHIVE_SCHEMA}.messages_"
+            f"{partitions.month_start(self.now - timedelta(days=400)):%Y_%m}"
+        ).scalar()
+        other = User.signup("other", 'other@test.com', 'password', None)
+        db.session.commit()
+
+        self.assertFalse(Likes.like(other.id, archived_id))
+        self.assertFalse(Likes.like(other.id, 12345))
+        self.assertEqual(Likes.toggle(other.id, 12345), (False, 0))
+        recent = Message.query.filter_by(text="0 days old").one()
+        self.assertTrue(Likes.like(other.id, recent.id))
+        db.session.commit()
+
+        self.assertEqual(Likes.query.filter_by(user_id=other.id).count(), 1)
+        self.assertEqual(User.query.get(other.id).like_count, 1)
+
+    def test_purge_archived(self):
+        detached = self.detach_old_months()
+        self.assertTrue(detached)
+
+        author = User.query.get(self.author_id)
+        purge.soft_delete(author)
+        db.session.commit()
+        app.config['PURGE_BATCH_PAUSE_SECONDS'] = 0
+        with app.app_context():
+            progress = purge.purge_user(self.author_id)
+            self.assertIsNotNone(progress.finished_at)
+            self.assertEqual(progress.messages_deleted, 4)
+        for name in detached:
+            self.assertEqual(db.session.execute(
+                f"SELECT count(*) FROM {partitions.ARCHIVE_SCHEMA}.{name}"
+            ).scalar(), 0)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(Timeline.query.count(), 0)
+        self.assertEqual(User.query.get(self.fan_id).like_count, 0)
@@ -0,0 +1,87 @@
+"""Connection pool and statement timeout tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_pooling.py
+
+
+import os
+from unittest import TestCase
+
+import psycopg2
+from sqlalchemy import exc
+
+from models import db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+import pooling
+
+db.create_all()
+
+
+class PoolingTestCase(TestCase):
+    """Tests for pool settings, metrics, timeouts and warm-up."""
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+
+    def test_pool_settings(self):
+        pool = db.engine.pool
+        self.assertIsInstance(pool, pooling.InstrumentedQueuePool)
+        self.assertEqual(pool.size(), app.config['DB_POOL_SIZE'])
+        self.assertTrue(pool._pre_ping)
+
+    def test_statement_timeout(self):
+        with app.test_request_context('/'):
+            timeout = db.session.execute("SHOW statement_timeout").scalar()
+            self.assertEqual(timeout, '5s')
+            db.session.remove()
+
+        # outside a request there's no limit
+        self.assertEqual(db.session.execute("SHOW statement_timeout").scalar(),
+                         '0')
+
+    def test_metrics(self):
+        client = app.test_client()
+        client.get('/users')
+
+        app.config['METRICS_ALLOW_LOCAL'] = True
+        try:
+            pools = client.get('/metrics').get_json()['pools']
+        finally:
+            app.config['METRICS_ALLOW_LOCAL'] = False
+        self.assertGreater(pools['primary']['checkouts'], 0)
+        self.assertGreater(pools['primary']['connects'], 0)
+        self.assertIn('checked_out', pools['primary'])
+        self.assertIn('wait_max_seconds', pools['primary'])
+
+    def test_timeouts_counted(self):
+        pool = pooling.InstrumentedQueuePool(
+            lambda: psycopg2.connect(dbname='warbler_test'),
+            pool_size=1, max_overflow=0, timeout=0.01)
+        conn = pool.connect()
+        with self.assertRaises(exc.TimeoutError):
+            pool.connect()
+        conn.close()
+        pool.dispose()
+        self.assertEqual(pool.stats.timeouts, 1)
+
+        # a connection that fails isn't a timeout
+        def refuse():
+            raise psycopg2.OperationalError("connection refused")
+
+        broken = pooling.InstrumentedQueuePool(refuse, pool_size=1,
+                                               max_overflow=0)
+        with self.assertRaises(psycopg2.OperationalError):
+            broken.connect()
+        self.assertEqual(broken.stats.timeouts, 0)
+
+    def test_warm_up(self):
+        db.session.remove()
+        db.engine.dispose()
+
+        self.assertEqual(pooling.warm_up(app, 2), 2)
+        self.assertEqual(db.engine.pool.checkedin(), 2)
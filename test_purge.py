@@ -0,0 +1,195 @@
+"""Account deletion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_purge.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, UserPurge
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from fragments import clear_fragment_cache
+import purge
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['USER_CONTEXT_TTL'] = 0
+app.config['GRAPH_INDEX_TTL'] = 0
+
+
+class PurgeTestCase(TestCase):
+    """Is a deleted account hidden at once, then purged cleanly?"""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        clear_fragment_cache()
+
+        app.config['PURGE_BATCH_SIZE'] = 2
+        app.config['PURGE_BATCH_PAUSE_SECONDS'] = 0
+
+        victim = User.signup("Victim", 'victim@test.com', 'password', None)
+        fan = User.signup("Fan", 'fan@test.com', 'password', None)
+        friend = User.signup("Friend", 'friend@test.com', 'password', None)
+        db.session.commit()
+        self.victim_id, self.fan_id, self.friend_id = (
+            victim.id, fan.id, friend.id)
+
+        for i in range(5):
+            db.session.add(Message(text=f"Victim {i}", user_id=victim.id))
+        for i in range(3):
+            db.session.add(Message(text=f"Friend {i}", user_id=friend.id))
+        for follower, followed in ((victim, fan), (victim, friend),
+                                   (fan, victim), (friend, victim),
+                                   (fan, friend)):
+            db.session.add(Follows(user_following_id=follower.id,
+                                   user_being_followed_id=followed.id))
+        db.session.commit()
+
+        victims = Message.query.filter_by(user_id=victim.id).all()
+        friends = Message.query.filter_by(user_id=friend.id).all()
+        db.session.add_all(
+            [Likes(user_id=fan.id, message_id=m.id) for m in victims[:3]]
+            + [Likes(user_id=friend.id, message_id=victims[0].id)]
+            + [Likes(user_id=victim.id, message_id=m.id) for m in friends])
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['PURGE_BATCH_SIZE'] = 500
+        app.config['PURGE_BATCH_PAUSE_SECONDS'] = 0.05
+        app.config['TASKS_ALWAYS_EAGER'] = False
+
+    def counters(self):
+        return {user.id: (user.message_count, user.following_count,
+                          user.follower_count, user.like_count)
+                for user in User.query.order_by(User.id)}
+
+    def assert_counters_consistent(self):
+        db.session.expire_all()
+        kept = self.counters()
+        User.reconcile_counters()
+        db.session.flush()
+        db.session.expire_all()
+        self.assertEqual(kept, self.counters())
+        db.session.rollback()
+
+    def test_soft_delete_hides_account(self):
+        victim_message_id = Message.query.filter_by(
+            user_id=self.victim_id).first().id
+        with app.app_context():
+            purge.soft_delete(User.query.get(self.victim_id))
+            db.session.commit()
+
+        self.client.post('/login', data=dict(username="Victim",
+                                             password='password'))
+        with self.client.session_transaction() as sess:
+            self.assertNotIn(CURR_USER_KEY, sess)
+
+        self.assertEqual(
+            self.client.get(f'/users/{self.victim_id}').status_code, 404)
+        self.assertNotIn(b'@Victim', self.client.get('/users').data)
+        self.assertEqual(
+            self.client.get(f'/api/v1/users/{self.victim_id}').status_code,
+            404)
+
+        # an existing session for the account is as good as logged out
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.victim_id
+            resp = c.get('/messages/new')
+            self.assertEqual(resp.status_code, 302)
+
+        # nor do their messages, anywhere they'd be listed
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.fan_id
+            self.assertNotIn(b'Victim 0', c.get('/').data)
+            self.assertIn(b'Friend 0', c.get('/').data)
+            likes = c.get(f'/messages/{self.fan_id}/likes')
+            self.assertEqual(likes.status_code, 200)
+            self.assertNotIn(b'Victim 0', likes.data)
+            api_texts = [m['text'] for m in
+                         c.get('/api/v1/timeline').get_json()['messages']]
+            self.assertEqual(len(api_texts), 3)
+            self.assertNotIn(b'Victim', c.get(
+                f'/timeline/items?ids={victim_message_id}').data)
+
+        # nothing's been purged yet
+        self.assertEqual(Message.query.filter_by(
+            user_id=self.victim_id).count(), 5)
+        self.assertIsNone(UserPurge.query.get(self.victim_id).finished_at)
+
+    def test_purge_in_batches(self):
+        with app.app_context():
+            purge.soft_delete(User.query.get(self.victim_id))
+            db.session.commit()
+            progress = purge.purge_user(self.victim_id)
+
+            self.assertIsNotNone(progress.finished_at)
+            self.assertEqual(progress.stage, 'user')
+            self.assertEqual(progress.messages_deleted, 5)
+            self.assertEqual(progress.likes_deleted, 3)
+            self.assertEqual(progress.follows_deleted, 4)
+
+            # running it again is harmless
+            self.assertIs(purge.purge_user(self.victim_id), progress)
+
+        self.assertIsNone(User.query.get(self.victim_id))
+        self.assertEqual(Message.query.count(), 3)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 1)
+
+        fan = User.query.get(self.fan_id)
+        self.assertEqual((fan.following_count, fan.follower_count,
+                          fan.like_count), (1, 0, 0))
+        self.assert_counters_consistent()
+
+    def test_purge_pending(self):
+        with app.app_context():
+            purge.soft_delete(User.query.get(self.victim_id))
+            db.session.commit()
+
+            # as if a purge died part way through
+            app.config['PURGE_BATCH_SIZE'] = 500
+            progress = UserPurge.query.get(self.victim_id)
+            progress.stage = 'likes'
+            db.session.commit()
+
+            seen = []
+            self.assertEqual(purge.purge_pending(progress=seen.append), 1)
+            self.assertEqual([p.user_id for p in seen], [self.victim_id])
+            self.assertEqual(purge.purge_pending(), 0)
+
+        # it picked up at likes; the last sweep still found the messages
+        self.assertIsNone(User.query.get(self.victim_id))
+        self.assertEqual(Message.query.count(), 3)
+        self.assert_counters_consistent()
+
+    def test_delete_route(self):
+        app.config['TASKS_ALWAYS_EAGER'] = True
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.victim_id
+            resp = c.post('/users/delete')
+            self.assertEqual(resp.status_code, 302)
+
+        # the request only soft-deletes; the purge is left to the CLI
+        self.assertIsNotNone(User.query.get(self.victim_id).deleted_at)
+        self.assertIsNone(UserPurge.query.get(self.victim_id).finished_at)
+
+        result = app.test_cli_runner().invoke(args=['purge-deleted-users'])
+        self.assertIn('Purged 1 deleted users', result.output)
+        db.session.expire_all()
+        self.assertIsNone(User.query.get(self.victim_id))
+        self.assertIsNotNone(UserPurge.query.get(self.victim_id).finished_at)
+        self.assert_counters_consistent()
@@ -0,0 +1,134 @@
+"""Who-to-follow recommendation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recommendations.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Follows, FollowChange, Recommendation
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from fragments import clear_fragment_cache
+import recommendations
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['USER_CONTEXT_TTL'] = 0
+app.config['RECOMMENDATIONS_CACHE_TTL'] = 0
+
+
+class RecommendationsTestCase(TestCase):
+    """Are friends of friends suggested, and kept up to date?"""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        clear_fragment_cache()
+        recommendations.clear_cache()
+
+        users = [User.signup(name, f"{name}@test.com", 'password', None)
+                 for name in ('ann', 'bob', 'cat', 'dan', 'eve', 'fay')]
+        db.session.commit()
+        self.ann, self.bob, self.cat, self.dan, self.eve, self.fay = [
+            user.id for user in users]
+
+        # ann -> bob, cat; bob -> dan, eve, ann; cat -> dan
+        for follower, followed in ((self.ann, self.bob), (self.ann, self.cat),
+                                   (self.bob, self.dan), (self.bob, self.eve),
+                                   (self.bob, self.ann), (self.cat, self.dan)):
+            db.session.add(Follows(user_following_id=follower,
+                                   user_being_followed_id=followed))
+        db.session.commit()
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.ctx.pop()
+
+    def test_graph(self):
+        graph = recommendations.FollowGraph.load()
+
+        self.assertEqual(list(graph.following(self.ann)),
+                         sorted([self.bob, self.cat]))
+        self.assertEqual(list(graph.following(self.fay)), [])
+        self.assertEqual(list(graph.following(99999)), [])
+
+        # dan is followed by both of ann's follows; ann herself is skipped
+        self.assertEqual(graph.recommend(self.ann),
+                         [(self.dan, 2), (self.eve, 1)])
+        self.assertEqual(graph.recommend(self.ann, limit=1), [(self.dan, 2)])
+        self.assertEqual(graph.recommend(self.bob), [(self.cat, 1)])
+        self.assertEqual(graph.recommend(self.fay), [])
+
+    def test_full_refresh(self):
+        seen = []
+        count = recommendations.refresh(
+            full=True, progress=lambda done, total: seen.append((done, total)))
+
+        self.assertEqual(count, 6)
+        self.assertEqual(seen, [(6, 6)])
+        self.assertEqual(
+            [(row.id, row.username) for row in recommendations.for_user(
+                self.ann)],
+            [(self.dan, 'dan'), (self.eve, 'eve')])
+        self.assertEqual(FollowChange.query.count(), 0)
+
+    def test_incremental_refresh(self):
+        recommendations.refresh(full=True)
+
+        # fay is on nobody's path; cat's change reaches ann, who follows cat
+        db.session.add(Follows(user_following_id=self.cat,
+                               user_being_followed_id=self.fay))
+        db.session.commit()
+        self.assertEqual([change.user_id for change in FollowChange.query],
+                         [self.cat])
+
+        self.assertEqual(recommendations.refresh(), 2)
+        self.assertEqual(
+            [row.id for row in recommendations.for_user(self.ann)],
+            [self.dan, self.eve, self.fay])
+        self.assertEqual(FollowChange.query.count(), 0)
+
+        # nothing changed, nothing to do
+        self.assertEqual(recommendations.refresh(), 0)
+
+    def test_budget_restores_timeout(self):
+        recommendations.refresh(full=True)
+        before = db.session.execute("SHOW statement_timeout").scalar()
+
+        self.assertEqual(len(recommendations.for_user(self.ann)), 2)
+        self.assertEqual(db.session.execute("SHOW statement_timeout").scalar(),
+                         before)
+
+    def test_sidebar(self):
+        recommendations.refresh(full=True)
+        client = app.test_client()
+
+        with client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.ann
+            resp = c.get('/')
+            html = resp.get_data(as_text=True)
+            self.assertIn('Who to follow', html)
+            self.assertIn(f'action="/users/follow/{self.dan}"', html)
+
+            # and someone just followed drops out before the next refresh
+            c.post(f'/users/follow/{self.dan}')
+            html = c.get('/').get_data(as_text=True)
+            self.assertNotIn(f'action="/users/follow/{self.dan}"', html)
+            self.assertIn(f'action="/users/follow/{self.eve}"', html)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.fay
+            self.assertNotIn('Who to follow', c.get('/').get_data(as_text=True))
+
+        self.assertEqual(Recommendation.query.filter_by(
+            user_id=self.ann).count(), 2)
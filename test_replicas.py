@@ -0,0 +1,126 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+#
+# The "replica" is a SQLite file holding different data from the primary,
+# so we can tell which database a page was read from.
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from fragments import clear_fragment_cache
+import replicas
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['USER_CONTEXT_TTL'] = 0
+app.config['GRAPH_INDEX_TTL'] = 0
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Do GETs read from the replica, and writers from the primary?"""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        clear_fragment_cache()
+
+        self.tmp = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        app.config['SQLALCHEMY_REPLICA_URIS'] = [f"sqlite:///{self.tmp.name}"]
+        [bind] = replicas.replica_binds(app)
+        replica = db.get_engine(app, bind=bind)
+        db.Model.metadata.create_all(bind=replica)
+
+        self.user = User.signup("PrimaryUser", 'primary@test.com',
+                                'password', None)
+        self.other = User.signup("OtherUser", 'other@test.com',
+                                 'password', None)
+        db.session.commit()
+        self.user_id, self.other_id = self.user.id, self.other.id
+
+        # the replica has the same users, plus one the primary doesn't
+        with replica.begin() as connection:
+            for user in (self.user, self.other):
+                connection.execute(User.__table__.insert(), dict(
+                    id=user.id, username=user.username, email=user.email,
+                    password=user.password, image_url=user.image_url,
+                    header_image_url=user.header_image_url))
+            connection.execute(User.__table__.insert(), dict(
+                username="ReplicaOnly", email='replica@test.com',
+                password='x', image_url='', header_image_url=''))
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['SQLALCHEMY_REPLICA_URIS'] = []
+        db.session.rollback()
+        db.session.remove()
+        db.get_engine(app, bind='replica_0').dispose()
+        os.unlink(self.tmp.name)
+
+    def test_get_reads_replica(self):
+        resp = self.client.get('/users')
+        self.assertIn(b'@ReplicaOnly', resp.data)
+
+    def test_no_replicas(self):
+        app.config['SQLALCHEMY_REPLICA_URIS'] = []
+        resp = self.client.get('/users')
+        self.assertNotIn(b'@ReplicaOnly', resp.data)
+
+    def test_writes_go_to_primary_and_stick(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.post('/messages/new', data={"text": "Hello primary"})
+
+            # the write landed on the primary only
+            self.assertEqual(Message.query.one().text, "Hello primary")
+
+            # and we read it back from there
+            resp = c.get(f'/users/{self.user_id}')
+            self.assertIn(b'Hello primary', resp.data)
+            resp = c.get('/users')
+            self.assertNotIn(b'@ReplicaOnly', resp.data)
+
+            # until the stickiness wears off
+            with c.session_transaction() as sess:
+                sess['_db_sticky_until'] = 0
+            resp = c.get('/users')
+            self.assertIn(b'@ReplicaOnly', resp.data)
+
+    def test_follow_sticks(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.post(f'/users/follow/{self.other_id}')
+            self.assertEqual(Follows.query.count(), 1)
+
+            resp = c.get(f'/users/{self.user_id}/following')
+            self.assertIn(b'@OtherUser', resp.data)
+
+    def test_timeline_items_read_primary(self):
+        # announced over /stream before the replica has caught up
+        msg = Message(text="Just posted", user_id=self.user_id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.get(f'/timeline/items?ids={msg_id}')
+            self.assertIn(f'data-message-id="{msg_id}"',
+                          resp.get_data(as_text=True))
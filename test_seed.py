@@ -0,0 +1,105 @@
+"""CSV seeding tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_seed.py
+
+
+import csv
+import io
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message, Follows, FollowChange
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+import seed
+
+db.create_all()
+
+USERS = [
+    ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url',
+     'location'],
+    ['a@test.com', 'alpha', '/a.png', 'x', 'Hi', '/h.png', 'Salem'],
+    ['b@test.com', 'bravo', '/b.png', 'x', '', '/h.png', ''],
+    ['c@test.com', 'charlie', '/c.png', 'x', 'Yo', '/h.png', 'Oxford'],
+]
+
+MESSAGES = [
+    ['text', 'timestamp', 'user_id'],
+    ['First', '2024-01-01 10:00:00', '1'],
+    ['Second', '2024-01-02 10:00:00', '1'],
+    ['Third', '2024-02-29 23:59:59.5', '2'],
+]
+
+FOLLOWS = [
+    ['user_being_followed_id', 'user_following_id'],
+    ['1', '2'],
+    ['1', '3'],
+    ['2', '3'],
+]
+
+
+class SeedTestCase(TestCase):
+    """Does seeding load every row and leave the counters right?"""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.paths = {}
+        for name, rows in (('users', USERS), ('messages', MESSAGES),
+                           ('follows', FOLLOWS)):
+            path = os.path.join(self.dir.name, f"{name}.csv")
+            with open(path, 'w', newline='') as file:
+                csv.writer(file).writerows(rows)
+            self.paths[name] = path
+
+    def tearDown(self):
+        self.dir.cleanup()
+        db.session.rollback()
+
+    def test_seed(self):
+        seed.seed(self.paths)
+
+        self.assertEqual(User.query.count(), 3)
+        self.assertEqual(Message.query.count(), 3)
+        self.assertEqual(Follows.query.count(), 3)
+
+        # empty CSV fields are NULLs, as with COPY
+        self.assertIsNone(User.query.filter_by(username='bravo').one().bio)
+
+        counters = {user.username: (user.message_count, user.following_count,
+                                    user.follower_count, user.like_count)
+                    for user in User.query}
+        self.assertEqual(counters, {'alpha': (2, 0, 2, 0),
+                                    'bravo': (1, 1, 1, 0),
+                                    'charlie': (0, 2, 0, 0)})
+
+        # the sequences carry on after the loaded ids
+        user = User.signup('delta', 'd@test.com', 'password', None)
+        db.session.commit()
+        self.assertEqual(user.id, 4)
+
+        # and the next incremental refresh covers every follower
+        self.assertEqual(sorted(change.user_id
+                                for change in FollowChange.query), [2, 3])
+
+    def test_insert_csv(self):
+        """The executemany path, used where COPY isn't available."""
+        db.drop_all()
+        db.create_all()
+
+        file = io.StringIO()
+        csv.writer(file).writerows(USERS[1:])
+        file.seek(0)
+        progress = seed.Progress('users', 1)
+
+        with db.engine.begin() as connection:
+            rows = seed.insert_csv(connection, User.__table__, file,
+                                   USERS[0], progress, chunk_size=2)
+
+        self.assertEqual(rows, 3)
+        self.assertEqual(sorted(user.username for user in User.query),
+                         ['alpha', 'bravo', 'charlie'])
@@ -0,0 +1,196 @@
+"""Precomputed timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, HeavyPoster, Timeline
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import timeline
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['USER_CONTEXT_TTL'] = 0
+
+
+class TimelineTestCase(TestCase):
+    """Test fan-out-on-write timelines."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        app.config['TIMELINE_FANOUT_ENABLED'] = True
+        app.config['TASKS_ALWAYS_EAGER'] = True
+
+        self.author = User.signup('Spongebob', 'sponge@bikini-bottom.com', 'password', None)
+        self.fan = User.signup('Patrick', 'pat@bikini-bottom.com', 'password2', None)
+        self.other = User.signup('Squidward', 'squid@bikini-bottom.com', 'clarinet', None)
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=self.author.id,
+                               user_following_id=self.fan.id))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+        # timeline helpers read their settings from current_app
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        res = super().tearDown()
+        self.ctx.pop()
+        db.session.rollback()
+        app.config['TIMELINE_FANOUT_ENABLED'] = False
+        app.config['TASKS_ALWAYS_EAGER'] = False
+        app.config['TIMELINE_MAX_LENGTH'] = 800
+        app.config['TIMELINE_FANOUT_FOLLOWER_LIMIT'] = 5000
+        return res
+
+    def test_fanout_on_add(self):
+        """Does a new message land in the author's and followers' timelines?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.author.id
+
+            c.post("/messages/new", data={"text": "I'm ready!"})
+
+        msg = Message.query.one()
+        owners = {t.user_id for t in Timeline.query.filter_by(message_id=msg.id)}
+        self.assertEqual(owners, {self.author.id, self.fan.id})
+
+    def test_home_reads_timeline(self):
+        """Does the home page show fanned-out messages?"""
+        m = Message(text="Hello from the pineapple", user_id=self.author.id)
+        db.session.add(m)
+        db.session.commit()
+        timeline.fanout_message(m.id)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.fan.id
+
+            resp = c.get('/')
+            self.assertIn('Hello from the pineapple', resp.get_data(as_text=True))
+
+    def test_timeline_is_bounded(self):
+        """Are timelines trimmed to TIMELINE_MAX_LENGTH?"""
+        app.config['TIMELINE_MAX_LENGTH'] = 3
+
+        for i in range(5):
+            m = Message(text=f"Message {i}", user_id=self.author.id)
+            db.session.add(m)
+            db.session.commit()
+            timeline.fanout_message(m.id)
+
+        self.assertEqual(Timeline.query.filter_by(user_id=self.fan.id).count(), 3)
+
+    def test_heavy_poster_is_pulled(self):
+        """Are heavy posters skipped on write and pulled on read?"""
+        app.config['TIMELINE_FANOUT_FOLLOWER_LIMIT'] = 0
+
+        m = Message(text="Too popular to fan out", user_id=self.author.id)
+        db.session.add(m)
+        db.session.commit()
+        timeline.fanout_message(m.id)
+
+        self.assertEqual(Timeline.query.filter_by(user_id=self.fan.id).count(), 0)
+        self.assertEqual([msg.id for msg in timeline.home_timeline(self.fan.id).items], [m.id])
+
+    def test_heavy_poster_sticks(self):
+        """Are messages posted while heavy still seen once they're not?"""
+        def post(text):
+            m = Message(text=text, user_id=self.author.id)
+            db.session.add(m)
+            db.session.commit()
+            timeline.fanout_message(m.id)
+            return m.id
+
+        def home():
+            return [m.id for m in timeline.home_timeline(self.fan.id).items]
+
+        app.config['TIMELINE_FANOUT_FOLLOWER_LIMIT'] = 0
+        m1 = post("Heavy")
+
+        # one follower is back under the limit, but not under half of it
+        app.config['TIMELINE_FANOUT_FOLLOWER_LIMIT'] = 1
+        m2 = post("Still heavy")
+        self.assertIsNotNone(HeavyPoster.query.get(self.author.id))
+        self.assertEqual(Timeline.query.filter_by(user_id=self.fan.id).count(), 0)
+        self.assertEqual(home(), [m2, m1])
+
+        # well under it: the next message pushes the ones before it too
+        app.config['TIMELINE_FANOUT_FOLLOWER_LIMIT'] = 2
+        m3 = post("Light again")
+        self.assertIsNone(HeavyPoster.query.get(self.author.id))
+        self.assertEqual(
+            {t.message_id for t in Timeline.query.filter_by(user_id=self.fan.id)},
+            {m1, m2, m3})
+        self.assertEqual(home(), [m3, m2, m1])
+
+    def test_rebuild_timeline(self):
+        """Does a rebuild pick up messages from followed users only?"""
+        m1 = Message(text="Followed", user_id=self.author.id)
+        m2 = Message(text="Not followed", user_id=self.other.id)
+        db.session.add_all([m1, m2])
+        db.session.commit()
+
+        self.assertEqual(timeline.rebuild_timeline(self.fan.id), 1)
+        entries = Timeline.query.filter_by(user_id=self.fan.id).all()
+        self.assertEqual([e.message_id for e in entries], [m1.id])
+
+    def test_follow_merges_unfollow_removes(self):
+        """Does a follow merge in the user's messages, and an unfollow drop them?"""
+        m = Message(text="Tentacle practice", user_id=self.other.id)
+        db.session.add(m)
+        db.session.commit()
+        mid, other_id, fan_id = m.id, self.other.id, self.fan.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = fan_id
+
+            c.post(f'/users/follow/{other_id}')
+            self.assertEqual(
+                [t.message_id for t in Timeline.query.filter_by(user_id=fan_id)],
+                [mid])
+
+            c.post(f'/users/stop-following/{other_id}')
+            self.assertEqual(Timeline.query.filter_by(user_id=fan_id).count(), 0)
+
+    def test_rebuild_timelines(self):
+        """Does the backfill fill everyone's timeline and mark heavy posters?"""
+        app.config['TIMELINE_FANOUT_ENABLED'] = False
+        m = Message(text="Before fan-out", user_id=self.author.id)
+        db.session.add(m)
+        db.session.commit()
+        self.assertEqual(Timeline.query.count(), 0)
+
+        self.assertEqual(timeline.rebuild_timelines(), 3)
+        self.assertEqual({t.user_id for t in Timeline.query},
+                         {self.author.id, self.fan.id})
+        self.assertIsNone(HeavyPoster.query.get(self.author.id))
+
+        app.config['TIMELINE_FANOUT_FOLLOWER_LIMIT'] = 0
+        timeline.rebuild_timelines()
+        self.assertIsNotNone(HeavyPoster.query.get(self.author.id))
+
+    def test_fanout_retry(self):
+        """Is fanning out the same message twice harmless?"""
+        m = Message(text="Sent twice", user_id=self.author.id)
+        db.session.add(m)
+        db.session.commit()
+
+        timeline.rebuild_timeline(self.fan.id)
+        self.assertEqual(timeline.fanout_message(m.id), 2)
+        self.assertEqual(timeline.fanout_message(m.id), 2)
+        self.assertEqual(Timeline.query.filter_by(message_id=m.id).count(), 2)
@@ -6,10 +6,11 @@
 
 
 import os
-from unittest import TestCase
+from unittest import TestCase, mock
 from sqlalchemy import exc
 
-from models import db, User
+from models import db, User, Message, Follows, Likes
+import hashing
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
@@ -42,6 +43,7 @@ class UserModelTestCase(TestCase):
     def tearDown(self):
         res = super().tearDown()
         db.session.rollback()
+        db.session.remove()
         return res
 
     def test_user_model(self):
@@ -97,6 +99,96 @@ class UserModelTestCase(TestCase):
         self.assertTrue(self.u1.is_following(self.u2))
         self.assertFalse(self.u2.is_following(self.u1))
     
+    def test_follow_relationships(self):
+        """Does the batch lookup split following from followers?"""
+        u3 = User.signup('Squidward', 'squidward@bikini-bottom.com', 'clarinet', None)
+        db.session.commit()
+        db.session.add_all([
+            Follows(user_being_followed_id=self.u2.id, user_following_id=self.u1.id),
+            Follows(user_being_followed_id=self.u1.id, user_following_id=u3.id),
+        ])
+        db.session.commit()
+
+        following, followers = Follows.relationships(self.u1.id, [self.u2.id, u3.id])
+        self.assertEqual(following, {self.u2.id})
+        self.assertEqual(followers, {u3.id})
+
+        self.assertEqual(Follows.relationships(self.u1.id, []), (set(), set()))
+
+    #########
+    # Counter Tests
+    #########
+
+    def test_follow_counters(self):
+        """Are follow counts kept up to date?"""
+        f = Follows(user_being_followed_id=self.u2.id, user_following_id=self.u1.id)
+        db.session.add(f)
+        db.session.commit()
+
+        self.assertEqual(self.u1.following_count, 1)
+        self.assertEqual(self.u2.follower_count, 1)
+
+        db.session.delete(f)
+        db.session.commit()
+
+        self.assertEqual(self.u1.following_count, 0)
+        self.assertEqual(self.u2.follower_count, 0)
+
+    def test_message_and_like_counters(self):
+        """Does deleting a liked message update both counts?"""
+        m = Message(text="I'm ready!", user_id=self.u1.id)
+        db.session.add(m)
+        db.session.commit()
+        db.session.add(Likes(user_id=self.u2.id, message_id=m.id))
+        db.session.commit()
+
+        self.assertEqual(self.u1.message_count, 1)
+        self.assertEqual(self.u2.like_count, 1)
+
+        db.session.delete(m)
+        db.session.commit()
+
+        self.assertEqual(self.u1.message_count, 0)
+        self.assertEqual(self.u2.like_count, 0)
+
+    def test_reconcile_counters(self):
+        """Does reconciling fix counts changed behind the ORM's back?"""
+        self.u1.following.append(self.u2)
+        db.session.add(Message(text="Barnacles", user_id=self.u2.id))
+        db.session.commit()
+        self.assertEqual(self.u1.following_count, 0)
+
+        self.assertEqual(User.reconcile_counters(), 2)
+        db.session.commit()
+
+        self.assertEqual(self.u1.following_count, 1)
+        self.assertEqual(self.u2.follower_count, 1)
+        self.assertEqual(self.u2.message_count, 1)
+
+    def test_follow_is_idempotent(self):
+        """Does following twice add one row and count it once?"""
+        u1_id, u2_id = self.u1.id, self.u2.id
+        self.assertTrue(Follows.follow(u1_id, u2_id))
+        self.assertFalse(Follows.follow(u1_id, u2_id))
+        db.session.commit()
+
+        self.assertEqual(Follows.query.count(), 1)
+        self.assertEqual(User.query.get(u1_id).following_count, 1)
+        self.assertEqual(User.query.get(u2_id).follower_count, 1)
+
+    def test_migrate_counters(self):
+        """Does the migration add missing counter columns and fill them?"""
+        db.session.add(Message(text="Barnacles", user_id=self.u2.id))
+        db.session.commit()
+        db.session.execute("ALTER TABLE users DROP COLUMN message_count")
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=['migrate-counters'])
+        self.assertIn("reconciled them for 2 users", result.output)
+
+        db.session.expire_all()
+        self.assertEqual(User.query.get(2).message_count, 1)
+
     #########
     # Create User Tests
     #########
@@ -150,4 +242,60 @@ class UserModelTestCase(TestCase):
 
     def test_invalid_password(self):
         """Test invalid password"""
-        self.assertFalse(User.authenticate(self.u1.username, 'eurhger'))
\ No newline at end of file
+        self.assertFalse(User.authenticate(self.u1.username, 'eurhger'))
+
+    def test_authenticate_rehashes(self):
+        """Is an old-cost hash upgraded on login?"""
+        with app.app_context():
+            app.config['BCRYPT_LOG_ROUNDS'] = 4
+            try:
+                u_test = User.authenticate(self.u1.username, 'password')
+                db.session.commit()
+            finally:
+                app.config['BCRYPT_LOG_ROUNDS'] = 12
+
+            self.assertTrue(u_test.password.startswith('$2b$04$'))
+            self.assertTrue(User.authenticate(self.u1.username, 'password'))
+
+    def test_hashing_overloaded(self):
+        """Are hashes rejected once the queue is full?"""
+        pool, slots = hashing._get_pool()
+        taken = 0
+        while slots.acquire(blocking=False):
+            taken += 1
+        try:
+            with self.assertRaises(hashing.HashingOverloaded):
+                User.authenticate(self.u1.username, 'password')
+        finally:
+            for _ in range(taken):
+                slots.release()
+
+        self.assertEqual(hashing.metrics()['rejected'], 1)
+
+    def test_hashing_timeout(self):
+        """Is a hash that takes too long reported as overloaded?"""
+        timed_out = hashing.metrics()['timed_out']
+        with app.app_context():
+            app.config['PASSWORD_HASH_TIMEOUT'] = 0.001
+            try:
+                with self.assertRaises(hashing.HashingOverloaded):
+                    User.authenticate(self.u1.username, 'password')
+            finally:
+                app.config.pop('PASSWORD_HASH_TIMEOUT')
+
+        self.assertEqual(hashing.metrics()['timed_out'], timed_out + 1)
+
+    def test_rehash_skipped_when_overloaded(self):
+        """Does a login still succeed when the upgrade hash can't run?"""
+        old_hash = self.u1.password
+        with app.app_context():
+            app.config['BCRYPT_LOG_ROUNDS'] = 4
+            try:
+                with mock.patch.object(hashing, 'hash_password',
+                                       side_effect=hashing.HashingOverloaded):
+                    u_test = User.authenticate(self.u1.username, 'password')
+            finally:
+                app.config['BCRYPT_LOG_ROUNDS'] = 12
+
+        self.assertEqual(u_test.id, self.u1.id)
+        self.assertEqual(u_test.password, old_hash)
@@ -6,23 +6,36 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
 from sqlalchemy import exc
 from bs4 import BeautifulSoup
+from flask import g
 from models import db, User, Message, Follows, Likes
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 from app import CURR_USER_KEY, app, do_login
+from user_context import clear_user_context_cache
+from fragments import clear_fragment_cache
+import search
 
 db.create_all()
 
+app.config['WTF_CSRF_ENABLED'] = False
+
+# ids are reused after drop_all, so don't carry cached likes/follows
+# between tests
+app.config['USER_CONTEXT_TTL'] = 0
+app.config['GRAPH_INDEX_TTL'] = 0
+
 class UserViewsTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
 
         db.drop_all()
         db.create_all()
+        clear_fragment_cache()
 
         self.client = app.test_client()
 
@@ -71,6 +84,70 @@ class UserViewsTestCase(TestCase):
 
             self.assertNotIn('RickSanchez', html)
 
+    def test_user_search_ranking(self):
+        """Do exact and prefix matches come first?"""
+        User.signup("Smith", 'smith@gmail.com', 'agent1234', None)
+        User.signup("SmithJr", 'smithjr@gmail.com', 'agent1234', None)
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get('/users?q=smith')
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            names = [p.text for p in soup.select('.card-link p')]
+
+            self.assertEqual(names[:2], ['@Smith', '@SmithJr'])
+            self.assertEqual(len(names), 6)
+
+    def test_user_search_wildcards(self):
+        """Are LIKE wildcards in the query taken literally?"""
+        with self.client as c:
+            resp = c.get('/users?q=%25')
+            self.assertIn('Sorry, no users found', str(resp.data))
+
+    def test_username_index_reloads(self):
+        """Does the fallback index pick up users added by another process?"""
+        def add_elsewhere(username):
+            # a Core insert fires no mapper events, like another worker's
+            db.session.execute(User.__table__.insert().values(
+                username=username, email=f'{username}@gmail.com',
+                password='x', image_url='', header_image_url=''))
+            db.session.commit()
+
+        with app.app_context():
+            app.config['SEARCH_INDEX_TTL'] = 60
+            try:
+                search._index = None
+                search.get_username_index()
+                add_elsewhere('Squanchy')
+                self.assertEqual(
+                    search.get_username_index().search('squanch', 10), [])
+
+                # once it's expired, it's reloaded
+                search._index_expires_at = 0
+                self.assertEqual(
+                    len(search.get_username_index().search('squanch', 10)), 1)
+            finally:
+                app.config['SEARCH_INDEX_TTL'] = 60
+                search._index = None
+
+    def test_users_index_pages(self):
+        """Does the unfiltered listing page through everyone?"""
+        app.config['USERS_PER_PAGE'] = 2
+        try:
+            seen = []
+            url = '/users'
+            with self.client as c:
+                while url:
+                    soup = BeautifulSoup(c.get(url).data, 'html.parser')
+                    seen += [p.text for p in soup.select('.card-link p')]
+                    more = soup.find('a', id='more-users')
+                    url = more['href'] if more else None
+        finally:
+            app.config['USERS_PER_PAGE'] = 24
+
+        self.assertEqual(seen, ['@RickSanchez', '@MortySmith', '@SummerSmith',
+                                '@BethSmith', '@JerrySmith'])
+
     def test_show_user(self):
         """Does a specific user show up?"""
         with self.client as c:
@@ -80,6 +157,119 @@ class UserViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('RickSanchez', html)
 
+    def test_show_user_pages(self):
+        """Does 'load older' walk a profile page by page?"""
+        for i in range(5):
+            db.session.add(Message(text=f"Warble number {i}", user_id=self.testuser.id,
+                                   timestamp=datetime(2020, 1, i + 1)))
+        db.session.commit()
+
+        app.config['MESSAGES_PER_PAGE'] = 2
+        try:
+            seen = []
+            url = f'/users/{self.testuser.id}'
+            with self.client as c:
+                while url:
+                    resp = c.get(url)
+                    soup = BeautifulSoup(resp.data, 'html.parser')
+                    seen += [p.text for p in soup.select('.message-area p')]
+                    more = soup.find('a', id='load-older')
+                    url = more['href'] if more else None
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 100
+
+        self.assertEqual(seen, [f"Warble number {i}" for i in reversed(range(5))])
+
+    def test_profile_edit_refreshes_cards(self):
+        """Do cached message and user cards pick up a new username?"""
+        msg = Message(text="Wubba lubba dub dub", user_id=self.testuser.id)
+        db.session.add(msg)
+        db.session.commit()
+        uid = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = uid
+
+            html = str(c.get(f'/users/{uid}').data)
+            self.assertIn('@RickSanchez', html)
+            c.get('/users')
+
+            c.post(f'/users/{uid}/profile', data={
+                'username': 'PickleRick', 'email': 'rick@rick.gov',
+                'password': 'morty123'})
+
+            html = str(c.get(f'/users/{uid}').data)
+            self.assertIn('@PickleRick', html)
+            self.assertNotIn('@RickSanchez', html)
+            self.assertIn('Wubba lubba dub dub', html)
+
+            html = str(c.get('/users').data)
+            self.assertIn('@PickleRick', html)
+            self.assertNotIn('@RickSanchez', html)
+
+    def test_show_user_etag(self):
+        """Is an unchanged profile a 304, and a changed one re-rendered?"""
+        msg = Message(text="Wubba lubba dub dub", user_id=self.u1.id)
+        db.session.add(msg)
+        db.session.commit()
+        uid, u1_id, msg_id = self.testuser.id, self.u1.id, msg.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = uid
+
+            resp = c.get(f'/users/{u1_id}')
+            etag = resp.headers['ETag']
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('private', resp.headers['Cache-Control'])
+
+            resp = c.get(f'/users/{u1_id}', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b'')
+
+            # liking the message changes what the viewer sees
+            c.post(f'/messages/{msg_id}/like')
+            resp = c.get(f'/users/{u1_id}', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_etag_skipped_with_flashes(self):
+        """Does a page with a flash waiting render, instead of a 304?"""
+        u1_id = self.u1.id
+
+        with self.client as c:
+            etag = c.get(f'/users/{u1_id}').headers['ETag']
+
+            with c.session_transaction() as sess:
+                sess['_flashes'] = [('success', "Flashed once")]
+            resp = c.get(f'/users/{u1_id}', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b'Flashed once', resp.data)
+            self.assertNotIn('ETag', resp.headers)
+
+            # and once it's been shown, the page is cacheable again
+            resp = c.get(f'/users/{u1_id}', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+
+    def test_cache_headers(self):
+        """Are static files cacheable and anonymous pages revalidated?"""
+        with self.client as c:
+            resp = c.get('/static/stylesheets/style.css')
+            self.assertIn('public', resp.headers['Cache-Control'])
+            self.assertIn('max-age=3600', resp.headers['Cache-Control'])
+            resp.close()
+
+            resp = c.get('/users')
+            self.assertIn('no-cache', resp.headers['Cache-Control'])
+            self.assertNotIn('private', resp.headers['Cache-Control'])
+
+    def test_show_user_bad_cursor(self):
+        """Is a garbled cursor rejected?"""
+        with self.client as c:
+            resp = c.get(f'/users/{self.testuser.id}?cursor=not-a-cursor')
+            self.assertEqual(resp.status_code, 400)
+
 ######### Like view tests
     def setup_likes(self):
         """Likes for likes testing"""
@@ -117,6 +307,22 @@ class UserViewsTestCase(TestCase):
             # Likes:
             self.assertIn("1", found[3].text)
     
+    def test_likes_page_streams(self):
+        """Is the likes page streamed, with the liked messages on it?"""
+        self.setup_likes()
+        uid = self.testuser.id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = uid
+
+            resp = c.get(f'/messages/{uid}/likes')
+            self.assertTrue(resp.is_streamed)
+            html = resp.get_data(as_text=True)
+
+            self.assertIn('Aw geez...', html)
+            self.assertIn('@MortySmith', html)
+            self.assertNotIn('Wubba lubba dub dub!', html)
+
     def test_add_like(self):
         """Is a like added to a user's post?"""
         m2 = Message(id=2, text="Wubba lubba dub dub!", user_id=self.testuser.id)
@@ -148,6 +354,35 @@ class UserViewsTestCase(TestCase):
             likes = Likes.query.filter(Likes.message_id == m.id).all()
             self.assertEqual(len(likes), 0)
 
+    def test_like_json(self):
+        """Can several users like one message, getting state and count back?"""
+        m = Message(text="Wubba lubba dub dub!", user_id=self.testuser.id)
+        db.session.add(m)
+        db.session.commit()
+        mid, u1_id, u2_id = m.id, self.u1.id, self.u2.id
+
+        def toggle(user_id):
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+                return c.post(f'/messages/{mid}/like',
+                              headers={'Accept': 'application/json'}).get_json()
+
+        self.assertEqual(toggle(u1_id), dict(liked=True, count=1))
+        self.assertEqual(toggle(u2_id), dict(liked=True, count=2))
+        self.assertEqual(toggle(u1_id), dict(liked=False, count=1))
+
+        self.assertEqual(User.query.get(u1_id).like_count, 0)
+        self.assertEqual(User.query.get(u2_id).like_count, 1)
+
+    def test_like_missing_message(self):
+        """Is liking a message that doesn't exist a 404?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+            resp = c.post('/messages/99999/like')
+            self.assertEqual(resp.status_code, 404)
+
     def test_unauthenticated_like(self):
         """Does an unauthenticated like fail?"""
         self.setup_likes()
@@ -196,6 +431,39 @@ class UserViewsTestCase(TestCase):
             # Likes:
             self.assertIn("0", found[3].text)
 
+    def test_follow_twice(self):
+        """Is a repeated follow (e.g. from a stale page) harmless?"""
+        uid, u1_id = self.testuser.id, self.u1.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = uid
+
+            for _ in range(2):
+                resp = c.post(f'/users/follow/{u1_id}')
+                self.assertEqual(resp.status_code, 302)
+
+        self.assertEqual(Follows.query.count(), 1)
+        self.assertEqual(User.query.get(u1_id).follower_count, 1)
+
+    def test_unfollow_twice(self):
+        """Does a repeated unfollow 404 without un-counting again?"""
+        uid, u1_id = self.testuser.id, self.u1.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = uid
+
+            c.post(f'/users/follow/{u1_id}')
+            resp = c.post(f'/users/stop-following/{u1_id}')
+            self.assertEqual(resp.status_code, 302)
+            resp = c.post(f'/users/stop-following/{u1_id}')
+            self.assertEqual(resp.status_code, 404)
+
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(User.query.get(u1_id).follower_count, 0)
+        self.assertEqual(User.query.get(uid).following_count, 0)
+
     def test_show_following(self):
         """Do the correct 'following' users show?"""
         self.setup_follows()
@@ -230,6 +498,27 @@ class UserViewsTestCase(TestCase):
             self.assertIn('@BethSmith', html)
             self.assertNotIn('@JerrySmith', html)
 
+    def test_follow_invalidates_context(self):
+        """Does following someone show up straight away with the cache on?"""
+        clear_user_context_cache()
+        app.config['USER_CONTEXT_TTL'] = 30
+        uid = self.testuser.id
+        followed_id = self.u4.id
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = uid
+
+                c.get('/')
+                self.assertEqual(g.user_context.following_ids, frozenset())
+
+                c.post(f'/users/follow/{followed_id}')
+                c.get('/')
+                self.assertEqual(g.user_context.following_ids, {followed_id})
+        finally:
+            app.config['USER_CONTEXT_TTL'] = 0
+            clear_user_context_cache()
+
     def test_show_followers_unauthorized(self):
         """Can a user access a 'followers' page w/o credentials?"""
         self.setup_follows()
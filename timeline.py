@@ -0,0 +1,311 @@
+"""Fan-out-on-write home timelines.
+
+When TIMELINE_FANOUT_ENABLED is on, every new message is pushed into a bounded
+per-follower list (the `timelines` table) by a background task, and the home
+page reads that list instead of searching every followed user's messages.
+A follow merges the followed user's recent messages in, and an unfollow takes
+theirs out. Run `flask rebuild-timelines` when turning fan-out on for an
+existing database, or everyone's home timeline starts out empty.
+
+Authors with more than TIMELINE_FANOUT_FOLLOWER_LIMIT followers are not fanned
+out (one post would touch that many rows); they're recorded as heavy posters
+and their messages are pulled in at read time instead. The decision sticks
+until they're down to half the limit: the next message they post then pushes
+their recent messages to every follower, since none of the ones posted while
+they were heavy were, and they're pulled no longer.
+"""
+
+from flask import current_app
+from sqlalchemy import and_, func, or_, select, tuple_
+from sqlalchemy.dialects import postgresql
+
+from models import db, Follows, HeavyPoster, Message, Timeline, User
+from pagination import paginate
+import replicas
+
+DEFAULT_MAX_LENGTH = 800
+DEFAULT_FOLLOWER_LIMIT = 5000
+DEFAULT_BATCH_SIZE = 500
+
+
+def fanout_enabled():
+    """Is the precomputed timeline turned on for this app?"""
+
+    return current_app.config.get('TIMELINE_FANOUT_ENABLED', False)
+
+
+def _config(key, default):
+    return current_app.config.get(key, default)
+
+
+##############################################################################
+# Writes
+
+
+def _insert_entries(rows):
+    """Insert timeline entries, skipping any that are already there.
+
+    A retried fan-out, or one racing rebuild_timeline(), may write an entry
+    twice.
+    """
+
+    timelines = Timeline.__table__
+    connection = replicas.write_connection(db.session)
+    if connection.dialect.name == 'postgresql':
+        insert = postgresql.insert(timelines).on_conflict_do_nothing(
+            index_elements=[timelines.c.user_id, timelines.c.message_id])
+    else:
+        insert = timelines.insert().prefix_with('OR IGNORE')
+    connection.execute(insert, rows)
+
+
+def _set_heavy(user_id, heavy):
+    """Record whether `user_id` is a heavy poster; True if that changed."""
+
+    posters = HeavyPoster.__table__
+    connection = replicas.write_connection(db.session)
+    if not heavy:
+        return bool(connection.execute(
+            posters.delete().where(posters.c.user_id == user_id)).rowcount)
+
+    if connection.dialect.name == 'postgresql':
+        insert = postgresql.insert(posters).on_conflict_do_nothing()
+    else:
+        insert = posters.insert().prefix_with('OR IGNORE')
+    return bool(connection.execute(insert, dict(user_id=user_id)).rowcount)
+
+
+def fanout_message(message_id):
+    """Push a new message into its author's and followers' timelines.
+
+    Followers are written in batches of TIMELINE_FANOUT_BATCH_SIZE, each in its
+    own transaction, and each batch's timelines are trimmed back to
+    TIMELINE_MAX_LENGTH. Returns the number of timelines written to.
+    """
+
+    msg = (db.session
+           .query(Message.id, Message.user_id, Message.timestamp)
+           .filter(Message.id == message_id)
+           .first())
+
+    if msg is None:
+        return 0
+
+    limit = _config('TIMELINE_FANOUT_FOLLOWER_LIMIT', DEFAULT_FOLLOWER_LIMIT)
+    follower_ids = [user_id for (user_id,) in (
+        db.session
+        .query(Follows.user_following_id)
+        .filter(Follows.user_being_followed_id == msg.user_id)
+        .limit(limit + 1))]
+
+    entries = [(msg.id, msg.timestamp)]
+    was_heavy = HeavyPoster.query.get(msg.user_id) is not None
+
+    # heavy posters only go into their own timeline; followers pull them
+    if len(follower_ids) > limit or (was_heavy and
+                                     len(follower_ids) > limit // 2):
+        _set_heavy(msg.user_id, True)
+        follower_ids = []
+    elif was_heavy and _set_heavy(msg.user_id, False):
+        # back to fan-out: push what followers were pulling until now
+        entries = _newest_by(msg.user_id)
+
+    user_ids = [msg.user_id] + follower_ids
+    batch_size = _config('TIMELINE_FANOUT_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+        _insert_entries([
+            dict(user_id=user_id, message_id=message_id, timestamp=timestamp)
+            for user_id in batch
+            for message_id, timestamp in entries
+        ])
+        trim_timelines(batch)
+        db.session.commit()
+
+    return len(user_ids)
+
+
+def _newest_by(user_id):
+    """(id, timestamp) of `user_id`'s newest TIMELINE_MAX_LENGTH messages."""
+
+    return db.session.execute(
+        select([Message.id, Message.timestamp])
+        .where(Message.user_id == user_id)
+        .order_by(Message.timestamp.desc(), Message.id.desc())
+        .limit(_config('TIMELINE_MAX_LENGTH', DEFAULT_MAX_LENGTH))
+    ).fetchall()
+
+
+def trim_timelines(user_ids):
+    """Drop entries past TIMELINE_MAX_LENGTH from these users' timelines."""
+
+    ranked = (select([
+        Timeline.user_id,
+        Timeline.message_id,
+        func.row_number().over(
+            partition_by=Timeline.user_id,
+            order_by=(Timeline.timestamp.desc(), Timeline.message_id.desc()),
+        ).label('position'),
+    ])
+        .where(Timeline.user_id.in_(user_ids))
+        .alias('ranked'))
+
+    overflow = (select([ranked.c.user_id, ranked.c.message_id])
+                .where(ranked.c.position >
+                       _config('TIMELINE_MAX_LENGTH', DEFAULT_MAX_LENGTH)))
+
+    db.session.execute(
+        Timeline.__table__.delete().where(
+            tuple_(Timeline.user_id, Timeline.message_id).in_(overflow)))
+
+
+def _follows(user_id, followed_id):
+    return db.session.query(Follows.query.filter_by(
+        user_following_id=user_id,
+        user_being_followed_id=followed_id).exists()).scalar()
+
+
+def add_followed(user_id, followed_id):
+    """Merge `followed_id`'s newest messages into `user_id`'s timeline.
+
+    Run after a follow. A heavy poster's messages are pulled anyway, and so
+    are left out. Returns the number of entries written.
+    """
+
+    # the follow may have been undone since this was queued
+    if (HeavyPoster.query.get(followed_id) is not None
+            or not _follows(user_id, followed_id)):
+        return 0
+
+    entries = _newest_by(followed_id)
+    if entries:
+        _insert_entries([
+            dict(user_id=user_id, message_id=message_id, timestamp=timestamp)
+            for message_id, timestamp in entries
+        ])
+        trim_timelines([user_id])
+    db.session.commit()
+
+    return len(entries)
+
+
+def remove_followed(user_id, followed_id):
+    """Take `followed_id`'s messages out of `user_id`'s timeline.
+
+    Run after an unfollow. Returns the number of entries removed.
+    """
+
+    if _follows(user_id, followed_id):
+        return 0
+
+    mine = select([Timeline.message_id]).where(Timeline.user_id == user_id)
+    theirs = select([Message.id]).where(and_(Message.user_id == followed_id,
+                                             Message.id.in_(mine)))
+    removed = db.session.execute(Timeline.__table__.delete().where(and_(
+        Timeline.user_id == user_id,
+        Timeline.message_id.in_(theirs)))).rowcount
+    db.session.commit()
+
+    return removed
+
+
+def rebuild_timeline(user_id):
+    """Recompute one user's timeline from `follows` and `messages`.
+
+    Used by the `flask rebuild-timeline(s)` commands. Returns the number of
+    entries written.
+    """
+
+    followed = (select([Follows.user_being_followed_id])
+                .where(Follows.user_following_id == user_id))
+
+    newest = (select([Message.id, Message.timestamp])
+              .where(or_(Message.user_id.in_(followed),
+                         Message.user_id == user_id))
+              .order_by(Message.timestamp.desc(), Message.id.desc())
+              .limit(_config('TIMELINE_MAX_LENGTH', DEFAULT_MAX_LENGTH)))
+
+    rows = db.session.execute(newest).fetchall()
+
+    Timeline.query.filter(Timeline.user_id == user_id).delete()
+    if rows:
+        _insert_entries([
+            dict(user_id=user_id, message_id=message_id, timestamp=timestamp)
+            for message_id, timestamp in rows
+        ])
+    db.session.commit()
+
+    return len(rows)
+
+
+def rebuild_timelines(progress=None):
+    """Rebuild every user's timeline; returns how many were rebuilt.
+
+    For turning fan-out on for an existing database. Authors already past
+    TIMELINE_FANOUT_FOLLOWER_LIMIT are marked heavy first, since none of
+    their messages were fanned out. Calls progress(user id, entries) after
+    each user.
+    """
+
+    limit = _config('TIMELINE_FANOUT_FOLLOWER_LIMIT', DEFAULT_FOLLOWER_LIMIT)
+    for (user_id,) in (db.session.query(User.id)
+                       .filter(User.follower_count > limit).all()):
+        _set_heavy(user_id, True)
+    db.session.commit()
+
+    user_ids = [user_id for (user_id,) in
+                db.session.query(User.id).order_by(User.id)]
+    for user_id in user_ids:
+        entries = rebuild_timeline(user_id)
+        if progress:
+            progress(user_id, entries)
+
+    return len(user_ids)
+
+
+##############################################################################
+# Reads
+
+
+def heavy_followed_ids(user_id):
+    """Ids of followed users whose messages aren't fanned out."""
+
+    followed = (select([Follows.user_being_followed_id])
+                .where(Follows.user_following_id == user_id))
+
+    return [user_id for (user_id,) in (
+        db.session
+        .query(HeavyPoster.user_id)
+        .filter(HeavyPoster.user_id.in_(followed)))]
+
+
+def timeline_query(user_id):
+    """Query for the messages on `user_id`'s home timeline.
+
+    Reads the precomputed timeline when fan-out is enabled (plus the pull
+    path for heavy posters); otherwise falls back to searching the messages
+    of everyone the user follows.
+    """
+
+    if not fanout_enabled():
+        followed = (select([Follows.user_being_followed_id])
+                    .where(Follows.user_following_id == user_id))
+        return Message.with_authors().filter(or_(Message.user_id.in_(followed),
+                                                 Message.user_id == user_id))
+
+    precomputed = (select([Timeline.message_id])
+                   .where(Timeline.user_id == user_id))
+    heavy = heavy_followed_ids(user_id)
+
+    if not heavy:
+        return Message.with_authors().filter(Message.id.in_(precomputed))
+
+    return Message.with_authors().filter(or_(Message.id.in_(precomputed),
+                                             Message.user_id.in_(heavy)))
+
+
+def home_timeline(user_id, cursor=None):
+    """One page of `user_id`'s home timeline, newest first."""
+
+    return paginate(timeline_query(user_id), cursor)
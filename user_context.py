@@ -0,0 +1,132 @@
+"""Request-scoped context for the logged-in user.
+
+Loads the current user's row plus the ids of the messages they like and the
+users they follow once per request, so templates can check "do I like this?"
+and "do I follow them?" against sets instead of lazy-loading relationships.
+
+The id sets are also kept in a small in-process cache for USER_CONTEXT_TTL
+seconds. Routes that change them must call invalidate_user_context(); other
+processes pick the change up when their entry expires.
+"""
+
+import hashlib
+import threading
+import time
+
+from flask import current_app
+
+from models import db, User, Likes, Follows
+
+DEFAULT_TTL = 30
+DEFAULT_MAX_ENTRIES = 10000
+
+_cache = {}
+_lock = threading.Lock()
+
+
+class UserContext:
+    """The logged-in user and the ids they like and follow."""
+
+    def __init__(self, user, liked_message_ids, following_ids, version=None):
+        self.user = user
+        self.liked_message_ids = liked_message_ids
+        self.following_ids = following_ids
+        # a digest of the two id sets, for ETags; see caching.py
+        self.version = version or ids_version(liked_message_ids, following_ids)
+
+    def __repr__(self):
+        return f"<UserContext for #{self.user.id}>"
+
+    def likes(self, message):
+        """Does the current user like `message`?"""
+
+        return message.id in self.liked_message_ids
+
+    def is_following(self, other_user):
+        """Is the current user following `other_user`?"""
+
+        return other_user.id in self.following_ids
+
+
+def load_user_context(user_id):
+    """Build the UserContext for `user_id`, or None if there's no such user.
+
+    A deleted (but not yet purged) account counts as no such user.
+    """
+
+    user = User.query.get(user_id)
+    if user is None or user.deleted_at is not None:
+        return None
+
+    ids = _get_cached(user_id)
+    if ids is None:
+        ids = _load_ids(user_id)
+        _set_cached(user_id, ids)
+
+    return UserContext(user, *ids)
+
+
+def invalidate_user_context(user_id):
+    """Forget the cached likes/follows for `user_id`."""
+
+    with _lock:
+        _cache.pop(user_id, None)
+
+
+def clear_user_context_cache():
+    """Forget every cached entry."""
+
+    with _lock:
+        _cache.clear()
+
+
+def _load_ids(user_id):
+    liked_message_ids = frozenset(message_id for (message_id,) in (
+        db.session.query(Likes.message_id).filter(Likes.user_id == user_id)))
+
+    following_ids = frozenset(followed_id for (followed_id,) in (
+        db.session
+        .query(Follows.user_being_followed_id)
+        .filter(Follows.user_following_id == user_id)))
+
+    return (liked_message_ids, following_ids,
+            ids_version(liked_message_ids, following_ids))
+
+
+def ids_version(liked_message_ids, following_ids):
+    """A short digest that changes whenever either id set does."""
+
+    digest = hashlib.sha1()
+    for ids in (liked_message_ids, following_ids):
+        digest.update(','.join(map(str, sorted(ids))).encode())
+        digest.update(b';')
+    return digest.hexdigest()[:16]
+
+
+def _get_cached(user_id):
+    with _lock:
+        entry = _cache.get(user_id)
+
+    if entry is None:
+        return None
+
+    expires_at, ids = entry
+    if expires_at < time.monotonic():
+        return None
+    return ids
+
+
+def _set_cached(user_id, ids):
+    ttl = current_app.config.get('USER_CONTEXT_TTL', DEFAULT_TTL)
+    if ttl <= 0:
+        return
+
+    max_entries = current_app.config.get('USER_CONTEXT_MAX_ENTRIES',
+                                         DEFAULT_MAX_ENTRIES)
+
+    with _lock:
+        _cache.pop(user_id, None)
+        # dicts keep insertion order, so the first key is the oldest entry
+        while len(_cache) >= max_entries:
+            del _cache[next(iter(_cache))]
+        _cache[user_id] = (time.monotonic() + ttl, ids)